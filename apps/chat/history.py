@@ -0,0 +1,72 @@
+import os
+
+from apps.chat.models import ChatMessage, ChatSummary
+from apps.chat.persistence import chat_writer
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "10")) #most recent messages passed to the agent verbatim
+SUMMARY_MAX_CHARS = int(os.getenv("CHAT_SUMMARY_MAX_CHARS", "2000")) #size cap of the rolling summary of older messages
+SUMMARY_LINE_CHARS = 200 #each older message is kept as one line of at most this many characters
+
+
+def load_history(session_id: str) -> tuple[str, list[ChatMessage]]:
+    """
+        Loads the chat context of a session with a constant amount of work per request:
+        - the last HISTORY_WINDOW messages, read through the (session_id, id) index
+        - the rolling summary of everything older, updated with the messages that left the window since the last request
+        Both go by id, not timestamp: timestamps are set when a message is queued but ids when it is written, so a
+        message written late (by a batch that failed over or overflowed) is still newer than the summary's cutoff.
+        returns:
+            (summary, recent messages oldest first)
+    """
+    chat_writer.wait_written(session_id) #messages of the previous request may still be in the write-behind queue
+
+    recent = sorted(
+        ChatMessage.objects.filter(session_id=session_id).order_by("-id")[:HISTORY_WINDOW],
+        key=lambda msg: (msg.timestamp, msg.id),
+    )
+
+    summary = update_summary(session_id, min(msg.id for msg in recent) if len(recent) == HISTORY_WINDOW else None)
+
+    return summary, recent
+
+
+def update_summary(session_id: str, window_start_id: int | None) -> str:
+    """
+        Folds the messages written before the window (id below window_start_id) that are not summarized yet into the
+        session's summary.
+        The summary is extractive (one truncated line per message, oldest lines dropped past SUMMARY_MAX_CHARS) so
+        updating it never costs an LLM call.
+    """
+    summary, _ = ChatSummary.objects.get_or_create(session_id=session_id)
+
+    if window_start_id is None: #the whole conversation still fits in the window
+        return summary.summary
+
+    older = ChatMessage.objects.filter(session_id=session_id, id__lt=window_start_id)
+    if summary.summarized_until_id is not None:
+        older = older.filter(id__gt=summary.summarized_until_id)
+
+    new_messages = list(older.order_by("id"))
+    if not new_messages:
+        return summary.summary
+
+    lines = summary.summary.splitlines() if summary.summary else []
+    for msg in new_messages:
+        content = " ".join(msg.content.split())
+        if len(content) > SUMMARY_LINE_CHARS:
+            content = content[:SUMMARY_LINE_CHARS - 3] + "..."
+        lines.append(f"{msg.role}: {content}")
+
+    while lines and sum(len(line) + 1 for line in lines) > SUMMARY_MAX_CHARS:
+        lines.pop(0)
+
+    summary.summary = "\n".join(lines)
+    summary.summarized_until_id = new_messages[-1].id
+    summary.save(update_fields=["summary", "summarized_until_id", "updated_at"])
+
+    logger.info(f"Folded {len(new_messages)} messages into the summary of session {session_id}")
+
+    return summary.summary
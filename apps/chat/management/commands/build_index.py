@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.chat.rag import pdfloader
+
+
+class Command(BaseCommand):
+    help = "Builds/updates the persisted ChromaDB collections from the pdfs in media/pdfs, web workers only open the result"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--collection",
+            action="append",
+            choices=list(pdfloader.COLLECTIONS),
+            help="collection to build, can be repeated (default: all collections)",
+        )
+        parser.add_argument(
+            "--rebuild",
+            action="store_true",
+            help="ignore the ingestion manifest and re-embed every pdf",
+        )
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+
+        def progress(collection, name, index, total, status):
+            self.stdout.write(f"[{collection}] ({index}/{total}) {name}: {status}")
+
+        try:
+            counts = pdfloader.build_index(
+                collections=options["collection"],
+                rebuild=options["rebuild"],
+                progress=progress,
+            )
+        except Exception as e:
+            raise CommandError(f"Building the index failed: {e}") from e
+
+        for collection, count in counts.items():
+            self.stdout.write(f"{collection}: {count} chunks")
+
+        self.stdout.write(self.style.SUCCESS(f"Index built in {time.perf_counter() - start:.1f}s"))
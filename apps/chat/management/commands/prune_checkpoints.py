@@ -0,0 +1,19 @@
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.chat.rag.checkpoints import CHECKPOINT_DB, SessionCheckpointer
+
+
+class Command(BaseCommand):
+    help = "Deletes the agent checkpoints of chat sessions that expired or no longer exist, run it next to clearsessions"
+
+    def handle(self, *args, **options):
+        if not CHECKPOINT_DB.exists():
+            self.stdout.write("No checkpoint database, nothing to prune")
+            return
+
+        active = Session.objects.filter(expire_date__gt=timezone.now()).values_list("session_key", flat=True)
+        deleted = SessionCheckpointer(CHECKPOINT_DB).prune_threads(active)
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted the checkpoints of {deleted} sessions"))
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.6 on 2026-10-18 10:20
+
+from django.db import migrations, models
+
+
+def summarized_until_to_id(apps, schema_editor):
+    ChatMessage = apps.get_model("chat", "ChatMessage")
+    ChatSummary = apps.get_model("chat", "ChatSummary")
+
+    for summary in ChatSummary.objects.exclude(summarized_until=None):
+        summary.summarized_until_id = ChatMessage.objects.filter(
+            session_id=summary.session_id, timestamp__lte=summary.summarized_until,
+        ).aggregate(models.Max("id"))["id__max"]
+        summary.save(update_fields=["summarized_until_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_chatmessage_turn_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatsummary',
+            name='summarized_until_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.RunPython(summarized_until_to_id, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='chatsummary',
+            name='summarized_until',
+        ),
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chat_msg_session_ts_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['session_id', 'id'], name='chat_msg_session_id_idx'),
+        ),
+    ]
@@ -1,11 +1,30 @@
 from django.db import models
+from django.utils import timezone
 
 # Create your models here.
 class ChatMessage(models.Model):
     session_id = models.CharField(max_length=50) #identifier of session/user
     role = models.CharField(max_length=10) #user or agent
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now) #set when the turn happens, the write-behind queue saves it later
+    latency_ms = models.FloatField(null=True, blank=True) #agent replies: time to produce the reply
+    input_tokens = models.PositiveIntegerField(null=True, blank=True) #agent replies: prompt tokens of every LLM call of the turn
+    output_tokens = models.PositiveIntegerField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["session_id", "id"], name="chat_msg_session_id_idx"), #serves "last N messages of a session"
+        ]
 
     def __str__(self):
         return f"{self.role} ({self.timestamp}): {self.content[:50]}"
+
+
+class ChatSummary(models.Model):
+    session_id = models.CharField(max_length=50, unique=True) #identifier of session/user
+    summary = models.TextField(default="") #rolling summary of the messages older than the history window
+    summarized_until_id = models.BigIntegerField(null=True, blank=True) #id of the newest message folded into the summary, ids follow the write order, timestamps the queue order
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"summary of {self.session_id} until message {self.summarized_until_id}"
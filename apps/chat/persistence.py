@@ -0,0 +1,175 @@
+import atexit
+import os
+import queue
+import threading
+import time
+
+from django.db import close_old_connections, transaction
+
+from apps.chat.models import ChatMessage
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+WRITE_QUEUE_SIZE = int(os.getenv("CHAT_WRITE_QUEUE_SIZE", "1000")) #turns waiting to be written, when full they are written on the request path
+WRITE_BATCH_SIZE = int(os.getenv("CHAT_WRITE_BATCH_SIZE", "100")) #most messages per bulk_create
+WRITE_FLUSH_INTERVAL = float(os.getenv("CHAT_WRITE_FLUSH_INTERVAL", "0.2")) #seconds a message waits for more to batch with
+WRITE_WAIT_TIMEOUT = float(os.getenv("CHAT_WRITE_WAIT_TIMEOUT", "5")) #seconds a history read waits for its session's queued messages
+
+
+class WriteBehindQueue:
+    """
+        Saves chat messages from a background thread so the request path never waits on a SQLite write lock.
+        Messages are collected for up to WRITE_FLUSH_INTERVAL seconds (or WRITE_BATCH_SIZE messages) and written with
+        one bulk_create per batch. Timestamps are set when a message is queued, so the order of a session is kept.
+        A message is readable once its batch is written, usually within WRITE_FLUSH_INTERVAL, load_history calls
+        wait_written first so a session always reads its own messages.
+    """
+
+    def __init__(self, max_size: int = WRITE_QUEUE_SIZE, batch_size: int = WRITE_BATCH_SIZE, flush_interval: float = WRITE_FLUSH_INTERVAL):
+        self.queue: queue.Queue[ChatMessage] = queue.Queue(maxsize=max_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.lock = threading.Lock()
+        self.written_condition = threading.Condition(self.lock) #notified after every batch
+        self.thread: threading.Thread | None = None
+        self.pending: dict[str, int] = {} #session id -> queued messages not written yet
+
+        self.written = 0
+        self.batches = 0
+        self.failed = 0
+        self.overflowed = 0 #messages written on the request path because the queue was full
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="chat-writer", daemon=True)
+                self.thread.start()
+
+    def put(self, messages: list[ChatMessage]) -> list[ChatMessage]:
+        """
+            queues messages without blocking
+            returns:
+                the messages that did not fit because the queue is full, the caller has to write them itself
+        """
+        self._start()
+
+        for i, message in enumerate(messages):
+            with self.lock: #counted before it is queued, the writer may take it right away
+                self.pending[message.session_id] = self.pending.get(message.session_id, 0) + 1
+
+            try:
+                self.queue.put_nowait(message)
+            except queue.Full:
+                overflow = messages[i:]
+                with self.lock:
+                    self._done(message)
+                    self.overflowed += len(overflow)
+                logger.warning(f"Chat write queue full, writing {len(overflow)} messages on the request path")
+                return overflow
+
+        return []
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._write(batch)
+
+            with self.lock:
+                for message in batch:
+                    self._done(message)
+                self.written_condition.notify_all()
+
+            for _ in batch:
+                self.queue.task_done()
+
+    def _done(self, message: ChatMessage):
+        """
+            drops a message from the pending counts, called with the lock held
+        """
+        count = self.pending.get(message.session_id, 0) - 1
+        if count > 0:
+            self.pending[message.session_id] = count
+        else:
+            self.pending.pop(message.session_id, None)
+
+    def _write(self, batch: list[ChatMessage]):
+        close_old_connections()
+
+        try:
+            with transaction.atomic():
+                ChatMessage.objects.bulk_create(batch)
+        except Exception as e:
+            logger.exception(f"Failed to write {len(batch)} chat messages: {e}")
+            with self.lock:
+                self.failed += len(batch)
+            return
+
+        with self.lock:
+            self.written += len(batch)
+            self.batches += 1
+
+        logger.debug(f"Wrote {len(batch)} chat messages")
+
+    def wait_written(self, session_id: str, timeout: float = WRITE_WAIT_TIMEOUT) -> bool:
+        """
+            blocks until every queued message of the session is written (or failed to be)
+            returns:
+                False if timeout expired first
+        """
+        with self.written_condition:
+            done = self.written_condition.wait_for(lambda: session_id not in self.pending, timeout)
+
+        if not done:
+            logger.warning(f"Chat messages of session {session_id} still queued after {timeout}s, reading the history without them")
+
+        return done
+
+    def flush(self):
+        """
+            blocks until every queued message is written, called at interpreter exit
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queued" : self.queue.qsize(),
+                "written" : self.written,
+                "batches" : self.batches,
+                "mean_batch" : round(self.written / self.batches, 2) if self.batches else 0.0,
+                "failed" : self.failed,
+                "overflowed" : self.overflowed,
+            }
+
+
+chat_writer = WriteBehindQueue()
+atexit.register(chat_writer.flush)
+
+
+def save_messages(*messages: ChatMessage):
+    """
+        persists chat messages through the write-behind queue, or right away when it is full
+    """
+    overflow = chat_writer.put(list(messages))
+    if overflow:
+        ChatMessage.objects.bulk_create(overflow)
+
+
+async def asave_messages(*messages: ChatMessage):
+    overflow = chat_writer.put(list(messages))
+    if overflow:
+        await ChatMessage.objects.abulk_create(overflow)
@@ -1,29 +1,64 @@
+import asyncio
+import hashlib
 import os
+import time
+from contextlib import nullcontext
 from dotenv import load_dotenv
 from pathlib import Path
 from langchain_groq import ChatGroq
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from apps.chat.rag import graph, tools, pdfloader, build_graph
-from apps.chat.rag.router import RouterRetriever
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
+from apps.chat.rag import tools, pdfloader, build_graph
+from apps.chat.rag.answer_cache import SemanticAnswerCache, self_contained
+from apps.chat.rag.budget import TOOL_TOKEN_BUDGET, fit_history
+from apps.chat.rag.checkpoints import CHECKPOINTS_ENABLED, SessionCheckpointer, session_locks
+from apps.chat.rag.embeddings import get_embeddings
+from apps.chat.rag.gateway import LLMGateway
+from apps.chat.rag.intent import IntentClassifier
+from apps.chat.rag.reranker import CrossEncoderReranker
+from apps.chat.rag.router import EmbeddingRouter, RouterRetriever
+from apps.chat.rag.runtime import AgentRuntime
+from apps.chat.rag.speculation import SPECULATION_ENABLED, SpeculativeRetrieval
 from config.logger import get_logger
+from config.tracing import add_counts, current_totals, span
 
 logger = get_logger(__name__)
 
-rag_agent = None
+#default runtime of this process, set once by init_rag and never mutated afterwards
+runtime: AgentRuntime | None = None
 
-def init_rag():
+CONTEXT_MESSAGES = int(os.getenv("RAG_ANSWER_CACHE_CONTEXT_MESSAGES", "2")) #latest messages a cached answer is tied to
+
+#appended to the system prompt of the retrieve_first graph, tells the llm when to fall back to its tools
+RETRIEVE_FIRST_PROMPT = """
+    The documents have already been searched for the user's latest message, the results are in the retriever_tool message.
+    Answer from them directly. Only call a tool if they do not contain what you need to answer.
+"""
+
+def init_rag(build_index: bool | None = None, llm: BaseChatModel | None = None, graph_mode: str | None = None) -> AgentRuntime:
     """
         This initializes the rag agent.
         - loads environment variables
         - sets up LLM and tools
-        - injects dependencies into graph and tools
+        - bundles them with the retriever into an AgentRuntime that is passed to the graph through its config
         - builds the langgraph graph
+        Args:
+            build_index: ingest new/changed pdfs before serving. Defaults to the RAG_INDEX_MODE environment variable,
+                "serve" (default) only opens the index built by `python manage.py build_index`, "build" updates it first
+            llm: chat model to use instead of ChatGroq, e.g. the scripted model of the offline benchmark
+            graph_mode: "agent" (tool loop) or "retrieve_first" (search, then a single llm call), defaults to the
+                RAG_GRAPH_MODE environment variable
+        returns:
+            AgentRuntime: the initialized runtime, also stored as the module's default runtime
     """
 
-    global rag_agent
+    global runtime
 
     load_dotenv() #loads data from .env file
 
+    if build_index is None:
+        build_index = os.getenv("RAG_INDEX_MODE", "serve").lower() == "build"
+
     BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
     prompt_path = BASE_DIR / "config" / "system_prompt.txt"
@@ -50,46 +85,110 @@ def init_rag():
             - Do not repeat or re-answer earlier questions unless the user explicitly asks again.
             - Do not perform unrelated tasks or answer off-topic questions.
             - You can only call tools a maximum of 3 times per user query.
+            - For questions about whether a company or ticker is listed, or what a ticker/company is, use listing_lookup first.
 
             Your goal: sound clear, natural, and human-like, while staying strictly grounded in the PDF's content.
         """
 
+    graph_mode = graph_mode or build_graph.GRAPH_MODE
+    if graph_mode == "retrieve_first":
+        SYSTEM_PROMPT += RETRIEVE_FIRST_PROMPT
+
     #Initialize the LLM
-    llm_model = ChatGroq(model="openai/gpt-oss-120b", temperature=0)
+    #retries are left to the LLM gateway so rate limited calls back off with jitter instead of holding a worker
+    llm_model = llm if llm is not None else ChatGroq(
+        model="openai/gpt-oss-120b",
+        temperature=0,
+        timeout=float(os.getenv("RAG_LLM_TIMEOUT", "60")),
+        max_retries=0,
+    )
 
-    #bind the tools to LLM
+    #bind the tools to LLM, the answer model keeps them declared (the prompt holds their calls) but may not call them
+    answer_model = llm_model.bind_tools(list(tools.tools_dict.values()), tool_choice="none")
     llm_model = llm_model.bind_tools(list(tools.tools_dict.values()))
 
-    #Inject into graph
-    graph.llm_model = llm_model
+    #Initialize retrievers
+    listing_retriever, market_retriever = pdfloader.init_retriever(build=build_index)
 
-    graph.sys_prompt = SYSTEM_PROMPT
+    #Embedding router, queries both collections when its confidence margin is below RAG_ROUTER_THRESHOLD
+    query_router = None
+    if os.getenv("RAG_ROUTER", "embedding").lower() == "embedding":
+        query_router = EmbeddingRouter(get_embeddings(), threshold=float(os.getenv("RAG_ROUTER_THRESHOLD", "0.05")))
 
-    graph.tools_dict = tools.tools_dict
+    retriever = RouterRetriever(
+        listing_retriever,
+        market_retriever,
+        logger,
+        cache_size=int(os.getenv("RAG_RETRIEVAL_CACHE_SIZE", "256")),
+        version_fn=pdfloader.index_version,
+        mode=os.getenv("RAG_RETRIEVAL_MODE", "hybrid").lower(),
+        lexical_loader=pdfloader.init_lexical_indexes,
+        query_router=query_router,
+        reranker=CrossEncoderReranker() if os.getenv("RAG_RERANK", "1") != "0" else None,
+        candidate_k=int(os.getenv("RAG_RERANK_CANDIDATES", "20")),
+        token_budget=TOOL_TOKEN_BUDGET, #the same budget retriever_tool fits its result in
+    )
 
-    #Initialize retrievers
-    listing_retriever, market_retriever = pdfloader.init_retriever()
-    tools.retriever = RouterRetriever(listing_retriever, market_retriever, logger)
+    #Cache of final answers for near-duplicate questions, skips the LLM and chroma entirely on a hit
+    answer_cache = None
+    if os.getenv("RAG_ANSWER_CACHE", "1") != "0":
+        answer_cache = SemanticAnswerCache(
+            get_embeddings(),
+            threshold=float(os.getenv("RAG_ANSWER_CACHE_THRESHOLD", "0.95")),
+            ttl=float(os.getenv("RAG_ANSWER_CACHE_TTL", "3600")),
+            max_entries=int(os.getenv("RAG_ANSWER_CACHE_SIZE", "512")),
+        )
 
-    #Build the graph
-    rag_agent = build_graph.init_graph()
+    #Local classifier that answers greetings and clearly off-topic messages from templates, without calling the LLM
+    intent_classifier = None
+    if os.getenv("RAG_INTENT_FAST_PATH", "1") != "0":
+        intent_classifier = IntentClassifier(
+            get_embeddings(),
+            threshold=float(os.getenv("RAG_INTENT_THRESHOLD", "0.6")),
+            margin=float(os.getenv("RAG_INTENT_MARGIN", "0.1")),
+        )
+
+    #Chat sessions keep their graph state (answers, tool results) in a SQLite checkpointer between requests
+    checkpointer = SessionCheckpointer() if CHECKPOINTS_ENABLED else None
+
+    #Build the graph and bundle everything a run needs
+    runtime = AgentRuntime(
+        llm_model=llm_model,
+        answer_model=answer_model,
+        sys_prompt=SYSTEM_PROMPT,
+        tools_dict=tools.tools_dict,
+        retriever=retriever,
+        listing_index=pdfloader.load_listing_index(),
+        graph=build_graph.init_graph(graph_mode),
+        session_graph=build_graph.init_graph(graph_mode, checkpointer) if checkpointer is not None else None,
+        checkpointer=checkpointer,
+        graph_mode=graph_mode,
+        answer_cache=answer_cache,
+        gateway=LLMGateway(),
+        intent_classifier=intent_classifier,
+    )
 
     logger.info("RAG agent initialization complete")
 
+    return runtime
+
+
+def _get_runtime(agent_runtime: AgentRuntime | None) -> AgentRuntime:
+    agent_runtime = agent_runtime or runtime
+
+    if agent_runtime is None:
+        raise RuntimeError("Agent not initialized. Call init_rag() first.")
+
+    return agent_runtime
 
-def run_agent(previous_messages, user_input: str) -> str:
+
+def build_input_state(previous_messages, user_input: str, summary: str = "") -> dict:
     """
-        This runs the agent.
+        Converts the DB chat history and the new user input into the graph's input state
         Args:
-            user_input: user input to pass to LLM
-        Returns:
-            str: response from LLM
+            previous_messages: the most recent messages of the session
+            summary: rolling summary of the messages older than previous_messages
     """
-    global rag_agent
-
-    if rag_agent is None:
-        raise RuntimeError("Agent not initialized. Call init_rag() first.")
-    
     #Convert DB messages to Langchain Mesages
     message_history = []
     context_history = []
@@ -102,17 +201,73 @@ def run_agent(previous_messages, user_input: str) -> str:
     
     last_10 = message_history[-10:]
 
-    context_history.append(SystemMessage(content="Here is the chat so far: " + "\n".join(m.content for m in last_10)))
+    if summary:
+        context_history.append(SystemMessage(content="Summary of the earlier conversation: \n" + summary))
+
+    history_lines = fit_history([m.content for m in last_10]) #most recent messages within RAG_HISTORY_TOKEN_BUDGET
+    context_history.append(SystemMessage(content="Here is the chat so far: " + "\n".join(history_lines)))
     
     context_history.append(HumanMessage(content=user_input))
     logger.info(f"last appended message: {context_history[-1].content}")
-    state = {
+
+    return {
         "messages" : context_history,
         "tool_call_count": 0,
     }
 
-    final_state = rag_agent.invoke(state)
 
+def graph_input(agent_runtime: AgentRuntime, previous_messages, user_input: str, summary: str, session_id: str | None, **configurable):
+    """
+        returns (graph, input state, config) of a run. With a session id and a checkpointer only the new message is
+        passed and the session's stored state supplies the earlier turns, otherwise the DB history is converted
+    """
+    if session_id is not None and agent_runtime.session_graph is not None:
+        state = {"messages" : [HumanMessage(content=user_input)], "tool_call_count" : 0}
+        return agent_runtime.session_graph, state, agent_runtime.config(thread_id=session_id, **configurable)
+
+    return agent_runtime.graph, build_input_state(previous_messages, user_input, summary), agent_runtime.config(**configurable)
+
+
+def session_turn(agent_runtime: AgentRuntime, session_id: str | None):
+    """
+        returns a context manager holding the session's lock for a whole turn when its state is checkpointed, so turns
+        of one session run one after the other. Raises checkpoints.SessionBusy when the wait times out
+    """
+    if session_id is None or agent_runtime.session_graph is None:
+        return nullcontext()
+
+    return session_locks.hold(session_id)
+
+
+def asession_turn(agent_runtime: AgentRuntime, session_id: str | None):
+    """
+        async variant of session_turn for astream_agent
+    """
+    if session_id is None or agent_runtime.session_graph is None:
+        return nullcontext()
+
+    return session_locks.ahold(session_id)
+
+
+def remember_turn(agent_runtime: AgentRuntime, session_id: str | None, user_input: str, reply: str):
+    """
+        appends a turn answered without the graph (local fast path, answer cache) to the session's stored state
+    """
+    if session_id is None or agent_runtime.session_graph is None:
+        return
+
+    agent_runtime.session_graph.update_state(
+        agent_runtime.config(thread_id=session_id),
+        {"messages" : [HumanMessage(content=user_input), AIMessage(content=reply)], "tool_call_count" : 0},
+        as_node="llm",
+    )
+    agent_runtime.checkpointer.prune(session_id)
+
+
+def final_reply(final_state: dict) -> str:
+    """
+        Extracts the text of the last message of the graph's final state
+    """
     last_message = final_state["messages"][-1]
     logger.info(last_message)
     if isinstance(last_message, str):
@@ -120,4 +275,221 @@ def run_agent(previous_messages, user_input: str) -> str:
     elif hasattr(last_message, "content"):
         return last_message.content
     else:
-        return str(last_message)
\ No newline at end of file
+        return str(last_message)
+
+
+def cacheable(final_state: dict) -> bool:
+    """
+        True when the run ended on a complete answer: a non-empty reply that was not cut short by the tool limit,
+        from tool calls of this turn that all succeeded
+    """
+    messages = final_state["messages"]
+    last_message = messages[-1]
+    turn_start = max((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), default=0)
+
+    return (
+        isinstance(last_message, AIMessage)
+        and bool(last_message.content)
+        and not last_message.tool_calls
+        and last_message.response_metadata.get("finish_reason") != "tool_limit"
+        and not any(isinstance(m, ToolMessage) and m.status == "error" for m in messages[turn_start:])
+    )
+
+
+def conversation_context(agent_runtime: AgentRuntime, user_input: str, previous_messages, summary: str, session_id: str | None) -> str:
+    """
+        returns a digest of the latest CONTEXT_MESSAGES messages of the conversation, "" for its first message and for
+        self-contained questions. Answers to follow-ups are only reused in the same context, "and its CEO?" asks
+        something else in every chat, while "what is AAPL's exchange?" is shared by every chat that asks it.
+    """
+    if self_contained(user_input):
+        return ""
+
+    if session_id is not None and agent_runtime.session_graph is not None:
+        stored = agent_runtime.session_graph.get_state(agent_runtime.config(thread_id=session_id)).values.get("messages", [])
+        contents = [m.content for m in stored if isinstance(m, (HumanMessage, AIMessage)) and m.content and not getattr(m, "tool_calls", None)]
+    else:
+        contents = [msg.content for msg in previous_messages or []]
+
+    if not contents:
+        return "" if not summary else hashlib.sha1(summary.encode("utf-8")).hexdigest()
+
+    return hashlib.sha1("\n".join(contents[-CONTEXT_MESSAGES:]).encode("utf-8")).hexdigest()
+
+
+def cached_answer(agent_runtime: AgentRuntime, user_input: str, previous_messages, summary: str,
+                  session_id: str | None) -> tuple[str | None, str | None, str]:
+    """
+        returns (cached reply or None, index version and conversation context the reply has to be stored under)
+    """
+    if agent_runtime.answer_cache is None:
+        return None, None, ""
+
+    version = pdfloader.index_version()
+    context = conversation_context(agent_runtime, user_input, previous_messages, summary, session_id)
+    cached_reply = agent_runtime.answer_cache.lookup(user_input, version, context)
+    if cached_reply is not None:
+        logger.info("Answered from answer cache")
+
+    return cached_reply, version, context
+
+
+def local_reply(agent_runtime: AgentRuntime, user_input: str) -> str | None:
+    """
+        returns a template reply when the message is confidently a greeting or off-topic, None when the agent has to answer
+    """
+    if agent_runtime.intent_classifier is None:
+        return None
+
+    with span("intent.classify") as intent_span:
+        reply = agent_runtime.intent_classifier.reply(user_input)
+        intent_span.set(local=reply is not None)
+
+    if reply is not None:
+        add_counts(llm_calls_avoided=1)
+
+    return reply
+
+
+def speculate(agent_runtime: AgentRuntime, user_input: str) -> SpeculativeRetrieval | None:
+    """
+        starts searching the user input while the first LLM call runs, in the agent graph only (retrieve_first
+        already searches before calling the LLM) and only when the intent classifier expects a question about the
+        documents, chit-chat is answered without tools and its search would be wasted
+    """
+    if not SPECULATION_ENABLED or agent_runtime.retriever is None or agent_runtime.graph_mode != "agent":
+        return None
+
+    if agent_runtime.intent_classifier is not None and not agent_runtime.intent_classifier.likely_in_scope(user_input):
+        add_counts(speculation_skipped=1)
+        return None
+
+    return SpeculativeRetrieval(agent_runtime.retriever, user_input, embeddings=get_embeddings())
+
+
+def run_agent(previous_messages, user_input: str, agent_runtime: AgentRuntime | None = None, summary: str = "",
+              session_id: str | None = None) -> str:
+    """
+        This runs the agent. Safe to call from many threads at once, all per-run data lives in the graph state.
+        Args:
+            previous_messages: most recent chat history rows of the session, not needed when session_id is checkpointed
+            user_input: user input to pass to LLM
+            agent_runtime: runtime to run with, defaults to the one created by init_rag()
+            summary: rolling summary of the conversation before previous_messages
+            session_id: chat session, its graph state is restored from and saved to the checkpointer, turns of one
+                session run one at a time
+        Returns:
+            str: response from LLM
+    """
+    agent_runtime = _get_runtime(agent_runtime)
+
+    with span("run_agent", start_trace=True, graph_mode=agent_runtime.graph_mode) as run_span, session_turn(agent_runtime, session_id):
+        reply = local_reply(agent_runtime, user_input)
+        run_span.set(local=reply is not None)
+        if reply is not None:
+            remember_turn(agent_runtime, session_id, user_input, reply)
+            return reply
+
+        with span("answer_cache.lookup"):
+            cached_reply, version, context = cached_answer(agent_runtime, user_input, previous_messages, summary, session_id)
+        run_span.set(cached=cached_reply is not None)
+        if cached_reply is not None:
+            remember_turn(agent_runtime, session_id, user_input, cached_reply)
+            return cached_reply
+
+        speculation = speculate(agent_runtime, user_input)
+        graph, state, config = graph_input(agent_runtime, previous_messages, user_input, summary, session_id, speculation=speculation)
+        try:
+            final_state = graph.invoke(state, config=config)
+        finally:
+            if speculation is not None:
+                speculation.discard()
+
+        if graph is agent_runtime.session_graph:
+            with span("checkpoints.prune"):
+                agent_runtime.checkpointer.prune(session_id)
+
+        reply = final_reply(final_state)
+
+        if agent_runtime.answer_cache is not None and cacheable(final_state):
+            agent_runtime.answer_cache.store(user_input, reply, version, context)
+
+    return reply
+
+
+async def astream_agent(previous_messages, user_input: str, agent_runtime: AgentRuntime | None = None, summary: str = "",
+                        session_id: str | None = None):
+    """
+        Runs the agent and yields events as they happen, used by the streaming endpoint.
+        Yields dicts of {"event": name, "data": payload}:
+            token: a piece of the LLM's answer
+            reset: the text streamed so far was a preamble to tool calls, not the answer
+            tool_start / tool_end: a tool started/finished, with its name
+            done: the final reply and the turn's token usage
+    """
+    agent_runtime = _get_runtime(agent_runtime)
+
+    with span("astream_agent", start_trace=True, graph_mode=agent_runtime.graph_mode) as run_span:
+        start = time.perf_counter()
+
+        async with asession_turn(agent_runtime, session_id):
+            async for event in _astream_agent(previous_messages, user_input, agent_runtime, summary, session_id):
+                if event["event"] == "token" and "first_token_ms" not in run_span.attrs:
+                    run_span.set(first_token_ms=round((time.perf_counter() - start) * 1000, 1))
+                if event["event"] == "done":
+                    run_span.set(cached=event["data"]["cached"])
+                    totals = current_totals()
+                    event["data"]["usage"] = {key : totals.get(key, 0) for key in ("input_tokens", "output_tokens", "llm_calls")}
+                yield event
+
+
+async def _astream_agent(previous_messages, user_input: str, agent_runtime: AgentRuntime, summary: str, session_id: str | None):
+    reply = await asyncio.to_thread(local_reply, agent_runtime, user_input)
+    if reply is not None:
+        await asyncio.to_thread(remember_turn, agent_runtime, session_id, user_input, reply)
+        yield {"event" : "done", "data" : {"reply" : reply, "cached" : False}}
+        return
+
+    cached_reply, version, context = await asyncio.to_thread(cached_answer, agent_runtime, user_input, previous_messages, summary, session_id) #embedding the question is blocking work
+    if cached_reply is not None:
+        await asyncio.to_thread(remember_turn, agent_runtime, session_id, user_input, cached_reply)
+        yield {"event" : "done", "data" : {"reply" : cached_reply, "cached" : True}}
+        return
+
+    reply, final_state = None, None
+    speculation = speculate(agent_runtime, user_input)
+    graph, state, config = graph_input(agent_runtime, previous_messages, user_input, summary, session_id, speculation=speculation)
+
+    try:
+        async for event in graph.astream_events(state, config=config, version="v2"):
+            kind = event["event"]
+
+            if kind == "on_chat_model_stream":
+                content = event["data"]["chunk"].content
+                if content:
+                    yield {"event" : "token", "data" : {"text" : content}}
+
+            elif kind == "on_chat_model_end":
+                if getattr(event["data"].get("output"), "tool_calls", None):
+                    yield {"event" : "reset", "data" : {}}
+
+            elif kind == "on_tool_start":
+                yield {"event" : "tool_start", "data" : {"name" : event["name"]}}
+
+            elif kind == "on_tool_end":
+                yield {"event" : "tool_end", "data" : {"name" : event["name"]}}
+
+            elif kind == "on_chain_end" and not event.get("parent_ids"): #end of the root run carries the final state
+                final_state = event["data"]["output"]
+                reply = final_reply(final_state)
+    finally:
+        if speculation is not None:
+            speculation.discard()
+
+    if graph is agent_runtime.session_graph:
+        await asyncio.to_thread(agent_runtime.checkpointer.prune, session_id)
+
+    if agent_runtime.answer_cache is not None and final_state is not None and cacheable(final_state):
+        await asyncio.to_thread(agent_runtime.answer_cache.store, user_input, reply, version, context)
+
+    yield {"event" : "done", "data" : {"reply" : reply or "", "cached" : False}}
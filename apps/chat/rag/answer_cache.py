@@ -0,0 +1,151 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+#words that point back at earlier turns ("and its CEO?"), a question holding one is only answered from cache in the same chat
+REFERENCE_WORDS = {
+    "it", "its", "they", "them", "their", "theirs", "he", "him", "his", "she", "her", "hers", "this", "that", "these",
+    "those", "above", "previous", "earlier", "same", "former", "latter", "else", "also", "too", "again", "more", "one", "ones",
+}
+CONTINUATION_STARTS = ("and", "but", "so", "then", "what about", "how about") #"what about MSFT?" continues the last question
+MIN_SELF_CONTAINED_WORDS = 3 #"why?" or "which one?" never stand on their own
+
+
+def normalize_question(question: str) -> str:
+    """
+        lowercases, collapses whitespace and drops trailing punctuation so trivially different questions embed the same
+    """
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?!. ")
+
+
+def self_contained(question: str) -> bool:
+    """
+        True when the question can be answered without the earlier turns of its chat: long enough, not a follow-up
+        ("and ...", "what about ...") and no word referring back to them. Errs towards False, which only costs a cache hit.
+    """
+    normalized = normalize_question(question)
+    words = re.findall(r"\w+", normalized)
+
+    return (
+        len(words) >= MIN_SELF_CONTAINED_WORDS
+        and not any(normalized == start or normalized.startswith(start + " ") for start in CONTINUATION_STARTS)
+        and not REFERENCE_WORDS.intersection(words)
+    )
+
+
+class SemanticAnswerCache:
+    """
+        Caches final agent answers keyed on the embedding of the normalised question and its conversation context.
+        A lookup is a hit when a stored question has cosine similarity >= threshold, was asked in the same context
+        (see agent.conversation_context, "" for self-contained questions), was stored less than ttl seconds ago
+        and was answered against the same index version, so re-ingesting the pdfs invalidates it.
+        Entries are evicted least recently used once max_entries is reached.
+    """
+
+    def __init__(self, embeddings: Embeddings, threshold: float = 0.95, ttl: float = 3600, max_entries: int = 512):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[tuple[str, str], dict] = OrderedDict() #(context, normalised question) -> entry
+        self.version = None
+
+        self.hits = 0
+        self.misses = 0
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _check_version(self, version: str):
+        if version != self.version:
+            if self.entries:
+                logger.info(f"Index version changed, clearing {len(self.entries)} cached answers")
+            self.entries.clear()
+            self.version = version
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        for key in [k for k, entry in self.entries.items() if entry["created"] < cutoff]:
+            del self.entries[key]
+
+    def lookup(self, question: str, version: str, context: str = "") -> str | None:
+        """
+            returns the cached answer for a near-duplicate question asked in the same context, or None on a miss
+        """
+        key = (context, normalize_question(question))
+
+        with self.lock:
+            self._check_version(version)
+            self._expire()
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                return self._hit(key, entry)
+
+            if not self.entries:
+                self.misses += 1
+                return None
+
+        vector = self._embed(key[1]) #embedded outside the lock so concurrent lookups are not serialised on the model
+
+        with self.lock:
+            keys = [k for k in self.entries if k[0] == context]
+            if keys:
+                scores = np.stack([self.entries[k]["vector"] for k in keys]) @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    logger.info(f"Answer cache: similar question found (similarity {scores[best]:.3f})")
+                    return self._hit(keys[best], self.entries[keys[best]])
+
+            self.misses += 1
+            return None
+
+    def _hit(self, key: tuple[str, str], entry: dict) -> str:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry["answer"]
+
+    def store(self, question: str, answer: str, version: str, context: str = ""):
+        """
+            stores the final answer for a question asked in context
+        """
+        key = (context, normalize_question(question))
+        vector = self._embed(key[1])
+
+        with self.lock:
+            self._check_version(version)
+
+            self.entries[key] = {
+                "vector" : vector,
+                "answer" : answer,
+                "created" : time.time(),
+            }
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hit_rate" : self.hits / total if total else 0.0,
+                "size" : len(self.entries),
+                "max_entries" : self.max_entries,
+                "threshold" : self.threshold,
+                "ttl" : self.ttl,
+            }
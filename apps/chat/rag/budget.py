@@ -0,0 +1,215 @@
+import os
+import re
+
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage, ToolMessage
+
+from apps.chat.rag.lexical import tokenize
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+CHARS_PER_TOKEN = 4 #rough estimate for english text, errs on the high side for the number heavy pdf chunks
+MESSAGE_OVERHEAD_TOKENS = 4 #role and separators the chat template adds around every message
+
+LLM_TOKEN_BUDGET = int(os.getenv("RAG_LLM_TOKEN_BUDGET", "6000")) #prompt tokens a single call_llm may send
+TOOL_TOKEN_BUDGET = int(os.getenv("RAG_TOOL_TOKEN_BUDGET", "1200")) #tokens of one tool result
+HISTORY_TOKEN_BUDGET = int(os.getenv("RAG_HISTORY_TOKEN_BUDGET", "800")) #tokens of the chat history passed with the user input
+MIN_OVERLAP_CHARS = 20 #shorter common prefixes/suffixes between chunks are coincidence, not splitter overlap
+MAX_OVERLAP_CHARS = 400 #twice the splitter's CHUNK_OVERLAP, the overlap cut on a word boundary can be a bit longer
+
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+|\n+")
+STOP_WORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "of", "on", "in", "to", "for", "and", "or", "what", "which", "who",
+    "how", "does", "do", "did", "it", "its", "this", "that", "with", "by", "at", "as", "be", "about", "me", "tell",
+}
+
+
+def count_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def message_tokens(message: BaseMessage) -> int:
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    tokens = count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+    for tool_call in getattr(message, "tool_calls", None) or []:
+        tokens += count_tokens(tool_call.get("name", "") + str(tool_call.get("args", {})))
+
+    return tokens
+
+
+def truncate(text: str, max_tokens: int) -> str:
+    max_chars = max(max_tokens, 0) * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    return text[:max(max_chars - 3, 0)] + "..."
+
+
+def _overlap(previous: str, current: str) -> int:
+    """
+        length of the longest suffix of previous that current starts with (the text splitter's chunk overlap)
+    """
+    for size in range(min(len(previous), len(current), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if previous.endswith(current[:size]):
+            return size
+
+    return 0
+
+
+def dedupe_chunks(docs: list[Document]) -> list[Document]:
+    """
+        Drops chunks contained in another returned chunk and cuts the overlap that consecutive chunks of the same
+        page share (RecursiveCharacterTextSplitter repeats up to CHUNK_OVERLAP characters), keeping docs' order
+    """
+    results: list[Document] = []
+
+    for doc in docs:
+        text = doc.page_content.strip()
+
+        if any(text in kept.page_content for kept in results):
+            continue
+
+        for kept in results:
+            if kept.metadata.get("source") != doc.metadata.get("source") or kept.metadata.get("page") != doc.metadata.get("page"):
+                continue
+
+            overlap = _overlap(kept.page_content, text)
+            if overlap:
+                text = text[overlap:].lstrip()
+                continue
+
+            overlap = _overlap(text, kept.page_content) #doc is the chunk before kept
+            if overlap:
+                text = text[:-overlap].rstrip()
+
+        if text:
+            results.append(Document(page_content=text, metadata=doc.metadata, id=doc.id))
+
+    return results
+
+
+def query_terms(query: str) -> set[str]:
+    return {term for term in tokenize(query) if term not in STOP_WORDS}
+
+
+def extract_relevant(text: str, query: str, max_tokens: int) -> str:
+    """
+        Keeps the sentences of text sharing the most terms with query, in their original order, within max_tokens.
+        Text that already fits is returned unchanged.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    sentences = [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence.strip()]
+    terms = query_terms(query)
+
+    ranked = sorted(
+        range(len(sentences)),
+        key=lambda i: (len(terms & set(tokenize(sentences[i]))), -i), #ties keep the earlier sentence
+        reverse=True,
+    )
+
+    keep = set()
+    used = 0
+    for i in ranked:
+        tokens = count_tokens(sentences[i]) + 1
+        if used + tokens > max_tokens:
+            continue
+        keep.add(i)
+        used += tokens
+
+    if not keep: #a single sentence longer than the budget
+        return truncate(sentences[ranked[0]], max_tokens)
+
+    return " ".join(sentences[i] for i in sorted(keep))
+
+
+def share_budget(sizes: list[int], max_tokens: int) -> list[int]:
+    """
+        splits max_tokens over texts of the given token sizes: texts smaller than an equal share keep their size and
+        what they leave over goes to the larger ones, so texts that already fit together are never cut
+    """
+    shares = [0] * len(sizes)
+    remaining = max_tokens
+
+    for done, i in enumerate(sorted(range(len(sizes)), key=lambda i: sizes[i])):
+        shares[i] = min(sizes[i], remaining // (len(sizes) - done))
+        remaining -= shares[i]
+
+    return shares
+
+
+def fit_history(lines: list[str], max_tokens: int = HISTORY_TOKEN_BUDGET) -> list[str]:
+    """
+        keeps the most recent history lines that fit in max_tokens, the oldest kept line is cut to fit
+    """
+    kept = []
+    used = 0
+
+    for line in reversed(lines):
+        tokens = count_tokens(line) + 1
+        if used + tokens > max_tokens:
+            if max_tokens - used > 8:
+                kept.append(truncate(line, max_tokens - used - 1))
+            break
+        kept.append(line)
+        used += tokens
+
+    return kept[::-1]
+
+
+def fit_messages(messages: list[BaseMessage], max_tokens: int = LLM_TOKEN_BUDGET) -> list[BaseMessage]:
+    """
+        Returns messages shrunk to fit in max_tokens, trimming in this order until they fit:
+        1. history SystemMessages after the first one (the system prompt), oldest lines first
+        2. ToolMessages, down to the sentences most relevant to the latest user question, oldest results first
+        3. every message but the system prompt and the latest user question, cut to an equal share of what is left
+        Messages are never dropped, so AIMessage tool calls always keep their ToolMessage.
+    """
+    messages = list(messages)
+    total = sum(message_tokens(m) for m in messages)
+
+    if total <= max_tokens:
+        return messages
+
+    start_total = total
+    question = next((m.content for m in reversed(messages) if isinstance(m, HumanMessage)), "")
+    protected = {0} | {i for i, m in enumerate(messages) if isinstance(m, HumanMessage) and m.content == question}
+
+    def shrink(i: int, content: str):
+        nonlocal total
+        total -= message_tokens(messages[i])
+        messages[i] = messages[i].model_copy(update={"content" : content})
+        total += message_tokens(messages[i])
+
+    #1. chat history and summary
+    for i, m in enumerate(messages):
+        if i in protected or not isinstance(m, SystemMessage) or total <= max_tokens:
+            continue
+        lines = m.content.splitlines()
+        target = max(message_tokens(m) - (total - max_tokens), 0)
+        shrink(i, "\n".join(fit_history(lines, target)))
+
+    #2. tool results
+    for i, m in enumerate(messages):
+        if i in protected or not isinstance(m, ToolMessage) or total <= max_tokens:
+            continue
+        target = max(message_tokens(m) - (total - max_tokens), 16)
+        shrink(i, extract_relevant(m.content, question, target))
+
+    #3. hard cap, equal share for everything that is not protected
+    if total > max_tokens:
+        others = [i for i in range(len(messages)) if i not in protected]
+        fixed = sum(message_tokens(messages[i]) for i in protected)
+        share = max((max_tokens - fixed) // max(len(others), 1) - MESSAGE_OVERHEAD_TOKENS, 0)
+        for i in others:
+            if message_tokens(messages[i]) > share + MESSAGE_OVERHEAD_TOKENS:
+                shrink(i, truncate(messages[i].content, share))
+
+    logger.info(f"Prompt trimmed from ~{start_total} to ~{total} tokens (budget {max_tokens})")
+    if total > max_tokens:
+        logger.warning("System prompt and user question alone exceed the prompt token budget")
+
+    return messages
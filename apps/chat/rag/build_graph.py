@@ -1,28 +1,53 @@
+import os
+
+from langgraph.checkpoint.base import BaseCheckpointSaver
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.state import CompiledStateGraph
 
 from .state import RAGState
-from .graph import call_llm, execute_tools, check_continue
+from .graph import call_llm, execute_tools, check_continue, prune_history, retrieve_context
 from config.logger import get_logger
 
 logger = get_logger(__name__)
 
+#agent: the llm decides whether and what to search (llm -> execute_tools -> llm loop)
+#retrieve_first: the user input is searched first and the llm answers from it, it only loops when it asks for more tools
+GRAPH_MODES = ("agent", "retrieve_first")
+GRAPH_MODE = os.getenv("RAG_GRAPH_MODE", "agent").lower()
+
 
-def init_graph() -> CompiledStateGraph:
+def init_graph(mode: str = GRAPH_MODE, checkpointer: BaseCheckpointSaver | None = None) -> CompiledStateGraph:
     """
         Build and compiles the RAG agent's graph
+        Args:
+            mode: one of GRAPH_MODES
+            checkpointer: stores the state per thread_id (chat session) between runs, the graph then starts by
+                pruning the stored turns and every run only has to pass the new user message
         returns:
             graph: Compiled State Graph
     """
-    
-    logger.info("Building graph...")
+    if mode not in GRAPH_MODES:
+        raise ValueError(f"Unknown graph mode '{mode}', expected one of {GRAPH_MODES}")
+
+    logger.info(f"Building graph ({mode})...")
 
     graph = StateGraph(RAGState)
 
     graph.add_node("llm", call_llm)
     graph.add_node("execute_tools", execute_tools)
 
-    graph.add_edge(START, "llm")
+    first = "llm"
+    if mode == "retrieve_first":
+        graph.add_node("retrieve_context", retrieve_context)
+        graph.add_edge("retrieve_context", "llm")
+        first = "retrieve_context"
+
+    if checkpointer is not None:
+        graph.add_node("prune_history", prune_history)
+        graph.add_edge(START, "prune_history")
+        graph.add_edge("prune_history", first)
+    else:
+        graph.add_edge(START, first)
     graph.add_conditional_edges(
         "llm",
         check_continue,
@@ -36,4 +61,4 @@ def init_graph() -> CompiledStateGraph:
 
     logger.info("Graph built succesfully")
 
-    return graph.compile()
\ No newline at end of file
+    return graph.compile(checkpointer=checkpointer)
\ No newline at end of file
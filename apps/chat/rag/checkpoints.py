@@ -0,0 +1,159 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Iterable, Sequence
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import ChannelVersions, Checkpoint, CheckpointMetadata, CheckpointTuple
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent
+
+CHECKPOINTS_ENABLED = os.getenv("RAG_CHECKPOINTS", "1") != "0"
+CHECKPOINT_DB = Path(os.getenv("RAG_CHECKPOINT_DB", BASE_DIR / "checkpoints.sqlite"))
+CHECKPOINT_TURNS = int(os.getenv("RAG_CHECKPOINT_TURNS", "5")) #most recent turns (question, tool calls and results, answer) kept per session
+BUSY_TIMEOUT_MS = 5000 #how long a writer waits for another process' lock before failing
+SESSION_LOCK_TIMEOUT = float(os.getenv("RAG_SESSION_LOCK_TIMEOUT", "60")) #seconds a turn waits for the running turn of its session
+
+
+class SessionBusy(Exception):
+    """
+        raised when a turn of a chat session is still running after SESSION_LOCK_TIMEOUT seconds, views answer it with a 409
+    """
+
+
+class SessionCheckpointer(SqliteSaver):
+    """
+        SQLite checkpointer of the chat graph, one LangGraph thread per chat session (thread_id = session id).
+        Each turn only appends the new question to the stored state, earlier answers and tool results are read back
+        from it. State stays bounded: the prune_history node keeps the last CHECKPOINT_TURNS turns and prune() keeps only
+        the latest checkpoint of a thread, so the file grows with the number of sessions, not with their length.
+        SqliteSaver is sync only, the async methods used by astream_events run its sync methods in a worker thread.
+    """
+
+    def __init__(self, path: Path = CHECKPOINT_DB):
+        conn = sqlite3.connect(str(path), check_same_thread=False) #calls are serialised by SqliteSaver's lock
+        conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+        super().__init__(conn)
+        self.path = path
+
+    async def aget_tuple(self, config: RunnableConfig) -> CheckpointTuple | None:
+        return await asyncio.to_thread(self.get_tuple, config)
+
+    async def alist(self, config: RunnableConfig | None, *, filter: dict[str, Any] | None = None,
+                    before: RunnableConfig | None = None, limit: int | None = None) -> AsyncIterator[CheckpointTuple]:
+        items = await asyncio.to_thread(lambda: list(self.list(config, filter=filter, before=before, limit=limit)))
+        for item in items:
+            yield item
+
+    async def aput(self, config: RunnableConfig, checkpoint: Checkpoint, metadata: CheckpointMetadata,
+                   new_versions: ChannelVersions) -> RunnableConfig:
+        return await asyncio.to_thread(self.put, config, checkpoint, metadata, new_versions)
+
+    async def aput_writes(self, config: RunnableConfig, writes: Sequence[tuple[str, Any]], task_id: str, task_path: str = "") -> None:
+        await asyncio.to_thread(self.put_writes, config, writes, task_id, task_path)
+
+    async def adelete_thread(self, thread_id: str) -> None:
+        await asyncio.to_thread(self.delete_thread, thread_id)
+
+    def prune(self, thread_id: str):
+        """
+            deletes every checkpoint of the thread but the latest one, with their pending writes
+        """
+        with self.cursor() as cur:
+            cur.execute(
+                "SELECT MAX(checkpoint_id) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''",
+                (thread_id,),
+            )
+            latest = cur.fetchone()[0]
+            if latest is None:
+                return
+
+            cur.execute("DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id < ?", (thread_id, latest)) #ids are time ordered
+            cur.execute("DELETE FROM writes WHERE thread_id = ? AND checkpoint_id < ?", (thread_id, latest))
+
+    def prune_threads(self, active_thread_ids: Iterable[str]) -> int:
+        """
+            deletes the threads of sessions that no longer exist, returns how many were deleted
+        """
+        active = set(active_thread_ids)
+
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT DISTINCT thread_id FROM checkpoints")
+            stale = [thread_id for (thread_id,) in cur.fetchall() if thread_id not in active]
+
+        for thread_id in stale:
+            self.delete_thread(thread_id)
+
+        if stale:
+            logger.info(f"Deleted the checkpoints of {len(stale)} expired sessions")
+
+        return len(stale)
+
+
+class SessionLocks:
+    """
+        One lock per chat session, held by a turn from reading the session's checkpoint to pruning it. Without it two
+        turns of one session (e.g. two tabs) both extend the same checkpoint, the later write silently drops the
+        other turn and prune() then deletes it. Locks are per process and removed once no turn holds or waits for them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks: dict[str, list] = {} #session id -> [lock, turns holding or waiting for it]
+
+    def _acquire_entry(self, session_id: str) -> threading.Lock:
+        with self.lock:
+            entry = self.locks.setdefault(session_id, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry[0]
+
+    def _release_entry(self, session_id: str):
+        with self.lock:
+            entry = self.locks[session_id]
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[session_id]
+
+    @contextmanager
+    def hold(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT):
+        lock = self._acquire_entry(session_id)
+        try:
+            if not lock.acquire(timeout=timeout):
+                raise SessionBusy(f"Session {session_id} is still answering another message")
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._release_entry(session_id)
+
+    @asynccontextmanager
+    async def ahold(self, session_id: str, timeout: float = SESSION_LOCK_TIMEOUT):
+        """
+            async variant of hold, polls so the event loop is never blocked and a cancelled wait leaves nothing behind
+        """
+        lock = self._acquire_entry(session_id)
+        try:
+            deadline = time.monotonic() + timeout
+            while not lock.acquire(blocking=False):
+                if time.monotonic() >= deadline:
+                    raise SessionBusy(f"Session {session_id} is still answering another message")
+                await asyncio.sleep(0.05)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._release_entry(session_id)
+
+
+session_locks = SessionLocks()
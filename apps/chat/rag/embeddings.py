@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from config.logger import get_logger
+from config.tracing import span
+
+logger = get_logger(__name__)
+
+BASE_DIR = Path(__file__).resolve().parent.parent.parent.parent
+
+EMBEDDING_MODEL = "sentence-transformers/all-mpnet-base-v2"
+EMBEDDING_NORMALIZE = os.getenv("RAG_NORMALIZE_EMBEDDINGS", "1") != "0" #unit length vectors, cosine and inner product rank the same
+
+#persistent text hash -> vector cache, one sub folder per embedding model
+EMBEDDING_CACHE_DIR = BASE_DIR / "chromadb" / "embedding_cache"
+EMBEDDING_CACHE_ENABLED = os.getenv("RAG_EMBEDDING_CACHE", "1") != "0"
+QUERY_CACHE_SIZE = int(os.getenv("RAG_QUERY_EMBEDDING_CACHE_SIZE", "1024")) #query vectors kept in memory, queries are not written to disk
+
+_embeddings: Embeddings | None = None
+_embeddings_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    """
+        Append-only on-disk cache of embedding vectors keyed by the sha1 of the embedded text.
+        - vectors.f32: float32 rows, read through a numpy memmap
+        - index.tsv: "<sha1>\t<row>" lines pointing into vectors.f32
+        - meta.json: model name and vector dimension
+        Appends happen under a file lock and rows are numbered from the size of vectors.f32, so several
+        processes (web workers, build_index) can share the same cache. A vector is written before its index line,
+        so readers map only the rows the index points to and never see a row another process is still appending.
+    """
+
+    def __init__(self, cache_dir: Path, model_name: str):
+        self.dir = cache_dir
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        self.vectors_path = self.dir / "vectors.f32"
+        self.index_path = self.dir / "index.tsv"
+        self.meta_path = self.dir / "meta.json"
+        self.model_name = model_name
+
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(str(self.dir / ".lock"))
+
+        self.rows: dict[str, int] = {}
+        self.dim: int | None = None
+        self.row_count = 0 #rows of vectors.f32 the index points to
+        self._index_offset = 0
+        self._vectors = None
+
+        self._read_index()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    def _read_index(self):
+        """
+            reads index lines appended since the last read (by this or another process)
+        """
+        if not self.index_path.exists():
+            return
+
+        if self.dim is None:
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"] #written before the first index line, by whichever process embedded first
+
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_offset)
+            data = f.read()
+
+        complete = data[:data.rfind(b"\n") + 1] #ignore a line another process is still writing
+        for line in complete.decode("utf-8").splitlines():
+            key, row = line.split("\t")
+            self.rows[key] = int(row)
+            self.row_count = max(self.row_count, int(row) + 1)
+
+        self._index_offset += len(complete)
+
+    def _row(self, row: int) -> np.ndarray:
+        if self._vectors is None or row >= self._vectors.shape[0]: #remap after the index grew
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(self.row_count, self.dim))
+
+        return np.array(self._vectors[row])
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        """
+            returns the cached vectors for the keys that are present
+        """
+        with self.lock:
+            if any(key not in self.rows for key in keys):
+                self._read_index() #another process may have embedded them in the meantime
+
+            return {key: self._row(self.rows[key]).tolist() for key in keys if key in self.rows}
+
+    def put_many(self, keys: list[str], vectors: list[list[float]]):
+        """
+            appends vectors to the cache
+        """
+        if not keys:
+            return
+
+        array = np.asarray(vectors, dtype=np.float32)
+
+        with self.lock, self.file_lock:
+            if self.dim is None:
+                self.dim = int(array.shape[1])
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model_name, "dim": self.dim}, f)
+
+            self._read_index()
+
+            first_row = self.vectors_path.stat().st_size // (self.dim * 4) if self.vectors_path.exists() else 0
+
+            with open(self.vectors_path, "ab") as f:
+                f.write(array.tobytes())
+
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write("".join(f"{key}\t{first_row + i}\n" for i, key in enumerate(keys)))
+
+            self._read_index()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+        Wraps an embeddings model so that texts already embedded once (by any process) are read from the
+        EmbeddingCache instead of running the transformer again. Query vectors are only kept in an in-memory LRU
+        of query_cache_size entries, user input is unbounded and would grow the on-disk cache forever.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, query_cache_size: int = QUERY_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.query_cache_size = query_cache_size
+
+        self.lock = threading.Lock()
+        self.queries: OrderedDict[str, list[float]] = OrderedDict() #query text -> vector, least recently used first
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [EmbeddingCache.key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+
+        missing = {} #key -> text, deduplicates identical texts within the batch
+        for key, text in zip(keys, texts):
+            if key not in cached:
+                missing[key] = text
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing), vectors)
+            cached.update(zip(missing, vectors))
+
+        logger.debug(f"Embedded {len(texts)} texts, {len(texts) - len(missing)} from cache")
+
+        return [list(cached[key]) for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        with span("embedding.query"):
+            with self.lock:
+                vector = self.queries.get(text)
+                if vector is not None:
+                    self.queries.move_to_end(text)
+                    return list(vector)
+
+            vector = self.embeddings.embed_query(text)
+
+            with self.lock:
+                self.queries[text] = vector
+                self.queries.move_to_end(text)
+                while len(self.queries) > self.query_cache_size:
+                    self.queries.popitem(last=False)
+
+            return list(vector)
+
+
+def get_embeddings() -> Embeddings:
+    """
+        returns the process wide embeddings model, loaded once and shared by both collections and query-time retrieval
+    """
+    global _embeddings
+
+    with _embeddings_lock:
+        if _embeddings is None:
+            logger.info(f"Loading embedding model {EMBEDDING_MODEL}...")
+            embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL, encode_kwargs={"normalize_embeddings" : EMBEDDING_NORMALIZE})
+
+            if EMBEDDING_CACHE_ENABLED:
+                cache_dir = EMBEDDING_CACHE_DIR / (EMBEDDING_MODEL.replace("/", "__") + ("__normalized" if EMBEDDING_NORMALIZE else ""))
+                embeddings = CachedEmbeddings(embeddings, EmbeddingCache(cache_dir, EMBEDDING_MODEL))
+
+            _embeddings = embeddings
+
+    return _embeddings
@@ -0,0 +1,224 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+from config.logger import get_logger
+from config.tracing import percentile, span
+
+logger = get_logger(__name__)
+
+LLM_CONCURRENCY = int(os.getenv("RAG_LLM_CONCURRENCY", "4")) #LLM calls in flight at once, per process
+LLM_TOKENS_PER_MINUTE = int(os.getenv("RAG_LLM_TPM", "0")) #prompt + completion tokens per rolling minute, 0 disables the budget
+LLM_QUEUE_SIZE = int(os.getenv("RAG_LLM_QUEUE_SIZE", "16")) #calls allowed to wait for a slot, more are rejected at once
+LLM_QUEUE_TIMEOUT = float(os.getenv("RAG_LLM_QUEUE_TIMEOUT", "10")) #seconds a call may wait for a slot and token budget
+LLM_MAX_RETRIES = int(os.getenv("RAG_LLM_MAX_RETRIES", "3")) #retries of a rate limited call
+LLM_BACKOFF_BASE = float(os.getenv("RAG_LLM_BACKOFF_BASE", "0.5")) #seconds, doubled per retry with +-50% jitter
+LLM_BACKOFF_MAX = float(os.getenv("RAG_LLM_BACKOFF_MAX", "8"))
+LLM_OUTPUT_RESERVE = 500 #completion tokens reserved from the budget before the real usage is known
+WAIT_WINDOW = 1000 #most recent queue waits kept for the percentiles
+
+
+class LLMOverloaded(Exception):
+    """
+        raised when an LLM call cannot be admitted: the queue is full or the wait for a slot/token budget timed out.
+        Views turn it into a 503 with a Retry-After header
+    """
+
+    def __init__(self, message: str, retry_after: float = 1.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def is_rate_limit(error: Exception) -> bool:
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status == 429 or "rate limit" in str(error).lower() or type(error).__name__ == "RateLimitError"
+
+
+def retry_after(error: Exception) -> float | None:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class LLMGateway:
+    """
+        Shared admission control in front of the LLM provider:
+        - at most max_concurrency calls in flight, others wait in a queue of at most max_queue calls
+        - an optional tokens per minute budget over a rolling 60s window
+        - a bounded wait (queue_timeout) for both, after which the call fails fast with LLMOverloaded
+        - retries with jittered exponential backoff when the provider rate limits (HTTP 429)
+    """
+
+    def __init__(self, max_concurrency: int = LLM_CONCURRENCY, tokens_per_minute: int = LLM_TOKENS_PER_MINUTE,
+                 max_queue: int = LLM_QUEUE_SIZE, queue_timeout: float = LLM_QUEUE_TIMEOUT, max_retries: int = LLM_MAX_RETRIES,
+                 backoff_base: float = LLM_BACKOFF_BASE, backoff_max: float = LLM_BACKOFF_MAX):
+        self.max_concurrency = max_concurrency
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.token_log: deque[list] = deque() #[timestamp, tokens] of the calls of the last minute
+
+        self.waits: deque[float] = deque(maxlen=WAIT_WINDOW)
+        self.calls = 0
+        self.rejected = 0 #queue full
+        self.timed_out = 0 #waited longer than queue_timeout
+        self.retries = 0
+        self.max_waiting = 0
+
+    def _tokens_used(self, now: float) -> int:
+        while self.token_log and now - self.token_log[0][0] >= 60:
+            self.token_log.popleft()
+        return sum(tokens for _, tokens in self.token_log)
+
+    def _budget_wait(self, tokens: int, now: float) -> float:
+        """
+            seconds until tokens fit in the budget, 0 if they fit now
+        """
+        if not self.tokens_per_minute:
+            return 0.0
+
+        used = self._tokens_used(now)
+        if used + tokens <= self.tokens_per_minute or not self.token_log:
+            return 0.0 #a single call larger than the whole budget is let through alone
+
+        freed = 0
+        for timestamp, logged in self.token_log: #wait until enough of the oldest calls leave the window
+            freed += logged
+            if used - freed + tokens <= self.tokens_per_minute:
+                return max(timestamp + 60 - now, 0.01)
+
+        return max(self.token_log[-1][0] + 60 - now, 0.01)
+
+    def saturated(self) -> bool:
+        """
+            True when a new call would be rejected right away, lets views answer 503 before doing any work
+        """
+        with self.condition:
+            return self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue
+
+    def _acquire(self, tokens: int) -> list:
+        start = time.perf_counter()
+        deadline = start + self.queue_timeout
+
+        with self.condition:
+            if self.in_flight >= self.max_concurrency and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise LLMOverloaded(f"LLM queue is full ({self.waiting} waiting)")
+
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            try:
+                while True:
+                    now = time.perf_counter()
+                    budget_wait = self._budget_wait(tokens, time.monotonic())
+                    if self.in_flight < self.max_concurrency and budget_wait == 0:
+                        break
+
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        raise LLMOverloaded(
+                            f"Waited {self.queue_timeout:g}s for an LLM slot or token budget",
+                            retry_after=max(budget_wait, 1.0),
+                        )
+                    self.condition.wait(timeout=min(remaining, budget_wait) if budget_wait else remaining)
+            finally:
+                self.waiting -= 1
+
+            self.in_flight += 1
+            entry = [time.monotonic(), tokens]
+            self.token_log.append(entry)
+            self.waits.append((time.perf_counter() - start) * 1000)
+            self.calls += 1
+
+        return entry
+
+    def _release(self, entry: list, used_tokens: int | None):
+        with self.condition:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                entry[1] = used_tokens #replace the estimate with the provider's count
+            self.condition.notify_all()
+
+    def backoff(self, error: Exception, attempt: int) -> float:
+        """
+            seconds to wait before retrying a rate limited call: at least the provider's Retry-After when it sends one,
+            else an exponential backoff, both with jitter so throttled workers do not retry in lockstep
+        """
+        server_delay = retry_after(error)
+        if server_delay is not None:
+            return server_delay * random.uniform(1.0, 1.5) #never earlier than asked
+
+        return min(self.backoff_base * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1.5)
+
+    def invoke(self, llm: Runnable, messages: list, config: RunnableConfig | None = None, prompt_tokens: int = 0):
+        """
+            calls llm.invoke(messages) once admitted, retrying rate limited calls
+            The slot is given back while a retry sleeps and taken again afterwards, so a throttled call does not keep
+            other calls waiting.
+            Raises LLMOverloaded if the call (or a retry) is not admitted within queue_timeout
+        """
+        tokens = prompt_tokens + LLM_OUTPUT_RESERVE
+
+        with span("llm.queue") as queue_span:
+            entry = self._acquire(tokens)
+            queue_span.set(waiting=self.waiting, in_flight=self.in_flight)
+
+        used_tokens = None
+        try:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    result = llm.invoke(messages, config=config)
+                    usage = getattr(result, "usage_metadata", None) or {}
+                    used_tokens = usage.get("total_tokens")
+                    return result
+                except Exception as e:
+                    if not is_rate_limit(e) or attempt == self.max_retries:
+                        raise
+
+                    delay = self.backoff(e, attempt)
+                    with self.condition:
+                        self.retries += 1
+                    logger.warning(f"LLM rate limited, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+
+                    self._release(entry, 0) #a rejected call used no tokens
+                    entry = None
+                    time.sleep(delay)
+                    with span("llm.queue", retry=attempt + 1):
+                        entry = self._acquire(tokens)
+        finally:
+            if entry is not None:
+                self._release(entry, used_tokens)
+
+    def stats(self) -> dict:
+        with self.condition:
+            waits = sorted(self.waits)
+            return {
+                "max_concurrency" : self.max_concurrency,
+                "tokens_per_minute" : self.tokens_per_minute,
+                "in_flight" : self.in_flight,
+                "queue_depth" : self.waiting,
+                "max_queue_depth" : self.max_waiting,
+                "queue_size" : self.max_queue,
+                "tokens_last_minute" : self._tokens_used(time.monotonic()),
+                "calls" : self.calls,
+                "rejected" : self.rejected,
+                "timed_out" : self.timed_out,
+                "retries" : self.retries,
+                "wait_p50_ms" : percentile(waits, 50),
+                "wait_p95_ms" : percentile(waits, 95),
+                "wait_p99_ms" : percentile(waits, 99),
+            }
@@ -1,104 +1,253 @@
-from typing import TYPE_CHECKING, Optional
-from langchain_core.messages import SystemMessage, ToolMessage
-from langchain_groq import ChatGroq
+import contextvars
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from langchain_core.messages import AIMessage, HumanMessage, RemoveMessage, SystemMessage, ToolMessage
+from langchain_core.runnables import RunnableConfig
 
 from .state import RAGState #imports RAGState class from state.py
-from .tools import current_state
+from .runtime import AgentRuntime, get_runtime
+from .budget import fit_messages, message_tokens
+from .checkpoints import CHECKPOINT_TURNS
 from config.logger import get_logger #imports get_logger function from logger.py
+from config.tracing import add_counts, span
 
 logger = get_logger(__name__)
 
-if TYPE_CHECKING:
-    from langchain_groq import ChatGroq
-    from langchain_core.tools import BaseTool
+MAX_TOOL_CONCURRENCY = int(os.getenv("RAG_TOOL_CONCURRENCY", "4")) #tool calls of one LLM turn running at the same time
+TOOL_WORKERS = int(os.getenv("RAG_TOOL_WORKERS", str(MAX_TOOL_CONCURRENCY * 4))) #tool calls running at once, per process
+TOOL_TIMEOUT = float(os.getenv("RAG_TOOL_TIMEOUT", "30")) #seconds a single tool call may take
+TOOL_LIMIT_REPLY = "I could not complete the search for this question within my tool limit. Please try asking it in a more specific way."
 
-#Global placeholders
-llm_model: Optional[ChatGroq] = None
-sys_prompt : str = ""
-tools_dict: dict[str, "BaseTool"] = {}
-MAX_TOOL_CALLS = 3
+_pool = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool") #a call that times out keeps its worker until it returns, so abandoned calls never grow past TOOL_WORKERS threads
 
-def call_llm(state: RAGState) -> RAGState:
-    global current_state
-    current_state = state
+def tool_budget_left(state: RAGState, runtime: AgentRuntime) -> bool:
+    """
+        True while the run has made fewer than runtime.max_tool_calls tool calls, the one rule call_llm,
+        execute_tools and check_continue share
+    """
+    return state.get("tool_call_count", 0) < runtime.max_tool_calls
+
+def call_llm(state: RAGState, config: RunnableConfig) -> dict:
     """
         Calls the llm and submits/passes the system prompt, user message, and tool response (when tool call is called by LLM).
         appends llm response to state
     """
 
-    global llm_model, sys_prompt
-
-    if llm_model is None:
-        raise RuntimeError("LLM model has not been initialized. Did you call init_rag()?")
+    runtime = get_runtime(config) #LLM, prompt and tools of this run, injected through the LangGraph config
 
     messages = list(state["messages"])
+    budget_left = tool_budget_left(state, runtime)
+    llm_model = runtime.llm_model if budget_left or runtime.answer_model is None else runtime.answer_model #no tool calls once the budget is spent
 
-    if state.get("tool_call_count", 0) > MAX_TOOL_CALLS: #This checks if the llm has been looping and enforces that the llm has used the tool usage count
+    if not budget_left: #This checks if the llm has been looping and enforces that the llm has used the tool usage count
         system_prompt = (
-            sys_prompt +
+            runtime.sys_prompt +
             "\n\nYou have reached the maximum number of tool calls."
             "Do not attempt to call any tools or functions."
             "Only respond in plain text with your best possible answer using the data already provided"
         ) #updates the system prompt telling the llm it cannot call anymore tools and provide its final answer based on gathered data so far
     else:
-        system_prompt = sys_prompt
-    
-    messages = [SystemMessage(content=system_prompt)] + messages
-    
-    result_message = llm_model.invoke(messages)
+        system_prompt = runtime.sys_prompt
+
+    messages = fit_messages([SystemMessage(content=system_prompt)] + messages, runtime.token_budget) #every call stays under the prompt token budget
+
+    prompt_tokens = sum(message_tokens(m) for m in messages)
+
+    with span("call_llm", prompt_tokens_estimate=prompt_tokens) as llm_span:
+        if runtime.gateway is not None: #waits for a slot and token budget, raises LLMOverloaded when saturated
+            result_message = runtime.gateway.invoke(llm_model, messages, config=config, prompt_tokens=prompt_tokens)
+        else:
+            result_message = llm_model.invoke(messages, config=config)
+
+        usage = getattr(result_message, "usage_metadata", None) or {}
+        llm_span.set(tool_calls_requested=len(getattr(result_message, "tool_calls", None) or []))
+        add_counts(
+            llm_calls=1,
+            input_tokens=usage.get("input_tokens", 0),
+            output_tokens=usage.get("output_tokens", 0),
+        )
+
+    if not budget_left and getattr(result_message, "tool_calls", None):
+        #the run ends after this call, tool calls nobody answers would be stored in the session's checkpoint and every
+        #later call would be rejected for them, so they are dropped and the reply is marked as not worth caching
+        logger.warning(f"LLM asked for {len(result_message.tool_calls)} tools after the tool budget was spent, dropping the calls")
+        add_counts(tool_calls_skipped=len(result_message.tool_calls))
+        result_message = AIMessage(
+            content=result_message.content or TOOL_LIMIT_REPLY,
+            id=result_message.id,
+            usage_metadata=getattr(result_message, "usage_metadata", None),
+            response_metadata={**result_message.response_metadata, "finish_reason" : "tool_limit"},
+        )
 
     logger.info("LLM has responded")
     logger.debug(f"LLM raw content: {getattr(result_message, 'content', '')[:100]}")
 
-    state["messages"].append(result_message) #updates state with latest llm response including tool call
+    return {"messages" : [result_message]} #add_messages appends the llm response (including tool calls) to the state
+
+def prune_history(state: RAGState, config: RunnableConfig) -> dict:
+    """
+        First node of the checkpointed graph: the session's stored state already holds the earlier turns, this drops
+        every turn but the last CHECKPOINT_TURNS. A turn starts at a HumanMessage, so tool calls keep their results.
+    """
+    messages = state["messages"]
+    turn_starts = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+
+    if len(turn_starts) <= CHECKPOINT_TURNS:
+        return {}
+
+    cutoff = turn_starts[-CHECKPOINT_TURNS]
+    logger.info(f"Pruning {cutoff} messages of {len(turn_starts) - CHECKPOINT_TURNS} old turns from the session state")
+
+    return {"messages" : [RemoveMessage(id=m.id) for m in messages[:cutoff]]} #add_messages deletes messages by id
+
+def retrieve_context(state: RAGState, config: RunnableConfig) -> dict:
+    """
+        First node of the retrieve_first graph: searches the documents for the user's latest message before the LLM
+        is called. The results are added as a retriever_tool call and its ToolMessage, so the LLM answers from them in
+        one call and can still ask for more tools (the agent loop) when they are not enough.
+    """
+    runtime = get_runtime(config)
+    question = next((m.content for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), "")
+    tool_call = {"name" : "retriever_tool", "args" : {"query" : question}, "id" : f"prefetch_{uuid.uuid4().hex[:8]}", "type" : "tool_call"}
+
+    with span("retrieve_context"):
+        tool_result, elapsed, status = _run_tool(runtime, "retriever_tool", tool_call["args"], config)
 
-    return state
+    logger.info(f"Retrieved context for the question in {elapsed * 1000:.0f} ms")
+    add_counts(tool_calls=1)
 
-def execute_tools(state: RAGState) -> RAGState:
+    return {
+        "messages" : [
+            AIMessage(content="", tool_calls=[tool_call]),
+            ToolMessage(tool_call_id=tool_call["id"], name="retriever_tool", content=str(tool_result), status=status, response_metadata={"elapsed_ms" : round(elapsed * 1000, 1)}),
+        ],
+        "tool_call_count" : state.get("tool_call_count", 0) + 1, #the search counts against the run's tool budget
+    }
+
+def _run_tool(runtime: AgentRuntime, tool_name: str, args: dict, config: RunnableConfig) -> tuple[str, float, str]:
     """
-        Executes any tool call from the last LLM message
+        runs a single tool call, returns (result, elapsed seconds, ToolMessage status "success" or "error")
     """
-    global tools_dict
+    start = time.perf_counter()
+
+    with span(f"tool.{tool_name}") as tool_span:
+        if tool_name not in runtime.tools_dict:
+            logger.warning(f"Tool '{tool_name}' not found in tools_dict")
+            tool_span.set(error="unknown_tool")
+            return "Incorrect Tool name, Please retry and select the correct Tool.", 0.0, "error"
+
+        try:
+            tool_result = runtime.tools_dict[tool_name].invoke(args, config=config)
+            logger.info(f"Executed Tool '{tool_name}' sucessfully")
+            return tool_result, time.perf_counter() - start, "success"
+        except Exception as e:
+            logger.exception(f"Error while executing tool {tool_name} with error: {e}")
+            tool_span.set(error=type(e).__name__)
+            return f"Tool {tool_name} failed with error {e}", time.perf_counter() - start, "error"
+
+
+def execute_tools(state: RAGState, config: RunnableConfig) -> dict:
+    """
+        Executes any tool call from the last LLM message.
+        Calls from the same LLM turn run concurrently on the process wide tool pool, in waves of MAX_TOOL_CONCURRENCY
+        calls that each get TOOL_TIMEOUT seconds (time queued behind other requests' calls included), and their
+        ToolMessages are appended in the order the LLM issued them.
+        Calls beyond the run's remaining tool budget (runtime.max_tool_calls) are not executed.
+        A call that times out is cancelled if it has not started yet, otherwise it is abandoned: its worker stays busy
+        until the tool returns. Both are counted (tool_timeouts, tool_calls_abandoned) in the request's trace.
+    """
+    with span("execute_tools") as tools_span:
+        update = _execute_tools(state, config)
+        tools_span.set(tool_calls=len(getattr(state["messages"][-1], "tool_calls", None) or []))
+
+    return update
+
+
+def _execute_tools(state: RAGState, config: RunnableConfig) -> dict:
+    runtime = get_runtime(config)
     last_message = state["messages"][-1] #gets latest message
     tool_calls = getattr(last_message, "tool_calls", []) #gets the tool call from the latest state message
+    tool_call_count = state.get("tool_call_count", 0)
     results = []
 
-    for t in tool_calls: #tool_calls is list of dictionary it contains [id:value, name:value, args:dict]
-        query = t.get("args", {}).get("query", "") #args is a dictionary containing name : value in this instance it 'query' : 'some text'
+    if not tool_calls:
+        return {}
+
+    budget = max(runtime.max_tool_calls - tool_call_count, 0) #tool calls this run may still make
+    to_run = tool_calls[:budget] #tool_calls is list of dictionary it contains [id:value, name:value, args:dict]
+    outcomes = [] #(result, elapsed seconds, status) of every executed call, in tool_calls order
+    timed_out = abandoned = 0
+    batch_start = time.perf_counter()
+
+    for wave_start in range(0, len(to_run), MAX_TOOL_CONCURRENCY):
+        wave = to_run[wave_start:wave_start + MAX_TOOL_CONCURRENCY]
+        futures = []
+
+        for t in wave:
+            args = t.get("args", {}) #args is a dictionary containing name : value in this instance it 'query' : 'some text'
+            tool_name = t.get("name")
+            logger.info(f"Tool call detected: {tool_name} with args: {args}")
+
+            context = contextvars.copy_context() #keeps callbacks (e.g. the streaming endpoint's event handler) attached inside the worker thread
+            futures.append(_pool.submit(context.run, _run_tool, runtime, tool_name, args, config))
+
+        deadline = time.perf_counter() + TOOL_TIMEOUT
+
+        for t, future in zip(wave, futures):
+            tool_name = t.get("name")
+
+            try:
+                outcomes.append(future.result(timeout=max(deadline - time.perf_counter(), 0)))
+            except FuturesTimeoutError:
+                timed_out += 1
+                if not future.cancel(): #already running, a thread cannot be stopped
+                    abandoned += 1
+                logger.warning(f"Tool '{tool_name}' timed out after {TOOL_TIMEOUT}s")
+                outcomes.append((f"Tool {tool_name} timed out, answer with the data available so far.", TOOL_TIMEOUT, "error"))
+
+    for i, t in enumerate(tool_calls):
         tool_name = t.get("name")
-        logger.info(f"Tool call detected: {tool_name} with query: {query}")
 
-        if tool_name not in tools_dict:
-            logger.warning(f"Tool '{tool_name}' not found in tools_dict")
-            tool_result = "Incorrect Tool name, Please retry and select the correct Tool."
+        if i >= budget:
+            logger.warning("Maximum tool calls reached - skipping tool execution")
+            tool_result, elapsed, status = "Maximum tool calls reached. Answer based on the context available so far.", 0.0, "success"
         else:
-            try:
-                tool_result = tools_dict[tool_name].invoke(query)
-                state["tool_call_count"] += 1
-                logger.info(f"Executed Tool '{tool_name}' sucessfully")
-            except Exception as e:
-                tool_result = f"Tool {tool_name} failed with error {e}"
-                logger.exception(f"Error while executing tool {tool_name} with error: {e}")
+            tool_result, elapsed, status = outcomes[i]
+            logger.info(f"Tool '{tool_name}' took {elapsed * 1000:.0f} ms")
 
         results.append(
             ToolMessage(
                 tool_call_id=t.get('id'),
                 name=tool_name,
                 content=str(tool_result),
+                status=status, #"error" results keep the answer out of the answer cache
+                response_metadata={"elapsed_ms" : round(elapsed * 1000, 1)},
             )
         ) #appends ToolMessage to results variable
 
-    state["messages"].extend(results) #extend is used to pass all parameters of the message in this instance result to the state["messages"] and not just the content which append does
+    logger.info(f"Executed {len(to_run)} tool calls in {(time.perf_counter() - batch_start) * 1000:.0f} ms")
+    add_counts(
+        tool_calls=len(to_run),
+        tool_calls_skipped=len(tool_calls) - len(to_run),
+        tool_timeouts=timed_out,
+        tool_calls_abandoned=abandoned,
+    )
 
-    return state
+    return {
+        "messages" : results, #add_messages appends every ToolMessage to the state
+        "tool_call_count" : tool_call_count + len(to_run), #skipped calls mean the budget is spent, the next llm call answers without tools
+    }
 
-def check_continue(state: RAGState) -> bool:
+def check_continue(state: RAGState, config: RunnableConfig) -> bool:
     """
         Checks if the last message is a Tool call and returns True, otherwise False
     """
+    runtime = get_runtime(config)
     last_message = state["messages"][-1]
     tool_calls = getattr(last_message, "tool_calls", []) #basically get attribute value from last_message named tool_callse otherwise empty []
-    should_continue = len(tool_calls) > 0 and state.get("tool_call_count", 0) <= MAX_TOOL_CALLS
+    should_continue = len(tool_calls) > 0 and tool_budget_left(state, runtime)
     logger.info(f"check continue -> {should_continue}. tool_call_count: {state.get('tool_call_count', 0)}")
 
-    return should_continue
\ No newline at end of file
+    return should_continue
@@ -0,0 +1,121 @@
+import threading
+
+from langchain_core.embeddings import Embeddings
+
+from apps.chat.rag.router import ROUTE_EXEMPLARS, EmbeddingRouter
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+#labelled example messages per intent, "in_scope" reuses the router's questions about both collections
+INTENT_EXEMPLARS = {
+    "greeting" : [
+        "Hello",
+        "Hi there",
+        "Hey, how are you?",
+        "Good morning",
+        "Who are you?",
+        "What can you do?",
+        "Nice to meet you",
+        "Good evening, how is it going?",
+        "Hey",
+    ],
+    "thanks" : [
+        "Thanks for the help",
+        "Thank you!",
+        "Thanks, that's all",
+        "Great, thanks",
+        "Goodbye",
+        "Bye, have a nice day",
+    ],
+    "off_topic" : [
+        "What is the weather like today?",
+        "Write me a poem about the ocean",
+        "Can you give me a recipe for pancakes?",
+        "Who won the football game last night?",
+        "Help me debug my Python code",
+        "Translate this sentence into French",
+        "What is the capital of Australia?",
+        "Recommend a good movie to watch",
+        "How do I fix my car's engine?",
+        "Tell me a joke",
+    ],
+    "in_scope" : ROUTE_EXEMPLARS["listing"] + ROUTE_EXEMPLARS["market"],
+}
+
+#replies sent without calling the LLM, worded like the system prompt asks the LLM to answer these messages
+INTENT_REPLIES = {
+    "greeting" : (
+        "Hi! I'm FranzAI, your financial assistant. I can answer questions about the stock market and about which "
+        "companies are listed on NASDAQ and the NYSE, based on the documents I have. What would you like to know?"
+    ),
+    "thanks" : "You're welcome! Let me know if you have any other questions about the stock market or exchange listings.",
+    "off_topic" : "I can only answer questions about the stock market, exchange listings based on the documents I have.",
+}
+
+
+class IntentClassifier:
+    """
+        Answers greetings, thanks and clearly off-topic messages from INTENT_REPLIES without a round trip to the LLM.
+        Messages are scored against INTENT_EXEMPLARS the same way EmbeddingRouter scores routes, a template is only
+        used when its intent scores at least threshold and beats every other intent by at least margin, anything
+        less certain goes to the LLM as before.
+    """
+
+    def __init__(self, embeddings: Embeddings, exemplars: dict[str, list[str]] = INTENT_EXEMPLARS, threshold: float = 0.6, margin: float = 0.1):
+        self.scorer = EmbeddingRouter(embeddings, exemplars)
+        self.threshold = threshold
+        self.margin = margin
+
+        self.lock = threading.Lock()
+        self.answered = {intent : 0 for intent in INTENT_REPLIES} #messages answered from a template, i.e. LLM calls avoided
+        self.passed = 0 #messages sent to the agent
+
+    def classify(self, message: str) -> tuple[str, float, dict[str, float]]:
+        """
+            returns:
+                (best intent, margin over the runner-up, score per intent)
+        """
+        scores = self.scorer.scores(message)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+
+        return ranked[0], scores[ranked[0]] - scores[ranked[1]], scores
+
+    def likely_in_scope(self, message: str) -> bool:
+        """
+            True when the message is probably a question about the documents: "in_scope" is its best intent or scores
+            within margin of the best one. Messages the agent likely answers without a search return False.
+        """
+        intent, _, scores = self.classify(message) #the embedding of message is cached by reply()'s classification
+
+        return intent == "in_scope" or scores[intent] - scores["in_scope"] < self.margin
+
+    def reply(self, message: str) -> str | None:
+        """
+            returns the template reply for a confidently classified greeting or off-topic message, None otherwise
+        """
+        intent, margin, scores = self.classify(message)
+        confident = intent in INTENT_REPLIES and scores[intent] >= self.threshold and margin >= self.margin
+
+        with self.lock:
+            if confident:
+                self.answered[intent] += 1
+            else:
+                self.passed += 1
+
+        if not confident:
+            return None
+
+        logger.info(f"Answered locally as {intent} (score {scores[intent]:.3f}, margin {margin:.3f})")
+
+        return INTENT_REPLIES[intent]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "answered" : dict(self.answered),
+                "llm_calls_avoided" : sum(self.answered.values()),
+                "passed_to_agent" : self.passed,
+                "threshold" : self.threshold,
+                "margin" : self.margin,
+            }
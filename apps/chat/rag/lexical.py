@@ -0,0 +1,135 @@
+import json
+import math
+import re
+from collections import Counter
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+BM25_FILE = "bm25.json"
+
+#keeps tickers and names like "brk.b", "s&p", "at&t" or "coca-cola" as single tokens
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.&'\-][a-z0-9]+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    """
+        In-process inverted index with Okapi BM25 scoring over the chunks of one collection.
+        It is built at ingestion time from the chroma collection and stored as bm25.json next to it, postings and
+        document lengths included, so loading it does not tokenize the corpus again and exact tokens (tickers,
+        company names, exchange codes) can be matched without the embedding model.
+    """
+
+    def __init__(self, ids: list[str], texts: list[str], metadatas: list[dict], k1: float = 1.5, b: float = 0.75, version: str = "",
+                 postings: dict[str, list] | None = None, doc_lengths: list[int] | None = None):
+        self.ids = ids
+        self.texts = texts
+        self.metadatas = metadatas
+        self.k1 = k1
+        self.b = b
+        self.version = version #manifest digest the index was built from
+
+        self.postings: dict[str, list] = {} #term -> [(doc index, term frequency)]
+        self.doc_lengths: list[int] = []
+
+        if postings is not None and doc_lengths is not None: #read back by load()
+            self.postings, self.doc_lengths = postings, doc_lengths
+        else:
+            for doc_index, text in enumerate(texts):
+                tokens = tokenize(text)
+                self.doc_lengths.append(len(tokens))
+                for term, tf in Counter(tokens).items():
+                    self.postings.setdefault(term, []).append((doc_index, tf))
+
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """
+            returns the k best matching chunks for query with their BM25 scores
+        """
+        scores: dict[int, float] = {}
+        n = len(self.ids)
+
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+
+            idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_index, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_index] / (self.avg_length or 1.0))
+                scores[doc_index] = scores.get(doc_index, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+        return [
+            (Document(page_content=self.texts[i], metadata=self.metadatas[i], id=self.ids[i]), score)
+            for i, score in best
+        ]
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "version" : self.version,
+                "k1" : self.k1,
+                "b" : self.b,
+                "ids" : self.ids,
+                "texts" : self.texts,
+                "metadatas" : self.metadatas,
+                "postings" : self.postings, #tuples are stored as [doc index, term frequency] lists
+                "doc_lengths" : self.doc_lengths,
+                "avg_length" : self.avg_length,
+            }, f)
+
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "BM25Index":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        index = cls(
+            data["ids"], data["texts"], data["metadatas"], k1=data["k1"], b=data["b"], version=data["version"],
+            postings=data.get("postings"), doc_lengths=data.get("doc_lengths"), #files written before they were stored are rebuilt
+        )
+        index.avg_length = data.get("avg_length", index.avg_length)
+
+        return index
+
+
+def reciprocal_rank_fusion(result_lists: list[list[Document]], k: int, rrf_k: int = 60) -> list[Document]:
+    """
+        Merges ranked document lists by reciprocal rank fusion, documents ranked high in any list come first
+    """
+    scores: dict[tuple, float] = {}
+    docs: dict[tuple, Document] = {}
+
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+
+    return [docs[key] for key in best]
+
+
+def doc_key(doc: Document) -> tuple:
+    """
+        identifies a chunk independently of which index returned it
+    """
+    return (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
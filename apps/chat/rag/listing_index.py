@@ -0,0 +1,287 @@
+import bisect
+import json
+import re
+from pathlib import Path
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+LISTING_INDEX_FILE = "listing_index.json"
+
+#NASDAQ listing: "AAPL Apple Inc. - Common Stock", 5 letter symbols are sometimes glued to the name ("ABPWWAbpro Holdings")
+NASDAQ_HEADER = "Symbol Security Name"
+NASDAQ_ROW_RE = re.compile(r"^(?P<symbol>[A-Z][A-Z0-9.\-]{0,4})\s+(?P<name>\S.*)$")
+NASDAQ_GLUED_RE = re.compile(r"^(?P<symbol>[A-Z][A-Z0-9]{4})(?P<name>[A-Z0-9]\S*(?:\s.*)?)$")
+
+#NYSE listing: a 3 column table (name, symbol, country) whose name cells wrap over several lines, the row ends on the line
+#holding "SYMBOL Country", e.g. "Corporati\non\nAIR US" or glued "3M CompanyMMM United\nStates"
+#multi-word countries are listed in full too, depending on the pypdf version they are extracted on one line ("MMM United States")
+NYSE_COUNTRIES = [
+    "United States", "United Kingdom", "United Arab Emirates", "South Africa", "South Korea", "Hong Kong", "Puerto Rico",
+    "Cayman Islands", "Marshall Islands", "British Virgin Islands",
+    "US", "United", "Canada", "Brazil", "China", "Bermuda", "Ireland", "Netherlan", "Netherlands", "Chile", "Mexico",
+    "Taiwan", "Peru", "Panama", "Greece", "Argentina", "Switzerlan", "Switzerland", "Spain", "Luxembou", "Luxembourg",
+    "Uruguay", "South", "Singapore", "Japan", "Israel", "India", "France", "Colombia", "Belgium", "Germany", "Italy",
+    "Australia", "Korea", "Hong", "Puerto", "Cayman", "Bahamas", "Monaco", "Norway", "Denmark", "Sweden", "Finland",
+    "Philippines", "Indonesia", "Russia", "Turkey", "Cyprus", "Jersey", "Guernsey", "Marshall", "Liberia", "Portugal",
+    "Austria", "Britain", "England", "UK", "Scotland", "Venezuela", "Jamaica", "Thailand", "Malaysia", "Bahrain",
+]
+NYSE_ROW_RE = re.compile(
+    r"^(?P<pre>.*?)(?P<symbol>[A-Z][A-Z0-9]{0,5}(?:\.[A-Z0-9]{1,4})?)\s*(?P<country>"
+    + "|".join(sorted(NYSE_COUNTRIES, key=len, reverse=True))
+    + r")\s*$"
+)
+NYSE_SYMBOL_LINE_RE = re.compile(r"^[A-Z][A-Z0-9]{0,5}(?:\.[A-Z0-9]{1,4})?$") #symbol alone on its line, the country starts on the next one
+NYSE_COUNTRY_CONTINUATIONS = {"States", "Kingdom", "Africa", "Korea", "Kong", "Rico", "Islands", "Arab", "Emirates", "d", "ds", "rg"}
+NYSE_HEADER_LINES = {"Stock", "name Symbol", "Country", "of", "origin"}
+NYSE_NAME_SUFFIXES = {"LTD", "INC", "CO", "CORP", "PLC", "NV", "SA", "AG"} #"ABB LTD.ABB" is name "ABB LTD." + symbol "ABB", not symbol "LTD.ABB"
+#a name line that ends like a row ("Foo CorpFOO Mauritius") but on no known country, its row would merge into the next one
+NYSE_UNKNOWN_ROW_END_RE = re.compile(r"(?<![A-Z])[A-Z][A-Z0-9]{0,4}(?:\.[A-Z0-9]{1,4})?\s*[A-Z][a-z]+$")
+
+
+def _wrapped_country(lines: list[str], start: int) -> tuple[str, int] | None:
+    """
+        reads a country cell wrapped over the lines from start on ("British" / "Virgin" / "Islands")
+        returns:
+            (country, number of lines it spans), None when the lines do not spell a known country
+    """
+    words, found = [], None
+    for line in lines[start:start + 3]:
+        words.append(line.strip())
+        text = " ".join(words)
+        if text in NYSE_COUNTRIES:
+            found = (text, len(words))
+        if not any(country.startswith(text + " ") for country in NYSE_COUNTRIES):
+            break
+
+    return found
+
+
+def _join_fragments(fragments: list[str]) -> str:
+    """
+        joins the wrapped lines of a table cell, pypdf keeps a trailing space where a line ended between words,
+        lines without one were cut inside a word ("Corporati" + "on")
+    """
+    return " ".join("".join(fragments).split())
+
+
+def parse_nasdaq(lines: list[str], exchange: str = "NASDAQ") -> list[dict]:
+    rows = []
+
+    for line in lines:
+        line = line.strip()
+        if line == NASDAQ_HEADER:
+            continue
+
+        if not line:
+            if rows:
+                break #the table ends at the first blank line, the pages after it only repeat overlong security names
+            continue
+
+        match = NASDAQ_ROW_RE.match(line)
+        if match is None and " " not in line[:6]:
+            match = NASDAQ_GLUED_RE.match(line)
+
+        if match is not None:
+            rows.append({"symbol" : match["symbol"], "name" : match["name"].strip(), "exchange" : exchange})
+
+    return rows
+
+
+def parse_nyse(lines: list[str], exchange: str = "NYSE") -> list[dict]:
+    rows = []
+    fragments = []
+    expect_continuation = False
+    skip_until = 0
+    unknown_row_ends = []
+
+    for i, raw_line in enumerate(lines):
+        if i < skip_until:
+            continue
+
+        line = raw_line.rstrip("\n")
+        stripped = line.strip()
+
+        if not stripped or stripped in NYSE_HEADER_LINES:
+            continue
+
+        wrapped = _wrapped_country(lines, i + 1) if NYSE_SYMBOL_LINE_RE.match(line) else None
+        if wrapped: #"Foods Ltd" / "ANFI" / "United" / "Arab" / "Emirates"
+            country, spanned = wrapped
+            stripped = f"{stripped} {country}"
+            skip_until = i + 1 + spanned
+
+            cut = re.search(r"(?<![^ ])[A-Z]{1,2}$", fragments[-1]) if fragments else None
+            if cut: #symbol cut over two lines, "BHP BBL & B" / "HP"
+                stripped = cut.group() + stripped
+                fragments[-1] = fragments[-1][:cut.start()]
+
+        if expect_continuation and stripped in NYSE_COUNTRY_CONTINUATIONS: #second line of a wrapped country, e.g. "United" / "States"
+            rows[-1]["country"] = (rows[-1]["country"] + (" " if len(stripped) > 2 else "") + stripped).strip()
+            continue
+        expect_continuation = False
+
+        match = NYSE_ROW_RE.match(stripped)
+        if match is None:
+            if NYSE_UNKNOWN_ROW_END_RE.search(line): #a line cut between words keeps its trailing space and never matches
+                unknown_row_ends.append(stripped)
+            fragments.append(line)
+            continue
+
+        pre, symbol = match["pre"], match["symbol"]
+        head = symbol.split(".")[0]
+        if "." in symbol and (head in NYSE_NAME_SUFFIXES or (len(head) == 1 and pre.endswith("."))): #"S.A.AGRO" is "S.A." + "AGRO"
+            suffix, symbol = symbol.split(".", 1)
+            pre += suffix + "."
+        elif len(head) > 5 and head[:2] in NYSE_NAME_SUFFIXES: #"Atento SAATTO", symbols have at most 5 letters
+            pre += head[:2]
+            symbol = symbol[2:]
+
+        if pre:
+            fragments.append(pre)
+
+        name = _join_fragments(fragments)
+        fragments = []
+
+        if not name:
+            continue
+
+        rows.append({"symbol" : symbol, "name" : name, "exchange" : exchange, "country" : match["country"]})
+        expect_continuation = True
+
+    if unknown_row_ends:
+        logger.warning(
+            f"{len(unknown_row_ends)} {exchange} lines look like rows ending on a country missing from NYSE_COUNTRIES, "
+            f"they were merged into the next row: {unknown_row_ends[:5]}"
+        )
+
+    return rows
+
+
+def parse_listing(lines: list[str], exchange: str) -> list[dict]:
+    """
+        extracts listing rows from the text lines of a whole listing pdf, the table layout is detected from its header
+    """
+    head = " ".join(line.strip() for line in lines[:5])
+
+    if NASDAQ_HEADER in head:
+        return parse_nasdaq(lines, exchange)
+
+    return parse_nyse(lines, exchange)
+
+
+def _normalize(text: str) -> str:
+    return " ".join(re.sub(r"[^a-z0-9&.\s]", " ", text.lower()).split())
+
+
+class ListingIndex:
+    """
+        Structured index of the exchange listings: symbol -> rows (a symbol can be listed on several exchanges).
+        Symbols are looked up in a dict, symbol and company name prefixes by bisecting sorted key lists, and single
+        words of company names through a word -> symbols map.
+    """
+
+    def __init__(self, rows: list[dict], version: str = ""):
+        self.rows = rows
+        self.version = version
+
+        self.by_symbol: dict[str, list[dict]] = {}
+        self.by_word: dict[str, set[str]] = {}
+        names = []
+
+        for row in rows:
+            self.by_symbol.setdefault(row["symbol"].upper(), []).append(row)
+            name = _normalize(row["name"])
+            names.append((name, row["symbol"].upper()))
+            for word in set(name.split()):
+                self.by_word.setdefault(word, set()).add(row["symbol"].upper())
+
+        self.symbols = sorted(self.by_symbol)
+        self.names = sorted(names)
+        self.name_keys = [name for name, _ in self.names]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def get(self, symbol: str) -> list[dict]:
+        return self.by_symbol.get(symbol.strip().upper().lstrip("$"), [])
+
+    def symbol_prefix(self, prefix: str, limit: int = 10) -> list[dict]:
+        prefix = prefix.strip().upper()
+        start = bisect.bisect_left(self.symbols, prefix)
+        results = []
+
+        for symbol in self.symbols[start:]:
+            if not symbol.startswith(prefix) or len(results) >= limit:
+                break
+            results.extend(self.by_symbol[symbol])
+
+        return results[:limit]
+
+    def name_prefix(self, prefix: str, limit: int = 10) -> list[dict]:
+        prefix = _normalize(prefix)
+        start = bisect.bisect_left(self.name_keys, prefix)
+        results = []
+
+        for name, symbol in self.names[start:]:
+            if not name.startswith(prefix) or len(results) >= limit:
+                break
+            results.extend(row for row in self.by_symbol[symbol] if _normalize(row["name"]) == name)
+
+        return results[:limit]
+
+    def name_words(self, query: str, limit: int = 10) -> list[dict]:
+        """
+            rows whose company name contains every word of query
+        """
+        words = _normalize(query).split()
+        if not words:
+            return []
+
+        symbols = set.intersection(*(self.by_word.get(word, set()) for word in words))
+
+        return [row for symbol in sorted(symbols) for row in self.by_symbol[symbol]][:limit]
+
+    def lookup(self, query: str, limit: int = 10) -> list[dict]:
+        """
+            Resolves a ticker or company name: exact symbol first, then company name prefix, then name words,
+            then symbol prefix
+        """
+        query = query.strip()
+        if not query:
+            return []
+
+        results = self.get(query)
+        if results:
+            return results[:limit]
+
+        for search in (self.name_prefix, self.name_words, self.symbol_prefix):
+            results = search(query, limit)
+            if results:
+                return results
+
+        return []
+
+    def save(self, path: Path):
+        tmp_path = path.with_suffix(".tmp")
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version" : self.version, "rows" : self.rows}, f)
+
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ListingIndex":
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        return cls(data["rows"], version=data.get("version", ""))
+
+
+def format_rows(rows: list[dict]) -> str:
+    lines = []
+    for row in rows:
+        country = f", country: {row['country']}" if row.get("country") else ""
+        lines.append(f"{row['symbol']} - {row['name']} (exchange: {row['exchange']}{country})")
+    return "\n".join(lines)
@@ -0,0 +1,106 @@
+import hashlib
+import json
+from pathlib import Path
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+CHUNK_ID_SCHEME = "name+sha256" #stored with the ingest settings, collections built with content-only ids are rebuilt
+
+
+def file_hash(path: Path, block_size: int = 1 << 20) -> str:
+    """
+        returns the sha256 hex digest of a file's content, read in blocks so large pdfs are not loaded at once
+    """
+    digest = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def chunk_ids(name: str, sha256: str, count: int, start: int = 0) -> list[str]:
+    """
+        returns the deterministic chroma ids for chunks start..start+count of a file, derived from its relative name and
+        content hash so identical pdfs stored under different names never share (and overwrite) each other's chunks
+    """
+    prefix = hashlib.sha256(f"{name}\0{sha256}".encode("utf-8")).hexdigest()[:16]
+    return [f"{prefix}-{i}" for i in range(start, start + count)]
+
+
+def manifest_digest(chroma_dir: Path) -> str:
+    """
+        returns a hash of the manifest in chroma_dir, artifacts derived from a collection store it to detect staleness
+    """
+    path = chroma_dir / MANIFEST_FILE
+    return hashlib.sha256(path.read_bytes() if path.exists() else b"").hexdigest()[:16]
+
+
+class IngestManifest:
+    """
+        Keeps track of which pdfs have been ingested into a chroma collection.
+        Stored as manifest.json next to the chroma files, it maps each pdf (relative path) to its content hash
+        and the number of chunks written for it. The settings used for chunking/embedding are stored too so that
+        changing them invalidates everything that was ingested with the old settings.
+    """
+
+    def __init__(self, path: Path, settings: dict):
+        self.path = path
+        self.settings = settings
+        self.files: dict[str, dict] = {}
+        self.settings_changed = False
+        self.exists = False
+
+    @classmethod
+    def load(cls, chroma_dir: Path, settings: dict) -> "IngestManifest":
+        """
+            loads the manifest stored in chroma_dir, an empty manifest is returned if none exists yet
+        """
+        manifest = cls(chroma_dir / MANIFEST_FILE, settings)
+
+        if not manifest.path.exists():
+            return manifest
+
+        try:
+            with open(manifest.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read ingestion manifest {manifest.path}: {e}")
+            return manifest
+
+        manifest.exists = True
+        manifest.files = data.get("files", {})
+        manifest.settings_changed = data.get("settings") != settings #chunker or embedder changed, old chunks are not comparable anymore
+
+        return manifest
+
+    def save(self):
+        """
+            writes the manifest to disk, through a temp file so a crash mid-write never leaves a corrupt manifest
+        """
+        tmp_path = self.path.with_suffix(".tmp")
+
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"settings": self.settings, "files": self.files}, f, indent=2, sort_keys=True)
+
+        tmp_path.replace(self.path)
+
+    def is_current(self, name: str, sha256: str) -> bool:
+        entry = self.files.get(name)
+        return entry is not None and entry.get("sha256") == sha256
+
+    def ids_for(self, name: str) -> list[str]:
+        entry = self.files.get(name)
+        if entry is None:
+            return []
+        return chunk_ids(name, entry["sha256"], entry.get("chunks", 0))
+
+    def all_ids(self) -> list[str]:
+        ids = []
+        for name in self.files:
+            ids.extend(self.ids_for(name))
+        return ids
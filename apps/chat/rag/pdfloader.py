@@ -1,11 +1,19 @@
+import hashlib
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
 
 from langchain_community.vectorstores import Chroma
-from langchain_community.document_loaders import PyPDFDirectoryLoader
+from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
 
+from apps.chat.rag.embeddings import EMBEDDING_MODEL, EMBEDDING_NORMALIZE, get_embeddings
+from apps.chat.rag.lexical import BM25_FILE, BM25Index
+from apps.chat.rag.listing_index import LISTING_INDEX_FILE, ListingIndex, parse_listing
+from apps.chat.rag.manifest import CHUNK_ID_SCHEME, MANIFEST_FILE, IngestManifest, chunk_ids, file_hash, manifest_digest
 from config.logger import get_logger
 
 logger = get_logger(__name__)
@@ -22,63 +30,482 @@ MARKET_PDF_DIR = BASE_DIR / "media" / "pdfs" / "stock_market"
 CHROMA_LISTING_DIR = BASE_DIR / "chromadb" / "listing_db"
 CHROMA_MARKET_DIR = BASE_DIR / "chromadb" / "market_db"
 
+#collection name -> (pdf directory, chromaDB directory)
+COLLECTIONS = {
+    "listing_db" : (LISTING_PDF_DIR, CHROMA_LISTING_DIR),
+    "market_db" : (MARKET_PDF_DIR, CHROMA_MARKET_DIR),
+}
 
-def build_vectorstore(pdf_dir : Path, chroma_dir: Path):
+_index_version = None #(manifest mtimes, version) of the last index_version() call
+
+#chunking and embedding settings, changing any of these re-ingests every pdf on the next run
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1000"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "200"))
+
+RETRIEVER_K = int(os.getenv("RAG_RETRIEVER_K", "4")) #chunks each collection's retriever returns
+
+#chroma collection settings, the metric and HNSW build parameters are fixed when a collection is created so changing them
+#rebuilds it. ef_search only affects queries and is applied to the existing collection when it is opened
+COLLECTION_PREFIX = os.getenv("RAG_COLLECTION_PREFIX", "") #collections are named <prefix><chroma dir name>, e.g. "market_db"
+DISTANCE_METRIC = os.getenv("RAG_DISTANCE_METRIC", "cosine") #"cosine", "l2" or "ip"
+HNSW_M = int(os.getenv("RAG_HNSW_M", "16")) #graph links per node, higher is better recall, more memory and slower builds
+HNSW_EF_CONSTRUCTION = int(os.getenv("RAG_HNSW_EF_CONSTRUCTION", "100")) #candidate list size while building the graph
+HNSW_EF_SEARCH = int(os.getenv("RAG_HNSW_EF_SEARCH", "50")) #candidate list size per query, higher is better recall and slower
+
+#distance -> relevance score in [0, 1] used by similarity_search_with_relevance_scores, same mapping as langchain's
+RELEVANCE_SCORE_FNS = {
+    "cosine" : Chroma._cosine_relevance_score_fn,
+    "l2" : Chroma._euclidean_relevance_score_fn,
+    "ip" : Chroma._max_inner_product_relevance_score_fn,
+}
+
+#ingestion pipeline settings, peak memory is bounded by the pdfs in flight (whole files, see iter_parsed_pdfs) plus one embedding batch
+EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "64")) #chunks embedded and upserted to chroma per call
+PARSE_WORKERS = int(os.getenv("RAG_PARSE_WORKERS", str(min(4, os.cpu_count() or 1)))) #processes parsing pdfs in parallel
+PARSE_START_METHOD = os.getenv("RAG_PARSE_START_METHOD", "spawn") #"spawn" or "forkserver", a fork of this multithreaded process (torch, chroma, the chat writer) can deadlock on a lock held by another thread
+
+
+def ingest_settings(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> dict:
     """
-        This is a helper function to build a vector store from PDFs
+        returns the settings that determine the content of the vector store, stored in the ingestion manifest
     """
+    return {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_model": EMBEDDING_MODEL,
+        "normalize_embeddings": EMBEDDING_NORMALIZE,
+        "collection_prefix": COLLECTION_PREFIX,
+        "distance_metric": DISTANCE_METRIC,
+        "hnsw_m": HNSW_M,
+        "hnsw_ef_construction": HNSW_EF_CONSTRUCTION,
+        "chunk_id_scheme": CHUNK_ID_SCHEME,
+    }
 
-    pdf_dir.mkdir(parents=True, exist_ok=True) #checks if pdf directory exists if not create
 
-    chroma_dir.mkdir(parents=True, exist_ok=True) #checks if chromadb directory exists if not create
+def collection_metadata(distance_metric: str = DISTANCE_METRIC, m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION,
+                        ef_search: int = HNSW_EF_SEARCH) -> dict:
+    """
+        returns the chroma collection metadata holding the distance metric and HNSW parameters
+    """
+    return {
+        "hnsw:space" : distance_metric,
+        "hnsw:M" : m,
+        "hnsw:construction_ef" : ef_construction,
+        "hnsw:search_ef" : ef_search,
+    }
+
+
+def chroma_collection(chroma_dir: Path) -> Chroma:
+    """
+        opens (or creates) the collection persisted in chroma_dir with the configured name, metric and HNSW settings
+    """
+    return Chroma(
+        collection_name=COLLECTION_PREFIX + chroma_dir.name,
+        embedding_function=get_embeddings(),
+        persist_directory=str(chroma_dir),
+        collection_metadata=collection_metadata(),
+        relevance_score_fn=RELEVANCE_SCORE_FNS[DISTANCE_METRIC],
+    )
+
+
+def drop_collections(vectorstore: Chroma):
+    """
+        deletes every collection in the vectorstore's directory (the current one and any left by older builds,
+        e.g. chroma's default "langchain" collection)
+    """
+    client = vectorstore._client
+    for collection in client.list_collections():
+        name = getattr(collection, "name", collection)
+        logger.info(f"Dropping chroma collection {name}")
+        client.delete_collection(name)
+
+
+def apply_search_ef(vectorstore: Chroma, ef_search: int = HNSW_EF_SEARCH):
+    """
+        sets ef_search on an existing collection, it is a query time setting so no rebuild is needed
+    """
+    try:
+        vectorstore._collection.modify(configuration={"hnsw" : {"ef_search" : ef_search}})
+    except Exception as e:
+        logger.warning(f"Could not set ef_search={ef_search} on {vectorstore._collection.name}: {e}")
+
+
+def _parse_pdf(pdf_path: str):
+    """
+        loads the pages of a single pdf, runs inside the parser process pool so it has to be a module level function
+    """
+    return PyPDFLoader(pdf_path).load()
+
+
+def iter_parsed_pdfs(pdf_paths: dict[str, Path]):
+    """
+        Parses pdfs in a process pool and yields (name, pages) in the order given, while the following pdfs are parsed.
+        At most PARSE_WORKERS * 2 pdfs are in flight, so parsed pages do not pile up when embedding is the bottleneck.
+        Memory is bounded per file, not per batch: a worker returns every page of its pdf at once, so the peak is the
+        text of the PARSE_WORKERS * 2 largest pdfs in flight (chunking and embedding then go EMBED_BATCH_SIZE chunks at a time).
+        Workers are started with PARSE_START_METHOD, never forked from this process.
+    """
+    items = iter(pdf_paths.items())
+
+    if PARSE_WORKERS <= 1:
+        for name, pdf_path in items:
+            yield name, _parse_pdf(str(pdf_path))
+        return
 
-    #load all pdfs in directory
-    loader = PyPDFDirectoryLoader(str(pdf_dir))
+    with ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=multiprocessing.get_context(PARSE_START_METHOD)) as executor:
+        in_flight = []
 
-    documents = loader.load()
+        for name, pdf_path in islice(items, PARSE_WORKERS * 2):
+            in_flight.append((name, executor.submit(_parse_pdf, str(pdf_path))))
+
+        while in_flight:
+            name, future = in_flight.pop(0) #results are consumed in submission order to keep ingestion deterministic
+            pages = future.result()
+
+            for next_name, next_path in islice(items, 1):
+                in_flight.append((next_name, executor.submit(_parse_pdf, str(next_path))))
+
+            yield name, pages
+
+
+def iter_chunks(pages, splitter: RecursiveCharacterTextSplitter):
+    """
+        yields the chunks of the given pages one page at a time instead of building the full list of chunks
+    """
+    for page in pages:
+        yield from splitter.split_documents([page])
+
+
+def batched(iterable, size: int):
+    """
+        yields lists of up to size items from iterable
+    """
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def sync_vectorstore(vectorstore: Chroma, pdf_dir: Path, chroma_dir: Path, progress=None,
+                     chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, on_parsed=None):
+    """
+        Brings the vector store in line with the pdfs in pdf_dir using the ingestion manifest
+        - unchanged pdfs (same content hash) are skipped
+        - changed pdfs have their old chunks deleted and are re-embedded
+        - deleted pdfs have their chunks purged
+        - if the chunker/embedder settings changed, or the collection was built before the manifest existed, it is rebuilt
+        New/changed pdfs are parsed in a process pool, split lazily and embedded/upserted EMBED_BATCH_SIZE chunks at a time,
+        on_parsed(name, pages) is called with the pages of each of them (build_listing_index reuses them)
+    """
+
+    manifest = IngestManifest.load(chroma_dir, ingest_settings(chunk_size, chunk_overlap))
+
+    if manifest.settings_changed or not manifest.exists:
+        stale_ids = vectorstore.get(include=[])["ids"] #anything already in the collection is untracked or built with old settings
+        if stale_ids:
+            logger.info(f"Rebuilding {chroma_dir.name}: removing {len(stale_ids)} chunks from a previous build")
+            vectorstore.delete(ids=stale_ids)
+        manifest.files = {}
+        manifest.save()
+
+    current = {
+        pdf_path.relative_to(pdf_dir).as_posix() : pdf_path
+        for pdf_path in sorted(pdf_dir.glob("**/[!.]*.pdf"))
+    }
+
+    if not current:
+        logger.warning(f"No documents found in {pdf_dir}")
+
+    #purge pdfs that no longer exist
+    for name in [n for n in manifest.files if n not in current]:
+        logger.info(f"Removing chunks of deleted pdf {name}")
+        vectorstore.delete(ids=manifest.ids_for(name))
+        del manifest.files[name]
+        manifest.save()
+
+    #hash everything first, only new/changed pdfs go through the parse -> split -> embed pipeline
+    pending = {}
+    for index, (name, pdf_path) in enumerate(current.items(), start=1):
+        sha256 = file_hash(pdf_path)
+
+        if manifest.is_current(name, sha256):
+            if progress:
+                progress(name, index, len(current), "unchanged")
+            continue
+
+        old_ids = manifest.ids_for(name)
+        if old_ids:
+            logger.info(f"{name} changed, replacing {len(old_ids)} chunks")
+            vectorstore.delete(ids=old_ids)
+            del manifest.files[name]
+            manifest.save()
+
+        pending[name] = (pdf_path, sha256)
+
+    skipped = len(current) - len(pending)
+    if not pending:
+        logger.info(f"{chroma_dir.name} is up to date ({skipped} of {len(current)} pdfs unchanged)")
+        return
 
-    if not documents:
-        logger.warning("No documents found in media/pdfs")
-    
-    #split documents    
     splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=200
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
     )
 
+    start = time.perf_counter()
+    total_pages = 0
+    total_chunks = 0
 
-    splitted_docs = splitter.split_documents(documents)
+    for done, (name, pages) in enumerate(iter_parsed_pdfs({n: p for n, (p, _) in pending.items()}), start=1):
+        sha256 = pending[name][1]
+        chunk_count = 0
 
-    #create embeddings
-    embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
+        if on_parsed:
+            on_parsed(name, pages)
 
-    #create ChromaDB vectorstore
-    vectorstore = Chroma.from_documents(
-        documents=splitted_docs,
-        embedding=embeddings,
-        persist_directory=str(chroma_dir)
+        for batch in batched(iter_chunks(pages, splitter), EMBED_BATCH_SIZE): #embeds and upserts one batch at a time
+            vectorstore.add_texts(
+                texts=[doc.page_content for doc in batch],
+                metadatas=[doc.metadata for doc in batch],
+                ids=chunk_ids(name, sha256, len(batch), start=chunk_count),
+            )
+            chunk_count += len(batch)
+
+        manifest.files[name] = {
+            "sha256" : sha256,
+            "pages" : len(pages),
+            "chunks" : chunk_count,
+        }
+        manifest.save() #saved per file so an interrupted run only redoes the file it was on
+
+        total_pages += len(pages)
+        total_chunks += chunk_count
+
+        logger.info(f"Ingested {name}: {len(pages)} pages, {chunk_count} chunks")
+        if progress:
+            progress(name, done, len(pending), f"ingested {len(pages)} pages, {chunk_count} chunks")
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    logger.info(
+        f"{chroma_dir.name} is up to date: ingested {len(pending)} pdfs ({skipped} unchanged) in {elapsed:.1f}s, "
+        f"{total_pages / elapsed:.1f} pages/s, {total_chunks / elapsed:.1f} chunks/s"
     )
 
-    return vectorstore.as_retriever()
 
+def build_vectorstore(pdf_dir : Path, chroma_dir: Path, progress=None, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                      on_parsed=None):
+    """
+        This is a helper function to build a vector store from PDFs.
+        Only pdfs that are new or changed since the last run are embedded, see sync_vectorstore
+    """
 
+    pdf_dir.mkdir(parents=True, exist_ok=True) #checks if pdf directory exists if not create
 
-def init_retriever():
+    chroma_dir.mkdir(parents=True, exist_ok=True) #checks if chromadb directory exists if not create
+
+    #open the persisted ChromaDB vectorstore
+    vectorstore = chroma_collection(chroma_dir)
+
+    manifest = IngestManifest.load(chroma_dir, ingest_settings(chunk_size, chunk_overlap))
+    if manifest.settings_changed or not manifest.exists: #sync_vectorstore re-ingests everything, start from a collection with the current settings
+        drop_collections(vectorstore)
+        vectorstore = chroma_collection(chroma_dir)
+    else:
+        apply_search_ef(vectorstore)
+
+    sync_vectorstore(vectorstore, pdf_dir, chroma_dir, progress, chunk_size=chunk_size, chunk_overlap=chunk_overlap, on_parsed=on_parsed)
+
+    build_lexical_index(vectorstore, chroma_dir)
+
+    return vectorstore
+
+
+def build_lexical_index(vectorstore: Chroma, chroma_dir: Path):
+    """
+        (Re)builds the BM25 index stored next to the collection when the collection changed since it was built
+    """
+    version = manifest_digest(chroma_dir)
+    path = chroma_dir / BM25_FILE
+
+    if path.exists():
+        try:
+            if BM25Index.load(path).version == version:
+                return
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read {path}, rebuilding it: {e}")
+
+    start = time.perf_counter()
+    data = vectorstore.get(include=["documents", "metadatas"])
+    index = BM25Index(data["ids"], data["documents"], data["metadatas"], version=version)
+    index.save(path)
+
+    logger.info(f"Built BM25 index for {chroma_dir.name}: {len(index)} chunks in {time.perf_counter() - start:.1f}s")
+
+
+def load_lexical_index(chroma_dir: Path) -> BM25Index | None:
+    """
+        loads the BM25 index of a collection, None if it was not built (hybrid retrieval then falls back to vectors only)
+    """
+    path = chroma_dir / BM25_FILE
+
+    if not path.exists():
+        logger.warning(f"No BM25 index in {chroma_dir}, run `python manage.py build_index` to enable hybrid retrieval")
+        return None
+
+    index = BM25Index.load(path)
+    if index.version != manifest_digest(chroma_dir):
+        logger.warning(f"BM25 index of {chroma_dir.name} is older than the collection, run `python manage.py build_index`")
+
+    return index
+
+
+def open_vectorstore(chroma_dir: Path) -> Chroma:
+    """
+        Opens an already built vector store for querying only, nothing is loaded, split or embedded.
+        Raises RuntimeError if the index has not been built with `python manage.py build_index` yet
+    """
+
+    manifest = IngestManifest.load(chroma_dir, ingest_settings())
+
+    if not manifest.exists:
+        raise RuntimeError(f"No index found in {chroma_dir}. Run `python manage.py build_index` first.")
+
+    if manifest.settings_changed:
+        logger.warning(f"{chroma_dir.name} was built with different chunking/embedding/collection settings, run `python manage.py build_index` to rebuild it")
+
+    vectorstore = chroma_collection(chroma_dir)
+    apply_search_ef(vectorstore)
+
+    return vectorstore
+
+
+def index_version() -> str:
+    """
+        returns a short hash identifying the currently ingested corpus, it changes whenever build_index adds,
+        replaces or removes a pdf (or the chunking/embedding settings change). Used to invalidate caches.
+    """
+    global _index_version
+
+    manifest_paths = [chroma_dir / MANIFEST_FILE for _, chroma_dir in COLLECTIONS.values()]
+    stamp = tuple(path.stat().st_mtime_ns if path.exists() else 0 for path in manifest_paths)
+
+    if _index_version is None or _index_version[0] != stamp: #manifests are only re-read after they were rewritten
+        digest = hashlib.sha256()
+        for path in manifest_paths:
+            digest.update(path.read_bytes() if path.exists() else b"")
+        _index_version = (stamp, digest.hexdigest()[:16])
+
+    return _index_version[1]
+
+
+def build_index(collections=None, rebuild: bool = False, progress=None) -> dict:
+    """
+        Builds/updates the persisted collections offline, used by the build_index management command.
+        Args:
+            collections: names from COLLECTIONS to build, all of them when None
+            rebuild: drop the manifest so every pdf is ingested again
+            progress: optional callback(collection, name, index, total, status) for reporting
+        returns:
+            dict: collection name -> number of chunks in the collection
+    """
+    counts = {}
+
+    for collection in collections or COLLECTIONS:
+        pdf_dir, chroma_dir = COLLECTIONS[collection]
+
+        if rebuild:
+            (chroma_dir / MANIFEST_FILE).unlink(missing_ok=True) #without a manifest the collection is treated as untracked and cleared
+
+        logger.info(f"Building index {collection}...")
+        parsed = {} #pages of the listing pdfs ingested by this run, build_listing_index only parses the others
+        vectorstore = build_vectorstore(
+            pdf_dir,
+            chroma_dir,
+            progress=(lambda *args, c=collection: progress(c, *args)) if progress else None,
+            on_parsed=parsed.__setitem__ if chroma_dir == CHROMA_LISTING_DIR else None,
+        )
+        if chroma_dir == CHROMA_LISTING_DIR:
+            build_listing_index(pdf_dir, chroma_dir, parsed=parsed)
+        counts[collection] = len(vectorstore.get(include=[])["ids"])
+
+    return counts
+
+
+def init_retriever(build: bool = False):
     """
         initialzes the retriever:
-        -loading pdfs
-        -splitting into chunks
-        -creating embeddings
-        -building ChromaDB vector store
+        - serve mode (default): opens the collections built by `python manage.py build_index`
+        - build mode: loads, splits and embeds new/changed pdfs first, like build_index does
         
         returns:
             retriever: Vectorstore retriever
     """
-    logger.info("Initializing retriever...")
+    logger.info(f"Initializing retriever ({'build' if build else 'serve'} mode)...")
 
-    listing_retriever = build_vectorstore(LISTING_PDF_DIR, CHROMA_LISTING_DIR)
-    market_retriever = build_vectorstore(MARKET_PDF_DIR, CHROMA_MARKET_DIR)
+    if build:
+        parsed = {}
+        listing_store = build_vectorstore(LISTING_PDF_DIR, CHROMA_LISTING_DIR, on_parsed=parsed.__setitem__)
+        market_store = build_vectorstore(MARKET_PDF_DIR, CHROMA_MARKET_DIR)
+        build_listing_index(parsed=parsed)
+    else:
+        listing_store = open_vectorstore(CHROMA_LISTING_DIR)
+        market_store = open_vectorstore(CHROMA_MARKET_DIR)
 
     logger.info("Retriever initialization complete")
 
-    return listing_retriever, market_retriever
\ No newline at end of file
+    search_kwargs = {"k" : RETRIEVER_K}
+
+    return listing_store.as_retriever(search_kwargs=search_kwargs), market_store.as_retriever(search_kwargs=search_kwargs)
+
+
+def build_listing_index(pdf_dir: Path = LISTING_PDF_DIR, chroma_dir: Path = CHROMA_LISTING_DIR, parsed: dict[str, list] | None = None):
+    """
+        Extracts the rows of the exchange listing pdfs (symbol, company, exchange, country) into listing_index.json,
+        rebuilt only when the listing collection changed. The exchange is taken from the file name, e.g. nasdaq_listing.pdf
+        parsed holds the pages (by relative name) sync_vectorstore already parsed, the other pdfs are parsed in the pool
+    """
+    version = manifest_digest(chroma_dir)
+    path = chroma_dir / LISTING_INDEX_FILE
+
+    if path.exists():
+        try:
+            if ListingIndex.load(path).version == version:
+                return
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not read {path}, rebuilding it: {e}")
+
+    pdf_paths = {pdf_path.relative_to(pdf_dir).as_posix() : pdf_path for pdf_path in sorted(pdf_dir.glob("**/[!.]*.pdf"))}
+    parsed = dict(parsed or {})
+    parsed.update(iter_parsed_pdfs({name : path for name, path in pdf_paths.items() if name not in parsed})) #unchanged pdfs, skipped by the sync
+
+    rows = []
+    for name, pdf_path in pdf_paths.items():
+        exchange = pdf_path.stem.split("_")[0].upper()
+        lines = "\n".join(page.page_content for page in parsed[name]).split("\n")
+        file_rows = parse_listing(lines, exchange)
+        logger.info(f"Extracted {len(file_rows)} listings from {pdf_path.name}")
+        rows.extend(file_rows)
+
+    ListingIndex(rows, version=version).save(path)
+
+
+def load_listing_index(chroma_dir: Path = CHROMA_LISTING_DIR) -> ListingIndex | None:
+    """
+        loads the structured listing index, None if it was not built yet
+    """
+    path = chroma_dir / LISTING_INDEX_FILE
+
+    if not path.exists():
+        logger.warning(f"No listing index in {chroma_dir}, run `python manage.py build_index` to enable listing_lookup")
+        return None
+
+    return ListingIndex.load(path)
+
+
+def init_lexical_indexes() -> dict[str, BM25Index | None]:
+    """
+        returns the BM25 indexes of both collections keyed by router choice ("listing" / "market")
+    """
+    return {
+        "listing" : load_lexical_index(CHROMA_LISTING_DIR),
+        "market" : load_lexical_index(CHROMA_MARKET_DIR),
+    }
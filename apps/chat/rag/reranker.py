@@ -0,0 +1,69 @@
+import os
+import threading
+import time
+
+from langchain_core.documents import Document
+
+from apps.chat.rag.budget import count_tokens
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+RERANK_MODEL = os.getenv("RAG_RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2") #small cpu cross-encoder, ~22M parameters
+RERANK_BATCH_SIZE = int(os.getenv("RAG_RERANK_BATCH_SIZE", "16"))
+
+
+class CrossEncoderReranker:
+    """
+        Scores (query, chunk) pairs with a cross-encoder and keeps the best chunks that fit in a token budget.
+        The model is loaded on first use so processes that never retrieve (e.g. build_index) do not pay for it.
+    """
+
+    def __init__(self, model_name: str = RERANK_MODEL, batch_size: int = RERANK_BATCH_SIZE, device: str = "cpu"):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.device = device
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                start = time.perf_counter()
+                self._model = CrossEncoder(self.model_name, device=self.device)
+                logger.info(f"Loaded reranker {self.model_name} in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        return self._model
+
+    def score(self, query: str, docs: list[Document]) -> list[float]:
+        if not docs:
+            return []
+
+        pairs = [(query, doc.page_content) for doc in docs]
+
+        return [float(score) for score in self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)]
+
+    def rerank(self, query: str, docs: list[Document], top_n: int, token_budget: int | None = None) -> list[Document]:
+        """
+            returns at most top_n of docs, best cross-encoder score first, stopping before the total estimated
+            tokens exceed token_budget (the best document is always kept)
+        """
+        scores = self.score(query, docs)
+        ranked = sorted(zip(docs, scores), key=lambda item: item[1], reverse=True)
+
+        results = []
+        used_tokens = 0
+        for doc, score in ranked[:top_n]:
+            tokens = count_tokens(doc.page_content)
+            if results and token_budget is not None and used_tokens + tokens > token_budget:
+                break
+
+            results.append(doc.model_copy(update={"metadata" : {**doc.metadata, "rerank_score" : round(score, 4)}})) #docs may be shared with the retrieval cache
+            used_tokens += tokens
+
+        logger.info(f"Reranked {len(docs)} candidates -> {len(results)} documents (~{used_tokens} tokens)")
+
+        return results
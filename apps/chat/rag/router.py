@@ -1,26 +1,332 @@
+import contextvars
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from apps.chat.rag.answer_cache import normalize_question
+from apps.chat.rag.lexical import doc_key, reciprocal_rank_fusion
+from apps.chat.rag.reranker import CrossEncoderReranker
+from config.tracing import span
+
+#labelled example questions per collection, embedded once at startup; their centroid and nearest example decide the route
+ROUTE_EXEMPLARS = {
+    "listing" : [
+        "Is Apple listed on NASDAQ?",
+        "What is the ticker symbol of Microsoft?",
+        "Which exchange is Coca-Cola listed on?",
+        "Find the company with the symbol AAPL",
+        "Is Tesla traded on the NYSE?",
+        "Which companies on the NYSE are from Canada?",
+        "List the companies whose name starts with Amazon",
+        "What company does the ticker BRK.B belong to?",
+        "Is this stock listed on Cboe or IEX?",
+        "What is the country of origin of this NYSE listed company?",
+    ],
+    "market" : [
+        "How did the stock market perform this year?",
+        "What was the return of the S&P 500?",
+        "What are the current market trends?",
+        "Which sectors had the biggest gains?",
+        "Why did the market lose value last quarter?",
+        "How did interest rates affect stocks?",
+        "What is the outlook for equities next year?",
+        "How volatile was the market recently?",
+        "Which index performed best?",
+        "What drove the rally in technology stocks?",
+    ],
+}
+
+
+class EmbeddingRouter:
+    """
+        Routes a query to a collection by cosine similarity to labelled exemplar questions:
+        each route scores the mean of its exemplar centroid similarity and its nearest exemplar similarity.
+        confidence is the margin between the best and the runner-up route, below threshold the caller should query every route.
+    """
+
+    def __init__(self, embeddings: Embeddings, exemplars: dict[str, list[str]] = ROUTE_EXEMPLARS, threshold: float = 0.05):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.routes = list(exemplars)
+
+        self.exemplar_vectors = {}
+        self.centroids = {}
+        for route, questions in exemplars.items():
+            vectors = self._normalize(np.asarray(embeddings.embed_documents(questions), dtype=np.float32))
+            self.exemplar_vectors[route] = vectors
+            self.centroids[route] = self._normalize(vectors.mean(axis=0))
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+    def scores(self, query: str) -> dict[str, float]:
+        vector = self._normalize(np.asarray(self.embeddings.embed_query(query), dtype=np.float32))
+
+        return {
+            route : float(0.5 * (self.centroids[route] @ vector) + 0.5 * (self.exemplar_vectors[route] @ vector).max())
+            for route in self.routes
+        }
+
+    def route(self, query: str) -> tuple[list[str], float, dict[str, float]]:
+        """
+            returns:
+                (routes to query, confidence, score per route), a single route when confident, every route otherwise
+        """
+        scores = self.scores(query)
+        ranked = sorted(scores, key=scores.get, reverse=True)
+        confidence = scores[ranked[0]] - scores[ranked[1]] if len(ranked) > 1 else 1.0
+
+        if confidence < self.threshold:
+            return ranked, confidence, scores
+
+        return ranked[:1], confidence, scores
+
+
 class RouterRetriever:
-    def __init__(self, listing_retriever, market_retriever, logger):
+    def __init__(self, listing_retriever, market_retriever, logger, cache_size: int = 256, version_fn=None,
+                 mode: str = "vector", lexical_loader=None, query_router: EmbeddingRouter | None = None,
+                 reranker: CrossEncoderReranker | None = None, candidate_k: int = 20, token_budget: int | None = None):
         self.listing_retriever = listing_retriever
         self.market_retriever = market_retriever
+        self.retrievers = {"listing" : listing_retriever, "market" : market_retriever}
         self.logger = logger
-    
+
+        #classifies queries by embedding similarity, route_query's keyword rules are used when it is not set
+        self.query_router = query_router
+        self.fan_out_pool = ThreadPoolExecutor(max_workers=len(self.retrievers), thread_name_prefix="fan-out")
+        self.fan_outs = 0 #queries sent to every collection because the router was not confident
+
+        #when a reranker is set, candidate_k documents are fetched and only the retriever's k best (within token_budget tokens) are returned
+        self.reranker = reranker
+        self.candidate_k = candidate_k
+        self.token_budget = token_budget
+
+        #"vector" uses the chroma retrievers only, "hybrid" fuses them with the BM25 indexes by reciprocal rank fusion
+        self.mode = mode
+        self.lexical_loader = lexical_loader #returns {"listing": BM25Index, "market": BM25Index}, reloaded when the index version changes
+        self.lexical_indexes = lexical_loader() if mode == "hybrid" and lexical_loader else {}
+
+        #LRU cache of (routed collections, normalised query, k) -> documents, cleared when version_fn() changes
+        self.cache_size = cache_size
+        self.version_fn = version_fn
+        self.version = None
+        self.cache: OrderedDict[tuple, list] = OrderedDict()
+        self.in_flight: dict[tuple, Future] = {} #lookups currently running, identical concurrent queries wait on these
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.shared = 0 #lookups answered by an identical in-flight lookup
+
+    def route(self, query: str) -> list[str]:
+        with span("retriever.route") as route_span:
+            choices = self._route(query)
+            route_span.set(routes=choices)
+
+        return choices
+
+    def _route(self, query: str) -> list[str]:
+        if self.query_router is None:
+            choices = [route_query(query)]
+            self.logger.info(f"Routing query -> {choices[0]} retriever (keyword rules)")
+            return choices
+
+        choices, confidence, scores = self.query_router.route(query)
+        score_text = ", ".join(f"{route}={score:.3f}" for route, score in scores.items())
+
+        if len(choices) > 1:
+            with self.lock:
+                self.fan_outs += 1
+            self.logger.info(f"Routing query -> {' + '.join(choices)} (fan-out, confidence {confidence:.3f}, scores {score_text})")
+        else:
+            self.logger.info(f"Routing query -> {choices[0]} retriever (confidence {confidence:.3f}, scores {score_text})")
+
+        return choices
+
     def get_relevant_documents(self, query: str): #not the same as the vectorstore.as_retriever().get_relevant_documents(query) its just a wrapper class
-        choice = route_query(query)
-        self.logger.info(f"choosing router...")
-        retriever = self.listing_retriever if choice == "listing" else self.market_retriever
-        self.logger.info(f"Routing query -> {choice} retriever")
+        choices = self.route(query)
+
+        k = max(getattr(self.retrievers[choice], "search_kwargs", {}).get("k", 4) for choice in choices)
+        key = (tuple(sorted(choices)), normalize_question(query), k)
+
+        with span("retriever", routes=choices, k=k) as retriever_span:
+            hits = self.hits
+            docs = self._cached(key, lambda: self._retrieve(choices, query, k))
+            retriever_span.set(cache_hit=self.hits > hits, documents=len(docs)) #approximate under concurrent lookups
+
+        return docs
 
-        return retriever.get_relevant_documents(query) #this will call the actual vectorstore.as_retriever().get_relevant_documents(query) and return the data
+    def _retrieve(self, choices: list[str], query: str, k: int) -> list:
+        """
+            first stage: fetch candidates from the routed collections, second stage: rerank them down to k
+        """
+        if self.reranker is None:
+            return self._search(choices, query, k)
+
+        start = time.perf_counter()
+        candidates = self._search(choices, query, max(self.candidate_k, k))
+        fetched = time.perf_counter()
+
+        with span("retriever.rerank", candidates=len(candidates)):
+            docs = self.reranker.rerank(query, candidates, top_n=k, token_budget=self.token_budget)
+        reranked = time.perf_counter()
+
+        self.logger.info(
+            f"Retrieval stages: candidates {len(candidates)} in {(fetched - start) * 1000:.0f} ms, "
+            f"rerank -> {len(docs)} in {(reranked - fetched) * 1000:.0f} ms"
+        )
+
+        return docs
+
+    def _search(self, choices: list[str], query: str, k: int) -> list:
+        if len(choices) == 1:
+            ranked_lists = [self._search_collection(choices[0], query, k)]
+        else: #both collections are searched in parallel and merged below
+            futures = [
+                self.fan_out_pool.submit(contextvars.copy_context().run, self._search_collection, choice, query, k) #keeps the request's trace in the worker
+                for choice in choices
+            ]
+            ranked_lists = [future.result() for future in futures]
+
+        if self.mode == "hybrid" and any(lexical for _, lexical in ranked_lists):
+            self.logger.info(
+                f"Hybrid retrieval: {sum(len(v) for v, _ in ranked_lists)} vector + "
+                f"{sum(len(l) for _, l in ranked_lists)} BM25 results"
+            )
+            result_lists = []
+            for vector, lexical in ranked_lists:
+                result_lists += [[doc for doc, _ in vector], lexical]
+
+            return reciprocal_rank_fusion(result_lists, k)
+
+        if len(ranked_lists) == 1:
+            return [doc for doc, _ in ranked_lists[0][0]]
+
+        return merge_by_score([vector for vector, _ in ranked_lists], k)
+
+    def _search_collection(self, choice: str, query: str, k: int) -> tuple[list, list]:
+        """
+            returns:
+                ([(document, relevance score)] from the vectorstore, [documents] from the BM25 index in hybrid mode)
+        """
+        retriever = self.retrievers[choice]
+        vectorstore = getattr(retriever, "vectorstore", None)
+
+        with span("chroma.search", collection=choice, k=k):
+            if vectorstore is not None:
+                vector_results = vectorstore.similarity_search_with_relevance_scores(query, k=k)
+            else:
+                vector_results = [(doc, None) for doc in retriever.get_relevant_documents(query)] #this will call the actual vectorstore.as_retriever().get_relevant_documents(query) and return the data
+
+        lexical_index = self.lexical_indexes.get(choice)
+        if self.mode != "hybrid" or lexical_index is None:
+            return vector_results, []
+
+        with span("bm25.search", collection=choice, k=k):
+            lexical_results = [doc for doc, _ in lexical_index.search(query, k)]
+
+        return vector_results, lexical_results
+
+    def _cached(self, key: tuple, fetch) -> list:
+        """
+            returns the cached documents for key, otherwise runs fetch once even if several threads ask for the same key
+        """
+        with self.lock:
+            if self.version_fn is not None:
+                version = self.version_fn()
+                if version != self.version:
+                    if self.version is not None and self.lexical_indexes:
+                        self.lexical_indexes = self.lexical_loader() #pick up the BM25 indexes of the new build
+                    self.cache.clear()
+                    self.version = version
+
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                self.logger.info("Retrieval cache hit")
+                return list(self.cache[key])
+
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.in_flight[key] = future
+                version = self.version
+                self.misses += 1
+            else:
+                self.shared += 1
+
+        if not owner:
+            self.logger.info("Waiting on identical in-flight retrieval")
+            return list(future.result())
+
+        try:
+            docs = fetch()
+            future.set_result(docs)
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+
+        current = self.version_fn() if self.version_fn is not None else None #the index may have been rebuilt while fetching
+
+        with self.lock:
+            if version == self.version == current and self.cache_size > 0: #do not cache results fetched against an older index
+                self.cache[key] = docs
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        return list(docs)
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses + self.shared
+            return {
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "shared" : self.shared,
+                "hit_rate" : (self.hits + self.shared) / total if total else 0.0,
+                "size" : len(self.cache),
+                "max_entries" : self.cache_size,
+                "fan_outs" : self.fan_outs,
+            }
+
+
+def merge_by_score(result_lists: list[list[tuple]], k: int) -> list:
+    """
+        merges (document, relevance score) lists of several collections, best score first, duplicates dropped
+    """
+    best: dict[tuple, tuple] = {}
+
+    for results in result_lists:
+        for doc, score in results:
+            key = doc_key(doc)
+            score = score if score is not None else float("-inf")
+            if key not in best or score > best[key][1]:
+                best[key] = (doc, score)
+
+    return [doc for doc, _ in sorted(best.values(), key=lambda item: item[1], reverse=True)[:k]]
 
 
 def route_query(query: str) -> str:
-    listings_keywords = ["list", "listed", "company", "ticker", "symbol", "nyse", "nasdaq", "iex", "cboe"]
-    market_keywords = ["market", "performance", "trend", "return", "gain", "loss", "index", "s&p"]
+    """
+        keyword fallback used when no EmbeddingRouter is configured, keywords only match whole words
+    """
+    listings_keywords = {"list", "listed", "listing", "company", "ticker", "symbol", "nyse", "nasdaq", "iex", "cboe"}
+    market_keywords = {"market", "performance", "trend", "return", "gain", "loss", "index", "s&p"}
 
-    q = query.lower()
-    if any(word in q for word in listings_keywords):
+    words = set(re.findall(r"[a-z0-9&]+", query.lower()))
+    if words & listings_keywords:
         return "listing"
-    elif any(word in q for word in market_keywords):
+    elif words & market_keywords:
         return "market"
     else:
-        return "market"
\ No newline at end of file
+        return "market"
@@ -0,0 +1,58 @@
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Optional
+
+from langchain_core.runnables import RunnableConfig
+
+from apps.chat.rag.budget import LLM_TOKEN_BUDGET
+
+if TYPE_CHECKING:
+    from langchain_core.runnables import Runnable
+    from langchain_core.tools import BaseTool
+    from langgraph.graph.state import CompiledStateGraph
+    from apps.chat.rag.answer_cache import SemanticAnswerCache
+    from apps.chat.rag.checkpoints import SessionCheckpointer
+    from apps.chat.rag.gateway import LLMGateway
+    from apps.chat.rag.intent import IntentClassifier
+    from apps.chat.rag.listing_index import ListingIndex
+    from apps.chat.rag.router import RouterRetriever
+
+
+#This is the Agent Runtime
+#It carries everything a run of the graph needs besides its state: the LLM with tools bound, the system prompt, the tools,
+#the retriever, the listing index and the compiled graph. It is passed to the nodes and tools through the LangGraph config instead of module
+#globals, so several runtimes can exist side by side and concurrent runs never share mutable state.
+@dataclass
+class AgentRuntime:
+    llm_model: "Runnable"
+    sys_prompt: str
+    tools_dict: dict[str, "BaseTool"]
+    retriever: Optional["RouterRetriever"] = None
+    listing_index: Optional["ListingIndex"] = None
+    graph: Optional["CompiledStateGraph"] = None
+    session_graph: Optional["CompiledStateGraph"] = None #the same graph with the checkpointer, for runs of a chat session
+    checkpointer: Optional["SessionCheckpointer"] = None
+    answer_cache: Optional["SemanticAnswerCache"] = None
+    gateway: Optional["LLMGateway"] = None #admission control for LLM calls, shared by every run of the process
+    intent_classifier: Optional["IntentClassifier"] = None #answers greetings and off-topic messages without the LLM
+    graph_mode: str = "agent" #topology the graph was built with, see build_graph.GRAPH_MODES
+    answer_model: Optional["Runnable"] = None #the LLM with tool calls disabled, answers once max_tool_calls is reached
+    max_tool_calls: int = 3
+    token_budget: int = LLM_TOKEN_BUDGET #prompt tokens a single LLM call may send
+
+    def config(self, **configurable) -> RunnableConfig:
+        """
+            returns the LangGraph config for one run of the graph with this runtime
+        """
+        return {"configurable" : {"runtime" : self, **configurable}}
+
+
+def get_runtime(config: RunnableConfig | None) -> AgentRuntime:
+    """
+        returns the AgentRuntime of the current run from its config
+    """
+    runtime = (config or {}).get("configurable", {}).get("runtime")
+
+    if runtime is None:
+        raise RuntimeError("Agent runtime missing from the run config. Did you call init_rag()?")
+
+    return runtime
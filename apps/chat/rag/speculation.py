@@ -0,0 +1,109 @@
+import contextvars
+import os
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from apps.chat.rag.answer_cache import normalize_question
+from config.logger import get_logger
+from config.tracing import add_counts, span
+
+logger = get_logger(__name__)
+
+SPECULATION_ENABLED = os.getenv("RAG_SPECULATIVE_RETRIEVAL", "1") != "0"
+SPECULATION_WORKERS = int(os.getenv("RAG_SPECULATION_WORKERS", "4")) #speculative lookups running at once, per process
+STRING_THRESHOLD = float(os.getenv("RAG_SPECULATION_STRING_THRESHOLD", "0.8")) #difflib ratio of the normalised queries
+EMBEDDING_THRESHOLD = float(os.getenv("RAG_SPECULATION_EMBEDDING_THRESHOLD", "0.9")) #cosine similarity of the queries
+
+_pool = ThreadPoolExecutor(max_workers=SPECULATION_WORKERS, thread_name_prefix="speculate")
+
+
+class SpeculativeRetrieval:
+    """
+        A retriever lookup of the raw user input started before the first LLM call, so the search runs while the LLM
+        decides which tool to call. retriever_tool takes its documents when the LLM's query is close enough to the
+        user input (string ratio >= STRING_THRESHOLD, else cosine similarity >= EMBEDDING_THRESHOLD) and searches
+        normally otherwise.
+        Counts in the request's trace totals (and so in /chat/metrics):
+            speculative_retrievals  lookups started
+            speculation_hits        lookups a tool call used
+            speculation_saved_ms    retrieval time that overlapped the LLM call instead of following it
+            speculation_cancelled   unused lookups stopped before they started
+            speculation_wasted      unused lookups that ran anyway (a running future cannot be cancelled)
+            speculation_wasted_ms   retrieval time those spent, up to the end of the run for lookups still running
+    """
+
+    def __init__(self, retriever, query: str, embeddings: Embeddings | None = None):
+        self.query = query
+        self.embeddings = embeddings
+        self.used = False
+        self.started_at = None
+        self.finished_in = None
+
+        add_counts(speculative_retrievals=1)
+        context = contextvars.copy_context() #keeps the lookup's spans in the request's trace
+        self.future: Future = _pool.submit(context.run, self._retrieve, retriever, query)
+
+    def _retrieve(self, retriever, query: str) -> list:
+        self.started_at = time.perf_counter()
+        with span("retriever.speculative"):
+            docs = retriever.get_relevant_documents(query)
+        self.finished_in = time.perf_counter() - self.started_at
+        return docs
+
+    def matches(self, query: str) -> bool:
+        normalized, speculated = normalize_question(query), normalize_question(self.query)
+        if normalized == speculated or SequenceMatcher(None, normalized, speculated).ratio() >= STRING_THRESHOLD:
+            return True
+
+        if self.embeddings is None:
+            return False
+
+        vectors = np.asarray([self.embeddings.embed_query(text) for text in (query, self.query)], dtype=np.float32) #served from the embedding cache, the router embeds the same texts
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        return float(vectors[0] @ vectors[1]) >= EMBEDDING_THRESHOLD
+
+    def take(self, query: str) -> list | None:
+        """
+            returns the speculated documents if query matches the speculated one and the lookup succeeded, else None
+        """
+        if not self.matches(query):
+            logger.info(f"Speculative retrieval not used, tool query '{query}' differs from the user input")
+            return None
+
+        start = time.perf_counter()
+        try:
+            docs = self.future.result()
+        except Exception as e:
+            logger.warning(f"Speculative retrieval failed, searching again: {e}")
+            return None
+        waited = time.perf_counter() - start
+
+        saved_ms = max((self.finished_in or 0.0) - waited, 0.0) * 1000 #the part of the search hidden behind the LLM call
+        self.used = True
+        add_counts(speculation_hits=1, speculation_saved_ms=round(saved_ms))
+        logger.info(f"Speculative retrieval used, saved {saved_ms:.0f} ms")
+
+        return docs
+
+    def discard(self):
+        """
+            called when the run ends, stops the lookup if it never started and records the work wasted otherwise
+        """
+        if self.used:
+            return
+
+        if self.future.cancel():
+            add_counts(speculation_cancelled=1)
+            return
+
+        if self.finished_in is not None:
+            wasted = self.finished_in
+        else: #still searching, it keeps a worker busy until it is done
+            wasted = time.perf_counter() - self.started_at if self.started_at is not None else 0.0
+
+        add_counts(speculation_wasted=1, speculation_wasted_ms=round(wasted * 1000))
+        logger.info(f"Speculative retrieval not used, {wasted * 1000:.0f} ms of retrieval wasted")
@@ -1,18 +1,15 @@
 from langchain.tools import tool
-from typing import TypedDict
+from langchain_core.runnables import RunnableConfig
+from apps.chat.rag.budget import TOOL_TOKEN_BUDGET, count_tokens, dedupe_chunks, extract_relevant, share_budget
+from apps.chat.rag.listing_index import format_rows
+from apps.chat.rag.runtime import get_runtime
 from config.logger import get_logger
 
 
-MAX_TOOL_CALLS = 3
-
 logger = get_logger(__name__)
 
-retriever = None
-
-current_state: dict = {}
-
 @tool
-def retriever_tool(query: str) -> str:
+def retriever_tool(query: str, config: RunnableConfig) -> str:
     """
         A tool that retrieves relevant data from documents stored in the vector database.
         Args:
@@ -22,27 +19,27 @@ def retriever_tool(query: str) -> str:
     """
     logger.info(f"Retriever tool started...")
 
-    global current_state
-
-    global retriever
+    retriever = get_runtime(config).retriever #config is injected by langchain and hidden from the LLM's tool schema
+    speculation = (config or {}).get("configurable", {}).get("speculation") #lookup of the user input started by run_agent
 
     if retriever is None:
         logger.warning("Retriever has not been initialized yet.")
         return "Retriever is not available"
-    
-    if current_state.get("tool_call_count", 0) > MAX_TOOL_CALLS:
-        logger.warning("Maximum tool calls reached - skipping tool execution")
-        return "Maximum tool calls reached. Answer based on the context available so far."
 
     try:
         results = []
-        docs = retriever.get_relevant_documents(query)
+        docs = speculation.take(query) if speculation is not None else None
+        if docs is None:
+            docs = retriever.get_relevant_documents(query)
+        docs = dedupe_chunks(docs) #drops repeated chunks and the text the splitter overlaps between them
+        budgets = share_budget([count_tokens(doc.page_content) for doc in docs], TOOL_TOKEN_BUDGET) #the reranker already kept docs within it, those pass unchanged
         # if we want to limit the number of documents, change to for i, doc in enumerate(docs[:n]): where n is the max documents to loop through
         for i, doc in enumerate(docs): #enumerate returns a list of LangChain Document objects and its index, which in this for loop is doc and i respectively
             source = doc.metadata.get("source", "unknown")
             page = doc.metadata.get("page", "N/A")
-            results.append(f"Document {i+1} (source: {source}, page: {page}):\n{doc.page_content}")
-        
+            results.append(f"[{i+1}] {source} p.{page}: {extract_relevant(doc.page_content, query, budgets[i])}")
+
+        logger.info(f"Retriever tool returned {len(docs)} documents (~{sum(count_tokens(r) for r in results)} tokens)")
         logger.info(f"Retriever tool completed its task")
         
         return "\n\n".join(results)
@@ -52,7 +49,35 @@ def retriever_tool(query: str) -> str:
         
         return f"Retriever tool failed due to: {e}"
 
+@tool
+def listing_lookup(query: str, config: RunnableConfig) -> str:
+    """
+        A tool that looks up exchange listings (NASDAQ, NYSE) by ticker symbol or company name.
+        Use it for questions like "Is X listed on NASDAQ?" or "What is the ticker of X?" before searching the documents.
+        Args:
+            query: str = a ticker symbol (e.g. AAPL) or a company name or the start of one (e.g. Apple)
+        returns:
+            str: matching listings with symbol, company name, exchange and country
+    """
+    logger.info(f"Listing lookup started...")
+
+    listing_index = get_runtime(config).listing_index
+
+    if listing_index is None:
+        logger.warning("Listing index has not been built yet.")
+        return "Listing lookup is not available, use retriever_tool instead."
+
+    rows = listing_index.lookup(query)
+
+    if not rows:
+        return f"No listing found for '{query}' on the exchanges in the documents."
+
+    logger.info(f"Listing lookup found {len(rows)} listings")
+
+    return format_rows(rows)
+
 #declare tools dictionary for graph
 tools_dict = {
-    "retriever_tool" : retriever_tool
+    "retriever_tool" : retriever_tool,
+    "listing_lookup" : listing_lookup,
 }
\ No newline at end of file
@@ -31,21 +31,77 @@ form.addEventListener("submit", async (e) => {
 
     try {
 
-        const response = await fetch("/chat/send_message/", {
+        const response = await fetch("/chat/stream_message/", {
             method: "POST",
             headers: {"Content-Type" : "application/json"},
             body: JSON.stringify({message: userInput})
         });
-        const data = await response.json();
+
+        if (!response.ok || !response.body) {
+            const data = await response.json();
+            throw new Error(data.error || response.statusText);
+        }
 
         const typingBubble = document.getElementById(typingId);
+        let reply = "";
+
+        //Server-Sent Events over a POST request: read the body stream and split it into "event:/data:" blocks
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = "";
+
+        while (true) {
+            const {value, done} = await reader.read();
+            if (done) break;
+
+            buffer += decoder.decode(value, {stream: true});
+            const blocks = buffer.split("\n\n");
+            buffer = blocks.pop();
+
+            for (const block of blocks) {
+                const event = parseEvent(block);
+                if (!event) continue;
+
+                if (event.name === "token") {
+                    reply += event.data.text;
+                    typingBubble.textContent = reply;
+                } else if (event.name === "reset") {
+                    reply = "";
+                } else if (event.name === "tool_start") {
+                    if (!reply) typingBubble.textContent = "FranzAI is searching the documents...";
+                } else if (event.name === "done") {
+                    reply = event.data.reply;
+                } else if (event.name === "error") {
+                    throw new Error(event.data.error);
+                }
+            }
+            chatBox.scrollTop = chatBox.scrollHeight;
+        }
+
         if (typingBubble) typingBubble.remove();
 
-        addMessage("ai", data.reply);
+        addMessage("ai", reply);
 
 
     } catch (err) {
+        const typingBubble = document.getElementById(typingId);
+        if (typingBubble) typingBubble.remove();
+
         chatBox.innerHTML += `<div><strong>Error:</strong> ${err}</div>`;
     }
 
-});
\ No newline at end of file
+});
+
+function parseEvent(block) {
+    let name = "message";
+    let data = "";
+
+    for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) name = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+    }
+
+    if (!data) return null;
+
+    return {name: name, data: JSON.parse(data)};
+}
@@ -1,3 +1,941 @@
-from django.test import TestCase
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TransactionTestCase
+from django.utils import timezone
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding, Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.tools import tool
+
+from apps.chat import history
+from apps.chat.history import load_history
+from apps.chat.models import ChatMessage
+from apps.chat import persistence
+from apps.chat.persistence import WriteBehindQueue, save_messages
+from apps.chat.rag import agent, build_graph, graph, pdfloader
+from apps.chat.rag.answer_cache import SemanticAnswerCache
+from apps.chat.rag.budget import fit_messages, message_tokens, share_budget
+from apps.chat.rag.checkpoints import SessionCheckpointer
+from apps.chat.rag.embeddings import CachedEmbeddings, EmbeddingCache
+from apps.chat.rag.gateway import LLMGateway, LLMOverloaded
+from apps.chat.rag.graph import TOOL_LIMIT_REPLY
+from apps.chat.rag.intent import INTENT_REPLIES, IntentClassifier
+from apps.chat.rag.lexical import BM25Index
+from apps.chat.rag.listing_index import LISTING_INDEX_FILE, ListingIndex, parse_listing
+from apps.chat.rag.manifest import IngestManifest
+from apps.chat.rag.reranker import CrossEncoderReranker
+from apps.chat.rag.router import EmbeddingRouter, RouterRetriever, merge_by_score, route_query
+from apps.chat.rag.runtime import AgentRuntime
+from apps.chat.rag.speculation import SpeculativeRetrieval
+from config.tracing import Trace, TraceWriter
+from scripts.fake_llm import ScriptedChatModel
+
+#lines of the listing pdfs as pypdf extracts them, 6.0.0 glues cells and wraps countries, later versions space them
+#(trailing spaces matter: a line that ends with one wrapped between words)
+NYSE_HEADER = ["Stock ", "name Symbol", "Country ", "of ", "origin"]
+NYSE_PYPDF_600 = NYSE_HEADER + [
+    "10X ", "Capital ", "Venture ", "Acquisiti", "on Corp. ", "III", "VCXB United ", "States",
+    "3D ", "Systems ", "Corporati", "on", "DDD United ", "States",
+    "3M ", "CompanyMMM United ", "States",
+    "A. O. ", "Smith ", "Corporati", "on", "AOS US",
+    "ABB LTD.ABB Switzerlan", "d",
+    "Adecoa", "gro S.A.AGRO Argentina",
+    "Amira ", "Nature ", "Foods Ltd", "ANFI", "United ", "Arab ", "Emirates",
+    "AquaVe", "nture ", "Holdings ", "Ltd.", "WAAS", "British ", "Virgin ", "Islands",
+    "AramarkARMK US",
+    "Atento SAATTO Luxembou", "rg",
+    "BHP BBL & B", "HP", "United ", "Kingdom",
+]
+NYSE_PYPDF_620 = NYSE_HEADER + [
+    "10X ", "Capital ", "Venture ", "Acquisiti", "on Corp. ", "III", "VCXB United States",
+    "3D ", "Systems ", "Corporati", "on", "DDD United States",
+    "3M ", "Company MMM United States",
+    "A. O. ", "Smith ", "Corporati", "on", "AOS US",
+    "ABB LTD. ABB Switzerland",
+    "Adecoa", "gro S.A. AGRO Argentina",
+    "Amira ", "Nature ", "Foods Ltd", "ANFI", "United ", "Arab ", "Emirates",
+    "AquaVe", "nture ", "Holdings ", "Ltd.", "WAAS", "British ", "Virgin ", "Islands",
+    "Aramark ARMK US",
+    "Atento SA ATTO Luxembourg",
+    "BHP BBL & BHP United Kingdom",
+]
+NYSE_EXPECTED = [
+    ("VCXB", "10X Capital Venture Acquisition Corp. III", "United States"),
+    ("DDD", "3D Systems Corporation", "United States"),
+    ("MMM", "3M Company", "United States"),
+    ("AOS", "A. O. Smith Corporation", "US"),
+    ("ABB", "ABB LTD.", "Switzerland"),
+    ("AGRO", "Adecoagro S.A.", "Argentina"),
+    ("ANFI", "Amira Nature Foods Ltd", "United Arab Emirates"),
+    ("WAAS", "AquaVenture Holdings Ltd.", "British Virgin Islands"),
+    ("ARMK", "Aramark", "US"),
+    ("ATTO", "Atento SA", "Luxembourg"),
+    ("BHP", "BHP BBL &", "United Kingdom"),
+]
+
+NASDAQ_PYPDF_600 = [
+    "Symbol Security Name",
+    "AAPL Apple Inc. - Common Stock",
+    "ABP Abpro Holdings, Inc - Common Stock",
+    "ABPWWAbpro Holdings, Inc - Warrant",
+    "ABLLL Abacus Global Management, Inc. - 9.875% Fixed Rate Senior Notes due 2028",
+]
+NASDAQ_PYPDF_620 = [line.replace("ABPWWAbpro", "ABPWW Abpro") for line in NASDAQ_PYPDF_600]
+NASDAQ_EXPECTED = [
+    ("AAPL", "Apple Inc. - Common Stock"),
+    ("ABP", "Abpro Holdings, Inc - Common Stock"),
+    ("ABPWW", "Abpro Holdings, Inc - Warrant"),
+    ("ABLLL", "Abacus Global Management, Inc. - 9.875% Fixed Rate Senior Notes due 2028"),
+]
+
+
+class ListingParserTests(SimpleTestCase):
+    def test_nyse_rows_from_both_pypdf_layouts(self):
+        for lines in (NYSE_PYPDF_600, NYSE_PYPDF_620):
+            rows = parse_listing(lines, "NYSE")
+            self.assertEqual([(row["symbol"], row["name"], row["country"]) for row in rows], NYSE_EXPECTED)
+
+    def test_nasdaq_rows_from_both_pypdf_layouts(self):
+        for lines in (NASDAQ_PYPDF_600, NASDAQ_PYPDF_620):
+            rows = parse_listing(lines, "NASDAQ")
+            self.assertEqual([(row["symbol"], row["name"]) for row in rows], NASDAQ_EXPECTED)
+
+    def test_lookup_finds_rows_ending_in_multi_word_countries(self):
+        index = ListingIndex(parse_listing(NYSE_PYPDF_620, "NYSE") + parse_listing(NASDAQ_PYPDF_620, "NASDAQ"))
+
+        self.assertEqual(index.lookup("MMM")[0]["name"], "3M Company")
+        self.assertEqual(index.lookup("vcxb")[0]["country"], "United States")
+        self.assertEqual(index.lookup("Amira Nature")[0]["symbol"], "ANFI")
+        self.assertEqual(index.lookup("ABPWW")[0]["exchange"], "NASDAQ")
+
+    def test_rows_ending_on_an_unknown_country_are_reported(self):
+        lines = NYSE_HEADER + ["Mauritius ", "Holdings LtdMAUR Mauritius", "3M ", "Company MMM United States"]
+
+        with self.assertLogs("apps.chat.rag.listing_index", "WARNING") as logs:
+            rows = parse_listing(lines, "NYSE")
+
+        self.assertEqual([row["symbol"] for row in rows], ["MMM"])
+        self.assertIn("Holdings LtdMAUR Mauritius", logs.output[0])
+
+    def test_known_layouts_report_nothing(self):
+        with self.assertNoLogs("apps.chat.rag.listing_index", "WARNING"):
+            parse_listing(NYSE_PYPDF_600, "NYSE")
+            parse_listing(NYSE_PYPDF_620, "NYSE")
+
+    def test_index_build_reuses_pages_parsed_by_the_sync(self):
+        parsed_by_pool = []
+
+        def parse(pdf_paths):
+            for name in pdf_paths:
+                parsed_by_pool.append(name)
+                yield name, [Document(page_content="\n".join(NASDAQ_PYPDF_620))]
+
+        with tempfile.TemporaryDirectory() as tmp_dir, mock.patch.object(pdfloader, "iter_parsed_pdfs", parse):
+            pdf_dir, chroma_dir = Path(tmp_dir) / "pdfs", Path(tmp_dir) / "chroma"
+            pdf_dir.mkdir()
+            chroma_dir.mkdir()
+            for name in ("nasdaq_listing.pdf", "nyse_listing.pdf"):
+                (pdf_dir / name).write_bytes(b"")
+
+            pdfloader.build_listing_index(pdf_dir, chroma_dir, parsed={"nyse_listing.pdf" : [Document(page_content="\n".join(NYSE_PYPDF_620))]})
+            index = ListingIndex.load(chroma_dir / LISTING_INDEX_FILE)
+
+        self.assertEqual(parsed_by_pool, ["nasdaq_listing.pdf"])
+        self.assertEqual(len(index), len(NYSE_EXPECTED) + len(NASDAQ_EXPECTED))
+
+
+@tool
+def retriever_tool(query: str) -> str:
+    """returns a fixed search result"""
+    return f"results for {query}"
+
+
+class GreedyChatModel(BaseChatModel):
+    """
+        Asks for another tool call on every turn, even when told to stop. Like the chat API it rejects prompts holding
+        a tool call without its ToolMessage.
+    """
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return "greedy"
+
+    def bind_tools(self, tools: list, **kwargs) -> "GreedyChatModel":
+        return self
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+        for message in messages:
+            for tool_call in getattr(message, "tool_calls", None) or []:
+                if tool_call["id"] not in answered:
+                    raise ValueError(f"tool call {tool_call['id']} has no ToolMessage")
+
+        self.calls += 1
+        tool_call = {"name" : "retriever_tool", "args" : {"query" : "more"}, "id" : f"call_{self.calls}", "type" : "tool_call"}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="", tool_calls=[tool_call]))])
+
+
+class ToolLimitTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        llm = GreedyChatModel()
+        checkpointer = SessionCheckpointer(Path(tmp_dir.name) / "checkpoints.sqlite")
+        self.addCleanup(checkpointer.conn.close)
+
+        self.runtime = AgentRuntime(
+            llm_model=llm,
+            answer_model=llm, #ignores tool_choice="none" like a model that does not honour it
+            sys_prompt="You are a test assistant.",
+            tools_dict={"retriever_tool" : retriever_tool},
+            session_graph=build_graph.init_graph("agent", checkpointer),
+            checkpointer=checkpointer,
+            answer_cache=SemanticAnswerCache(DeterministicFakeEmbedding(size=16)),
+        )
+
+    def test_tool_limit_leaves_no_dangling_tool_calls(self):
+        reply = agent.run_agent(None, "What is a stock?", agent_runtime=self.runtime, session_id="session")
+
+        self.assertEqual(reply, TOOL_LIMIT_REPLY)
+        self.assertEqual(len(self.runtime.answer_cache.entries), 0) #a reply cut short by the tool limit is not cached
+
+        messages = self.runtime.session_graph.get_state(self.runtime.config(thread_id="session")).values["messages"]
+        answered = {m.tool_call_id for m in messages if isinstance(m, ToolMessage)}
+        requested = {tool_call["id"] for m in messages for tool_call in getattr(m, "tool_calls", None) or []}
+        self.assertLessEqual(requested, answered)
+
+        #the stored state is still valid input for the next turn of the session
+        self.assertEqual(agent.run_agent(None, "What is a bond?", agent_runtime=self.runtime, session_id="session"), TOOL_LIMIT_REPLY)
+
+
+class SessionCheckpointTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        self.checkpointer = SessionCheckpointer(Path(tmp_dir.name) / "checkpoints.sqlite")
+        self.addCleanup(self.checkpointer.conn.close)
+
+        self.runtime = AgentRuntime(
+            llm_model=ScriptedChatModel(pattern="direct", latency=0.0),
+            sys_prompt="You are a test assistant.",
+            tools_dict={"retriever_tool" : retriever_tool},
+            session_graph=build_graph.init_graph("agent", self.checkpointer),
+            checkpointer=self.checkpointer,
+        )
+
+    def stored(self, session_id: str = "session") -> list:
+        return self.runtime.session_graph.get_state(self.runtime.config(thread_id=session_id)).values["messages"]
+
+    def test_prune_history_keeps_the_last_turns(self):
+        with mock.patch.object(graph, "CHECKPOINT_TURNS", 2):
+            for i in range(4):
+                agent.run_agent(None, f"question {i}", agent_runtime=self.runtime, session_id="session")
+
+        self.assertEqual([m.content for m in self.stored()], ["question 2", "You asked: question 2", "question 3", "You asked: question 3"])
+        self.assertEqual(self.checkpointer.conn.execute("SELECT COUNT(*) FROM checkpoints WHERE thread_id = 'session'").fetchone()[0], 1)
+
+    def test_remember_turn_appends_to_the_stored_state(self):
+        agent.run_agent(None, "question 0", agent_runtime=self.runtime, session_id="session")
+        agent.remember_turn(self.runtime, "session", "Hello", "Hi!")
+
+        self.assertEqual([m.content for m in self.stored()], ["question 0", "You asked: question 0", "Hello", "Hi!"])
+
+    def test_concurrent_turns_of_a_session_are_both_kept(self):
+        self.runtime.llm_model = ScriptedChatModel(pattern="direct", latency=0.2) #both turns would read the same checkpoint
+        threads = [
+            threading.Thread(target=agent.run_agent, args=(None, f"question {i}"), kwargs={"agent_runtime" : self.runtime, "session_id" : "session"})
+            for i in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        questions = sorted(m.content for m in self.stored() if isinstance(m, HumanMessage))
+        self.assertEqual(questions, ["question 0", "question 1"])
+
+
+class ToolExecutionTests(SimpleTestCase):
+    def setUp(self):
+        self.release = threading.Event()
+        self.addCleanup(self.release.set) #lets an abandoned call finish
+
+        @tool
+        def slow_tool(seconds: float) -> str:
+            """waits, at most until the test ends"""
+            self.release.wait(seconds)
+            return f"waited {seconds}"
+
+        self.runtime = AgentRuntime(llm_model=None, sys_prompt="", tools_dict={"slow_tool" : slow_tool}, max_tool_calls=3)
+
+        for name, value in (("TOOL_TIMEOUT", 0.3), ("MAX_TOOL_CONCURRENCY", 2)):
+            patcher = mock.patch.object(graph, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def execute(self, *seconds: float, tool_call_count: int = 0) -> tuple[dict, dict]:
+        tool_calls = [{"name" : "slow_tool", "args" : {"seconds" : s}, "id" : f"call_{i}", "type" : "tool_call"} for i, s in enumerate(seconds)]
+        state = {"messages" : [AIMessage(content="", tool_calls=tool_calls)], "tool_call_count" : tool_call_count}
+
+        with mock.patch.object(graph, "add_counts") as add_counts:
+            update = graph.execute_tools(state, self.runtime.config())
+
+        return update, add_counts.call_args.kwargs
+
+    def test_tool_messages_keep_the_order_of_the_calls(self):
+        update, counts = self.execute(0.1, 0.0, 0.05)
+
+        self.assertEqual([m.tool_call_id for m in update["messages"]], ["call_0", "call_1", "call_2"])
+        self.assertEqual([m.content for m in update["messages"]], ["waited 0.1", "waited 0.0", "waited 0.05"])
+        self.assertEqual(update["tool_call_count"], 3)
+        self.assertEqual(counts["tool_timeouts"], 0)
+
+    def test_slow_call_becomes_a_timeout_error(self):
+        update, counts = self.execute(0.0, 5.0)
+
+        self.assertEqual([m.status for m in update["messages"]], ["success", "error"])
+        self.assertIn("timed out", update["messages"][1].content)
+        self.assertEqual((counts["tool_timeouts"], counts["tool_calls_abandoned"]), (1, 1))
+
+    def test_calls_over_budget_are_skipped(self):
+        update, counts = self.execute(0.0, 0.0, 0.0, tool_call_count=2)
+
+        self.assertEqual([m.content for m in update["messages"]][1:], ["Maximum tool calls reached. Answer based on the context available so far."] * 2)
+        self.assertEqual(update["tool_call_count"], 3)
+        self.assertEqual((counts["tool_calls"], counts["tool_calls_skipped"]), (1, 2))
+
+
+class TraceWriterTests(SimpleTestCase):
+    def test_traces_are_written_in_the_background_and_rotated(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "traces.jsonl"
+            writer = TraceWriter(path, max_bytes=1000)
+
+            for i in range(10):
+                trace = Trace(f"request {i}")
+                trace.add(llm_calls=1)
+                writer.put(trace)
+            writer.flush()
+
+            rotated = path.with_name("traces.jsonl.1")
+            lines = rotated.read_text().splitlines() + path.read_text().splitlines()
+
+            self.assertEqual([json.loads(line)["name"] for line in lines], [f"request {i}" for i in range(10)])
+            self.assertLessEqual(path.stat().st_size, 1000)
+            self.assertGreaterEqual(writer.stats()["rotations"], 1)
+            self.assertEqual(writer.stats()["written"], 10)
+
+    def test_full_queue_drops_traces(self):
+        writer = TraceWriter(Path("unused.jsonl"), max_size=1)
+
+        with mock.patch.object(writer, "_start"): #no writer thread, the queue stays full
+            writer.put(Trace("kept"))
+            writer.put(Trace("dropped"))
+
+        self.assertEqual(writer.stats()["dropped"], 1)
+
+
+class WriteBehindQueueTests(TransactionTestCase): #the queue writes from its own thread, outside a test transaction
+    def test_flush_writes_every_queued_message(self):
+        writer = WriteBehindQueue(batch_size=2, flush_interval=0.5)
+        writer.put([ChatMessage(session_id="flush", role="user", content=f"question {i}") for i in range(5)])
+
+        writer.flush() #what the atexit hook runs at shutdown
+
+        self.assertEqual(ChatMessage.objects.filter(session_id="flush").count(), 5)
+        self.assertEqual(writer.stats()["queued"], 0)
+        self.assertEqual(writer.stats()["written"], 5)
+        self.assertEqual(writer.stats()["batches"], 3)
+
+    def test_overflow_is_written_on_the_request_path(self):
+        writer = WriteBehindQueue(max_size=2, flush_interval=0.05)
+
+        with mock.patch.object(writer, "_start"), mock.patch.object(persistence, "chat_writer", writer): #no writer thread, the queue stays full
+            save_messages(*(ChatMessage(session_id="overflow", role="user", content=f"question {i}") for i in range(3)))
+
+            self.assertEqual(list(ChatMessage.objects.filter(session_id="overflow").values_list("content", flat=True)), ["question 2"])
+            self.assertEqual(writer.stats()["overflowed"], 1)
+            self.assertEqual(writer.stats()["queued"], 2)
+
+        writer._start()
+        self.assertTrue(writer.wait_written("overflow", timeout=5))
+        self.assertEqual(ChatMessage.objects.filter(session_id="overflow").count(), 3)
+
+
+class HistoryTests(TransactionTestCase): #the write-behind queue writes from its own thread, outside the test's transaction
+    def test_load_history_includes_queued_messages(self):
+        save_messages(
+            ChatMessage(session_id="queued", role="user", content="What is a stock?"),
+            ChatMessage(session_id="queued", role="agent", content="A share of a company."),
+        )
+
+        _, recent = load_history("queued")
+
+        self.assertEqual([m.content for m in recent], ["What is a stock?", "A share of a company."])
+
+    @mock.patch.object(history, "HISTORY_WINDOW", 2)
+    def test_late_written_message_is_still_summarized(self):
+        start = timezone.now()
+        for i in range(3):
+            ChatMessage.objects.create(session_id="late", role="user", content=f"question {i}", timestamp=start + timedelta(seconds=i))
+        load_history("late") #summarizes "question 0"
+
+        ChatMessage.objects.create(session_id="late", role="agent", content="late answer", timestamp=start) #queued first, written last
+        ChatMessage.objects.create(session_id="late", role="user", content="question 3", timestamp=start + timedelta(seconds=3))
+        summary, recent = load_history("late")
+
+        self.assertEqual(summary.splitlines(), ["user: question 0", "user: question 1", "user: question 2"])
+        self.assertEqual([m.content for m in recent], ["late answer", "question 3"])
+
+
+class BM25IndexTests(SimpleTestCase):
+    def test_load_reads_stored_postings(self):
+        texts = ["3M Company MMM NYSE United States", "Apple Inc. AAPL NASDAQ", "Berkshire Hathaway BRK.B NYSE"]
+        index = BM25Index(["a", "b", "c"], texts, [{"page" : i} for i in range(3)], version="v1")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = Path(tmp_dir) / "bm25.json"
+            index.save(path)
+            loaded = BM25Index.load(path)
+
+        self.assertEqual(loaded.doc_lengths, index.doc_lengths)
+        self.assertEqual(loaded.avg_length, index.avg_length)
+        self.assertEqual(
+            [(doc.id, score) for doc, score in loaded.search("brk.b nyse")],
+            [(doc.id, score) for doc, score in index.search("brk.b nyse")],
+        )
+
+
+class EmbeddingCacheTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.cache_dir = Path(tmp_dir.name)
+
+    def test_rows_are_read_while_another_process_appends(self):
+        cache = EmbeddingCache(self.cache_dir, "fake")
+        cache.put_many(["a", "b"], [[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+
+        with open(cache.vectors_path, "ab") as f: #half a row of an append whose index line is not written yet
+            f.write(b"\0" * 6)
+
+        reader = EmbeddingCache(self.cache_dir, "fake")
+        self.assertEqual(reader.get_many(["b", "a"]), {"b" : [4.0, 5.0, 6.0], "a" : [1.0, 2.0, 3.0]})
+
+    def test_queries_are_not_written_to_disk(self):
+        embeddings = CachedEmbeddings(DeterministicFakeEmbedding(size=8), EmbeddingCache(self.cache_dir, "fake"), query_cache_size=2)
+
+        embeddings.embed_query("what is a stock")
+        embeddings.embed_query("what is a bond")
+        embeddings.embed_query("what is an etf")
+
+        self.assertEqual(embeddings.embed_query("what is an etf"), embeddings.embeddings.embed_query("what is an etf"))
+        self.assertEqual(list(embeddings.queries), ["what is a bond", "what is an etf"]) #least recently used query evicted
+        self.assertEqual(embeddings.cache.rows, {})
+
+
+class AnswerCacheTests(SimpleTestCase):
+    def test_answers_are_reused_only_in_the_same_context(self):
+        cache = SemanticAnswerCache(DeterministicFakeEmbedding(size=16))
+        cache.store("What is its CEO?", "Tim Cook.", "v1", context="apple chat")
+
+        self.assertEqual(cache.lookup("what is its CEO", "v1", context="apple chat"), "Tim Cook.")
+        self.assertIsNone(cache.lookup("What is its CEO?", "v1", context="3m chat"))
+        self.assertIsNone(cache.lookup("What is its CEO?", "v1"))
+
+    def test_standalone_questions_are_shared_across_chats(self):
+        runtime = AgentRuntime(llm_model=None, sys_prompt="", tools_dict={}, answer_cache=SemanticAnswerCache(DeterministicFakeEmbedding(size=16)))
+        apple_chat = [ChatMessage(role="user", content="Tell me about Apple"), ChatMessage(role="agent", content="Apple makes the iPhone.")]
+        mmm_chat = [ChatMessage(role="user", content="Tell me about 3M"), ChatMessage(role="agent", content="3M makes Post-it notes.")]
+
+        for question, answer in (("What is AAPL's exchange?", "NASDAQ."), ("And its CEO?", "Tim Cook.")):
+            _, version, context = agent.cached_answer(runtime, question, apple_chat, "", None)
+            runtime.answer_cache.store(question, answer, version, context)
+
+        self.assertEqual(agent.cached_answer(runtime, "what is AAPL's exchange", mmm_chat, "", None)[0], "NASDAQ.")
+        self.assertIsNone(agent.cached_answer(runtime, "And its CEO?", mmm_chat, "", None)[0])
+        self.assertEqual(agent.cached_answer(runtime, "And its CEO?", apple_chat, "", None)[0], "Tim Cook.")
+
+    def test_only_complete_answers_are_cacheable(self):
+        tool_call = {"name" : "retriever_tool", "args" : {"query" : "AAPL"}, "id" : "call_1", "type" : "tool_call"}
+        turn = [HumanMessage(content="Where is AAPL listed?"), AIMessage(content="", tool_calls=[tool_call])]
+
+        answered = turn + [ToolMessage(tool_call_id="call_1", content="AAPL NASDAQ"), AIMessage(content="On NASDAQ.")]
+        failed = turn + [ToolMessage(tool_call_id="call_1", content="Tool retriever_tool timed out", status="error"), AIMessage(content="I don't know.")]
+        empty = turn + [ToolMessage(tool_call_id="call_1", content="AAPL NASDAQ"), AIMessage(content="")]
+
+        self.assertTrue(agent.cacheable({"messages" : answered}))
+        self.assertFalse(agent.cacheable({"messages" : failed}))
+        self.assertFalse(agent.cacheable({"messages" : empty}))
+        self.assertTrue(agent.cacheable({"messages" : failed + answered})) #failures of earlier turns of the session do not count
+
+
+class RateLimitError(Exception):
+    def __init__(self, retry_after: str):
+        super().__init__("rate limit reached")
+        self.status_code = 429
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after" : retry_after})
+
+
+class FlakyLLM:
+    """answers "ok" after failing the first calls with a 429"""
+
+    def __init__(self, failures: int, retry_after: str = "2"):
+        self.failures = failures
+        self.retry_after = retry_after
+
+    def invoke(self, messages, config=None):
+        if self.failures:
+            self.failures -= 1
+            raise RateLimitError(self.retry_after)
+        return AIMessage(content="ok")
+
+
+class LLMGatewayTests(SimpleTestCase):
+    def test_rejects_when_the_queue_is_full(self):
+        gateway = LLMGateway(max_concurrency=1, max_queue=0)
+        gateway._acquire(0) #the only slot is taken
+
+        with self.assertRaises(LLMOverloaded):
+            gateway.invoke(FlakyLLM(0), [])
+        self.assertEqual(gateway.stats()["rejected"], 1)
+
+    def test_times_out_waiting_for_a_slot(self):
+        gateway = LLMGateway(max_concurrency=1, max_queue=1, queue_timeout=0.05)
+        gateway._acquire(0)
+
+        with self.assertRaises(LLMOverloaded):
+            gateway.invoke(FlakyLLM(0), [])
+        self.assertEqual(gateway.stats()["timed_out"], 1)
+
+    def test_retries_after_retry_after_without_holding_the_slot(self):
+        gateway = LLMGateway(max_concurrency=1, max_retries=2)
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append((seconds, gateway.in_flight))
+
+        with mock.patch("apps.chat.rag.gateway.time.sleep", sleep):
+            result = gateway.invoke(FlakyLLM(2, retry_after="2"), [])
+
+        self.assertEqual(result.content, "ok")
+        self.assertEqual(len(sleeps), 2)
+        self.assertTrue(all(seconds >= 2 for seconds, _ in sleeps)) #jitter never retries before Retry-After
+        self.assertEqual([in_flight for _, in_flight in sleeps], [0, 0]) #the slot is free while backing off
+        self.assertEqual(gateway.stats()["in_flight"], 0)
+        self.assertEqual(gateway.stats()["retries"], 2)
+
+    def test_gives_up_after_max_retries(self):
+        gateway = LLMGateway(max_retries=1)
+
+        with mock.patch("apps.chat.rag.gateway.time.sleep"), self.assertRaises(RateLimitError):
+            gateway.invoke(FlakyLLM(5, retry_after="1"), [])
+        self.assertEqual(gateway.stats()["in_flight"], 0)
+
+
+class FitMessagesTests(SimpleTestCase):
+    def test_every_tool_call_keeps_its_tool_message(self):
+        chunk = "Apple Inc. AAPL is listed on NASDAQ. " + "The S&P 500 returned 26% in 2023. " * 60
+        messages = [
+            SystemMessage(content="You are FranzAI."),
+            SystemMessage(content="Here is the chat so far: " + "\n".join(f"user: question {i}" for i in range(100))),
+            HumanMessage(content="Where is Apple listed?"),
+        ]
+        for turn in range(3):
+            tool_calls = [
+                {"name" : "retriever_tool", "args" : {"query" : f"apple {turn} {i}"}, "id" : f"call_{turn}_{i}", "type" : "tool_call"}
+                for i in range(2)
+            ]
+            messages.append(AIMessage(content="", tool_calls=tool_calls))
+            messages.extend(ToolMessage(tool_call_id=call["id"], content=chunk) for call in tool_calls)
+
+        fitted = fit_messages(messages, max_tokens=600)
+
+        self.assertLessEqual(sum(message_tokens(m) for m in fitted), 600)
+        self.assertEqual([type(m) for m in fitted], [type(m) for m in messages])
+        self.assertEqual(fitted[-1].tool_call_id, messages[-1].tool_call_id)
+
+        answered = [m.tool_call_id for m in fitted if isinstance(m, ToolMessage)]
+        requested = [call["id"] for m in fitted if isinstance(m, AIMessage) for call in m.tool_calls]
+        self.assertEqual(answered, requested)
+        self.assertIn("AAPL", fitted[4].content) #results are cut to the sentences about the question
+
+
+class FakeVectorStore:
+    """the part of the Chroma API sync_vectorstore uses, chunks kept in a dict"""
+
+    def __init__(self):
+        self.texts: dict[str, str] = {}
+
+    def get(self, include=None) -> dict:
+        return {"ids" : list(self.texts)}
+
+    def delete(self, ids: list[str]):
+        for chunk_id in ids:
+            self.texts.pop(chunk_id, None)
+
+    def add_texts(self, texts: list[str], metadatas: list[dict], ids: list[str]):
+        self.texts.update(zip(ids, texts))
+
+
+class ManifestSyncTests(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+
+        self.pdf_dir = Path(tmp_dir.name) / "pdfs"
+        self.chroma_dir = Path(tmp_dir.name) / "chroma"
+        self.pdf_dir.mkdir()
+        self.chroma_dir.mkdir()
+
+        self.vectorstore = FakeVectorStore()
+        self.parsed: list[str] = []
+
+        def parse(pdf_paths):
+            for name, path in pdf_paths.items(): #the "pdfs" are text files, one page each
+                self.parsed.append(name)
+                yield name, [Document(page_content=path.read_text(), metadata={"source" : name, "page" : 0})]
+
+        patcher = mock.patch.object(pdfloader, "iter_parsed_pdfs", parse)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, name: str, text: str):
+        (self.pdf_dir / name).write_text(text)
+
+    def sync(self, chunk_size: int = 1000):
+        self.parsed = []
+        pdfloader.sync_vectorstore(self.vectorstore, self.pdf_dir, self.chroma_dir, chunk_size=chunk_size, chunk_overlap=0)
+        return IngestManifest.load(self.chroma_dir, pdfloader.ingest_settings(chunk_size, 0))
+
+    def test_unchanged_pdfs_are_skipped(self):
+        self.write("a.pdf", "Apple is listed on NASDAQ.")
+        self.write("b.pdf", "3M is listed on the NYSE.")
+        manifest = self.sync()
+
+        self.assertEqual(self.parsed, ["a.pdf", "b.pdf"])
+        self.assertEqual(sorted(self.vectorstore.texts), sorted(manifest.all_ids()))
+
+        self.sync()
+        self.assertEqual(self.parsed, [])
+
+    def test_changed_pdf_is_reingested(self):
+        self.write("a.pdf", "Apple is listed on NASDAQ.")
+        self.write("b.pdf", "3M is listed on the NYSE.")
+        old_ids = self.sync().ids_for("b.pdf")
+
+        self.write("b.pdf", "3M moved to another exchange.")
+        manifest = self.sync()
+
+        self.assertEqual(self.parsed, ["b.pdf"])
+        self.assertNotEqual(manifest.ids_for("b.pdf"), old_ids)
+        self.assertTrue(all(chunk_id not in self.vectorstore.texts for chunk_id in old_ids))
+        self.assertEqual(sorted(self.vectorstore.texts.values()), ["3M moved to another exchange.", "Apple is listed on NASDAQ."])
+
+    def test_deleted_pdf_is_purged(self):
+        self.write("a.pdf", "Apple is listed on NASDAQ.")
+        self.write("b.pdf", "3M is listed on the NYSE.")
+        self.sync()
+
+        (self.pdf_dir / "a.pdf").unlink()
+        manifest = self.sync()
+
+        self.assertEqual(list(manifest.files), ["b.pdf"])
+        self.assertEqual(list(self.vectorstore.texts.values()), ["3M is listed on the NYSE."])
+
+    def test_changed_settings_rebuild_everything(self):
+        self.write("a.pdf", "Apple is listed on NASDAQ.")
+        self.sync()
+        self.vectorstore.texts["untracked"] = "chunk of an older build"
+
+        manifest = self.sync(chunk_size=500)
+
+        self.assertEqual(self.parsed, ["a.pdf"])
+        self.assertEqual(sorted(self.vectorstore.texts), manifest.all_ids())
+
+    def test_identical_pdfs_keep_their_own_chunks(self):
+        self.write("a.pdf", "Apple is listed on NASDAQ.")
+        self.write("copy of a.pdf", "Apple is listed on NASDAQ.")
+        manifest = self.sync()
+
+        self.assertEqual(len(self.vectorstore.texts), 2)
+        self.assertNotEqual(manifest.ids_for("a.pdf"), manifest.ids_for("copy of a.pdf"))
+
+        (self.pdf_dir / "a.pdf").unlink()
+        manifest = self.sync()
+
+        self.assertEqual(list(self.vectorstore.texts), manifest.ids_for("copy of a.pdf"))
+        self.assertEqual(list(self.vectorstore.texts.values()), ["Apple is listed on NASDAQ."])
+
+
+class RerankTests(SimpleTestCase):
+    def test_rerank_does_not_modify_the_candidates(self):
+        docs = [Document(page_content=text, metadata={"page" : i}) for i, text in enumerate(["NYSE listing", "AAPL on NASDAQ"])]
+        reranker = CrossEncoderReranker()
+
+        with mock.patch.object(reranker, "score", return_value=[0.1, 0.9]): #no model download
+            results = reranker.rerank("AAPL", docs, top_n=2)
+
+        self.assertEqual([doc.metadata for doc in results], [{"page" : 1, "rerank_score" : 0.9}, {"page" : 0, "rerank_score" : 0.1}])
+        self.assertEqual([doc.metadata for doc in docs], [{"page" : 0}, {"page" : 1}]) #cached documents are left as they were
+
+    def test_share_budget_only_cuts_what_does_not_fit(self):
+        self.assertEqual(share_budget([100, 200, 300], 1200), [100, 200, 300])
+        self.assertEqual(share_budget([100, 900, 700], 1200), [100, 550, 550])
+        self.assertEqual(share_budget([], 1200), [])
+
+
+class BlockingRetriever:
+    """returns one document once released"""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def get_relevant_documents(self, query: str) -> list:
+        self.started.set()
+        self.release.wait(5)
+        return [Document(page_content=query)]
+
+
+class SpeculationTests(SimpleTestCase):
+    def test_unused_running_lookup_is_recorded_as_wasted(self):
+        retriever = BlockingRetriever()
+        self.addCleanup(retriever.release.set)
+
+        with mock.patch("apps.chat.rag.speculation.add_counts") as add_counts:
+            speculation = SpeculativeRetrieval(retriever, "Is Apple listed on NASDAQ?")
+            self.assertTrue(retriever.started.wait(5))
+            speculation.discard()
+
+        counts = {key : value for call in add_counts.call_args_list for key, value in call.kwargs.items()}
+        self.assertEqual(counts["speculative_retrievals"], 1)
+        self.assertEqual(counts["speculation_wasted"], 1)
+        self.assertIn("speculation_wasted_ms", counts)
+
+    def test_no_speculation_for_messages_outside_the_documents(self):
+        classifier = mock.Mock()
+        classifier.likely_in_scope.return_value = False
+        runtime = AgentRuntime(llm_model=None, sys_prompt="", tools_dict={}, retriever=BlockingRetriever(), intent_classifier=classifier)
+
+        with mock.patch("apps.chat.rag.agent.SPECULATION_ENABLED", True):
+            self.assertIsNone(agent.speculate(runtime, "Tell me a joke"))
+        classifier.likely_in_scope.assert_called_once_with("Tell me a joke")
+
+
+class KeywordEmbeddings(Embeddings):
+    """embeds a text as its counts of listing and market keywords, so routes are decided by the words of a query"""
+
+    AXES = ({"listed", "ticker", "symbol", "exchange"}, {"market", "return", "sector", "rally"})
+
+    def embed_query(self, text: str) -> list[float]:
+        words = re.findall(r"[a-z]+", text.lower())
+        return [float(sum(word in axis for word in words)) for axis in self.AXES] + [0.01]
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+class ScoredStore:
+    """a vectorstore returning fixed (document, relevance score) results, counting its searches"""
+
+    def __init__(self, results: list[tuple], delay: float = 0.0):
+        self.results = results
+        self.delay = delay
+        self.searches = 0
+        self.lock = threading.Lock()
+
+    def similarity_search_with_relevance_scores(self, query: str, k: int) -> list[tuple]:
+        with self.lock:
+            self.searches += 1
+        time.sleep(self.delay)
+        return self.results[:k]
+
+
+def scored_retriever(store: ScoredStore, k: int = 2) -> SimpleNamespace:
+    return SimpleNamespace(vectorstore=store, search_kwargs={"k" : k})
+
+
+def chunk(text: str) -> Document:
+    return Document(page_content=text, metadata={"source" : text, "page" : 0})
+
+
+class RouterTests(SimpleTestCase):
+    def setUp(self):
+        self.listing_store = ScoredStore([(chunk("AAPL NASDAQ"), 0.9), (chunk("MMM NYSE"), 0.5)])
+        self.market_store = ScoredStore([(chunk("S&P 500 returned 25%"), 0.7), (chunk("AAPL NASDAQ"), 0.95)])
+        router = EmbeddingRouter(KeywordEmbeddings(), {"listing" : ["Is it listed on an exchange?", "ticker symbol"], "market" : ["market return", "sector rally"]})
+        self.retriever = RouterRetriever(scored_retriever(self.listing_store), scored_retriever(self.market_store), mock.Mock(), query_router=router)
+
+    def test_confident_query_searches_one_collection(self):
+        self.assertEqual(self.retriever.route("Which exchange is Tesla listed on?"), ["listing"])
+        self.assertEqual(self.retriever.route("How was the market return this year?"), ["market"])
+        self.assertEqual(self.retriever.stats()["fan_outs"], 0)
+
+    def test_unsure_query_fans_out_and_merges_by_score(self):
+        docs = self.retriever.get_relevant_documents("Did listed stocks beat the market?")
+
+        self.assertEqual((self.listing_store.searches, self.market_store.searches), (1, 1))
+        self.assertEqual([doc.page_content for doc in docs], ["AAPL NASDAQ", "S&P 500 returned 25%"]) #the duplicate keeps its best score
+        self.assertEqual(self.retriever.stats()["fan_outs"], 1)
+
+    def test_merge_by_score_orders_by_score_and_drops_duplicates(self):
+        merged = merge_by_score([[(chunk("a"), 0.2), (chunk("b"), None)], [(chunk("c"), 0.8), (chunk("a"), 0.5)]], k=3)
+
+        self.assertEqual([doc.page_content for doc in merged], ["c", "a", "b"]) #unscored results go last
+
+    def test_keyword_fallback_matches_whole_words(self):
+        self.assertEqual(route_query("Is Apple listed on NASDAQ?"), "listing")
+        self.assertEqual(route_query("Give me the list of NYSE companies"), "listing")
+        self.assertEqual(route_query("What does a market specialist do?"), "market") #"specialist" is not "list"
+        self.assertEqual(route_query("Ask a specialist"), "market")
+
+
+class RetrievalCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.store = ScoredStore([(chunk("AAPL NASDAQ"), 0.9)], delay=0.2)
+        self.version = "v1"
+        self.retriever = RouterRetriever(scored_retriever(self.store), scored_retriever(ScoredStore([])), mock.Mock(), version_fn=lambda: self.version)
+
+    def test_concurrent_identical_lookups_search_once(self):
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.retriever.get_relevant_documents("Is Apple listed?"))) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.store.searches, 1)
+        self.assertEqual([[doc.page_content for doc in docs] for docs in results], [["AAPL NASDAQ"]] * 4)
+        self.assertEqual(self.retriever.stats()["misses"], 1)
+        self.assertEqual(self.retriever.stats()["shared"] + self.retriever.stats()["hits"], 3)
+
+    def test_index_version_change_clears_the_cache(self):
+        self.store.delay = 0.0
+        self.retriever.get_relevant_documents("Is Apple listed?")
+        self.retriever.get_relevant_documents("Is Apple listed?")
+        self.assertEqual((self.store.searches, self.retriever.stats()["hits"]), (1, 1))
+
+        self.version = "v2"
+        self.retriever.get_relevant_documents("Is Apple listed?")
+        self.assertEqual(self.store.searches, 2)
+
+    def test_results_fetched_against_an_old_version_are_not_stored(self):
+        search = self.store.similarity_search_with_relevance_scores
+
+        def search_during_rebuild(query: str, k: int) -> list[tuple]:
+            self.version = "v2" #build_index finished while chroma was searched
+            return search(query, k)
+
+        self.store.similarity_search_with_relevance_scores = search_during_rebuild
+        self.retriever.get_relevant_documents("Is Apple listed?")
+
+        self.assertEqual(self.retriever.stats()["size"], 0)
+
+
+class RetrieveFirstTests(SimpleTestCase):
+    def run_graph(self, pattern: str, max_tool_calls: int = 3) -> tuple[dict, int]:
+        llm = ScriptedChatModel(pattern=pattern, latency=0.0)
+        runtime = AgentRuntime(
+            llm_model=llm,
+            answer_model=llm,
+            sys_prompt="You are a test assistant.",
+            tools_dict={"retriever_tool" : retriever_tool},
+            graph=build_graph.init_graph("retrieve_first"),
+            graph_mode="retrieve_first",
+            max_tool_calls=max_tool_calls,
+        )
+
+        with mock.patch.object(graph, "add_counts") as add_counts:
+            final_state = runtime.graph.invoke(agent.build_input_state([], "What was the S&P 500 return?"), config=runtime.config())
+
+        llm_calls = sum(call.kwargs.get("llm_calls", 0) for call in add_counts.call_args_list)
+        return final_state, llm_calls
+
+    def test_factual_question_takes_one_llm_call(self):
+        final_state, llm_calls = self.run_graph("direct")
+
+        self.assertEqual(llm_calls, 1)
+        self.assertEqual(final_state["tool_call_count"], 1)
+        self.assertEqual(final_state["messages"][-1].content, "Based on the documents: results for What was the S&P 500 return?")
+
+    def test_prefetch_counts_against_the_tool_budget(self):
+        final_state, llm_calls = self.run_graph("sequential", max_tool_calls=1) #would search again with budget left
+
+        self.assertEqual(llm_calls, 1)
+        self.assertEqual(final_state["tool_call_count"], 1)
+        self.assertEqual(sum(isinstance(m, ToolMessage) for m in final_state["messages"]), 1)
+
+    def test_falls_back_to_the_agent_loop_for_more_tools(self):
+        final_state, llm_calls = self.run_graph("sequential")
+
+        self.assertEqual(llm_calls, 2)
+        self.assertEqual(final_state["tool_call_count"], 2)
+        self.assertEqual(sum(isinstance(m, ToolMessage) for m in final_state["messages"]), 2)
+        self.assertFalse(final_state["messages"][-1].tool_calls)
+
+
+class IntentEmbeddings(KeywordEmbeddings):
+    AXES = ({"hello", "hi", "hey", "morning"}, {"thanks", "thank", "bye"}, {"weather", "poem", "joke", "recipe"}, {"listed", "nasdaq", "stock", "market"})
+
+
+INTENT_TEST_EXEMPLARS = {
+    "greeting" : ["Hello", "Hi there", "Good morning"],
+    "thanks" : ["Thanks", "Bye"],
+    "off_topic" : ["Tell me a joke", "What is the weather like?"],
+    "in_scope" : ["Is Apple listed on NASDAQ?", "How did the stock market do?"],
+}
+
+
+class IntentFastPathTests(SimpleTestCase):
+    def setUp(self):
+        self.runtime = AgentRuntime(
+            llm_model=ScriptedChatModel(pattern="direct", latency=0.0),
+            sys_prompt="You are a test assistant.",
+            tools_dict={"retriever_tool" : retriever_tool},
+            graph=build_graph.init_graph("agent"),
+            intent_classifier=IntentClassifier(IntentEmbeddings(), INTENT_TEST_EXEMPLARS),
+        )
+
+    def test_greeting_is_answered_without_the_llm(self):
+        with mock.patch.object(agent, "add_counts") as add_counts:
+            reply = agent.run_agent(None, "Hello there", agent_runtime=self.runtime)
+
+        self.assertEqual(reply, INTENT_REPLIES["greeting"])
+        add_counts.assert_called_once_with(llm_calls_avoided=1)
+        self.assertEqual(self.runtime.intent_classifier.stats()["llm_calls_avoided"], 1)
+
+    def test_message_below_the_margin_goes_to_the_graph(self):
+        reply = agent.run_agent([], "Hello, is Apple listed?", agent_runtime=self.runtime)
+
+        self.assertEqual(reply, "You asked: Hello, is Apple listed?")
+        self.assertEqual(self.runtime.intent_classifier.stats()["passed_to_agent"], 1)
+        self.assertEqual(self.runtime.intent_classifier.stats()["llm_calls_avoided"], 0)
+
+    def test_fast_path_can_be_turned_off(self):
+        env = {"RAG_INTENT_FAST_PATH" : "0", "RAG_ROUTER" : "keyword", "RAG_ANSWER_CACHE" : "0", "RAG_RERANK" : "0"}
+
+        with mock.patch.dict(os.environ, env), mock.patch.object(agent, "runtime"), mock.patch.object(agent, "CHECKPOINTS_ENABLED", False), \
+                mock.patch.object(agent, "SPECULATION_ENABLED", False), \
+                mock.patch.object(pdfloader, "init_retriever", return_value=(mock.Mock(), mock.Mock())), \
+                mock.patch.object(pdfloader, "init_lexical_indexes", return_value={}), \
+                mock.patch.object(pdfloader, "load_listing_index", return_value=None):
+            runtime = agent.init_rag(llm=ScriptedChatModel(pattern="direct", latency=0.0), graph_mode="agent")
+            reply = agent.run_agent([], "Hello there", agent_runtime=runtime)
+
+        self.assertIsNone(runtime.intent_classifier)
+        self.assertEqual(reply, "You asked: Hello there")
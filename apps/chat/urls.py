@@ -4,4 +4,7 @@ from . import views
 urlpatterns = [
     path('', views.rag_agent_home, name='rag_agent_home'),
     path('send_message/', views.send_message, name='send_message'),
+    path('stream_message/', views.stream_message, name='stream_message'),
+    path('cache_stats/', views.cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics, name='metrics'),
 ]
\ No newline at end of file
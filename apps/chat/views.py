@@ -1,14 +1,24 @@
 import json
+import time
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.shortcuts import render
-from django.http import HttpResponse, JsonResponse
-from apps.chat.rag.agent import run_agent, init_rag
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from apps.chat.rag import agent
+from apps.chat.rag.agent import run_agent, init_rag, astream_agent
+from apps.chat.rag.checkpoints import SessionBusy
+from apps.chat.rag.gateway import LLMOverloaded
+from apps.chat.history import load_history
 from apps.chat.models import ChatMessage
+from apps.chat.persistence import asave_messages, chat_writer, save_messages
 from config.logger import get_logger
+from config import tracing
+from config.tracing import span
 
 
 logger = get_logger(__name__)
 
+#serve mode only opens the index built offline by `python manage.py build_index`, so this does not depend on corpus size
 try:
 
     logger.info("RAG agent initializing...")
@@ -20,6 +30,41 @@ except Exception as e:
     logger.exception(f"Failed to initialize RAG agent at startup due to: {e}")
 
 
+def overloaded_response(retry_after: float = 1.0) -> JsonResponse:
+    response = JsonResponse({"error" : "The assistant is busy right now, please try again in a moment."}, status=503)
+    response["Retry-After"] = str(max(int(retry_after + 0.5), 1))
+    return response
+
+
+def llm_saturated() -> bool:
+    """
+        True when the LLM gateway's queue is full, checked before any work so overloaded requests fail fast
+    """
+    runtime = agent.runtime
+    return runtime is not None and runtime.gateway is not None and runtime.gateway.saturated()
+
+
+def uses_checkpoints() -> bool:
+    """
+        True when the agent keeps each session's state in its checkpointer, the DB history is then not needed
+    """
+    runtime = agent.runtime
+    return runtime is not None and runtime.session_graph is not None
+
+
+def get_session_id(request) -> str:
+    """
+        returns the session key of the browser, creating the session on its first message
+    """
+    #using session key to keep track of chat history since web app currently has no user management system
+    session_id = request.session.session_key
+    if not session_id:
+        request.session.create()
+        session_id = request.session.session_key
+
+    return session_id
+
+
 # Create your views here.
 def rag_agent_home(request):
 
@@ -30,39 +75,164 @@ def send_message(request):
     logger.info("calling send message")
 
     if request.method == "POST":
+        if llm_saturated():
+            logger.warning("LLM queue full, rejecting message")
+            return overloaded_response()
+
         try:
 
+            with span("send_message", start_trace=True):
+                data = json.loads(request.body) #parse request to JSON format
+                user_input = data.get("message", "")
+
+                with span("db.session"):
+                    session_id = get_session_id(request)
+
+                #Read the last messages of this session plus the rolling summary of older ones, unless the agent restores them from its checkpoints
+                summary, previous_messages = "", []
+                if not uses_checkpoints():
+                    with span("db.load_history") as history_span:
+                        summary, previous_messages = load_history(session_id)
+                        history_span.set(messages=len(previous_messages))
+
+                #queue the user message for the background writer, it is saved even if the agent fails
+                with span("db.save_message"):
+                    save_messages(ChatMessage(session_id=session_id, role="user", content=user_input))
+
+                logger.info("calling RAG agent")
+                logger.info(f"user input: {user_input}")
+                start = time.perf_counter()
+                response = run_agent(previous_messages, user_input, summary=summary, session_id=session_id) # call RAG agent
+                logger.info("RAG agent responded")
+
+                totals = tracing.current_totals() #tokens of every llm call of this request
+                with span("db.save_message"):
+                    save_messages(ChatMessage(
+                        session_id=session_id,
+                        role="agent",
+                        content=response,
+                        latency_ms=round((time.perf_counter() - start) * 1000, 1),
+                        input_tokens=totals.get("input_tokens", 0),
+                        output_tokens=totals.get("output_tokens", 0),
+                    ))
+
+            return JsonResponse({"reply" : response})
+
+        except LLMOverloaded as e:
+            logger.warning(f"LLM overloaded: {e}")
+            return overloaded_response(e.retry_after)
+
+        except SessionBusy as e: #another tab of the same session is still waiting for its answer
+            logger.warning(f"{e}")
+            return JsonResponse({"error" : "Your previous message is still being answered, please wait for it."}, status=409)
+
+        except Exception as e:
+            logger.exception(f"failed due to: {e}")
+            return JsonResponse({"error" : str(e)}, status=500)
+    
+    return JsonResponse({"error" : "Invalid request method"}, status=400)
+
+@csrf_exempt
+async def stream_message(request):
+    """
+        Async variant of send_message, streams the reply as Server-Sent Events while the agent runs.
+        Served without blocking a worker per conversation when the app runs under ASGI (config/asgi.py, e.g. uvicorn).
+        Events: token, reset, tool_start, tool_end, done and error, each with a JSON payload
+    """
+    logger.info("calling stream message")
+
+    if request.method != "POST":
+        return JsonResponse({"error" : "Invalid request method"}, status=400)
+
+    if llm_saturated():
+        logger.warning("LLM queue full, rejecting message")
+        return overloaded_response()
+
+    try:
+        with span("stream_message", start_trace=True): #the agent run is traced separately as astream_agent, it runs after this view returns
             data = json.loads(request.body) #parse request to JSON format
             user_input = data.get("message", "")
 
-            #using session key to keep track of chat history since web app currently has no user management system
-            session_id = request.session.session_key
-            if not session_id:
-                request.session.create()
-                session_id = request.session.session_key
+            with span("db.session"):
+                session_id = await sync_to_async(get_session_id)(request)
 
-            #append user message to database
-            ChatMessage.objects.create(
-                session_id=session_id,
-                role="user",
-                content=user_input
-            )
+            #Read the last messages of this session plus the rolling summary of older ones, unless the agent restores them from its checkpoints
+            summary, previous_messages = "", []
+            if not uses_checkpoints():
+                with span("db.load_history") as history_span:
+                    summary, previous_messages = await sync_to_async(load_history)(session_id)
+                    history_span.set(messages=len(previous_messages))
 
-            #Read message history from database where session id of browser is = session id of db row
-            previous_messages = ChatMessage.objects.filter(
-                session_id=session_id,
-            ).order_by("timestamp")
+            #queue the user message for the background writer, it is saved even if the agent fails
+            with span("db.save_message"):
+                await asave_messages(ChatMessage(session_id=session_id, role="user", content=user_input))
 
+    except Exception as e:
+        logger.exception(f"failed due to: {e}")
+        return JsonResponse({"error" : str(e)}, status=500)
 
-            logger.info("calling RAG agent")
+    async def event_stream():
+        try:
+            logger.info("streaming RAG agent")
             logger.info(f"user input: {user_input}")
-            response = run_agent(previous_messages, user_input) # call RAG agent
+            start = time.perf_counter()
+            async for event in astream_agent(previous_messages, user_input, summary=summary, session_id=session_id):
+                if event["event"] == "done":
+                    usage = event["data"]["usage"]
+                    await asave_messages(ChatMessage(
+                        session_id=session_id,
+                        role="agent",
+                        content=event["data"]["reply"],
+                        latency_ms=round((time.perf_counter() - start) * 1000, 1),
+                        input_tokens=usage["input_tokens"],
+                        output_tokens=usage["output_tokens"],
+                    ))
+                yield f"event: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
             logger.info("RAG agent responded")
 
-            return JsonResponse({"reply" : response})
-        
+        except LLMOverloaded as e: #admitted by the view but the queue filled up before the llm call
+            logger.warning(f"LLM overloaded: {e}")
+            yield f"event: error\ndata: {json.dumps({'error' : 'The assistant is busy right now, please try again in a moment.', 'retry_after' : e.retry_after})}\n\n"
+
+        except SessionBusy as e:
+            logger.warning(f"{e}")
+            yield f"event: error\ndata: {json.dumps({'error' : 'Your previous message is still being answered, please wait for it.'})}\n\n"
+
         except Exception as e:
             logger.exception(f"failed due to: {e}")
-            return JsonResponse({"error" : str(e)}, status=500)
-    
-    return JsonResponse({"error" : "Invalid request method"}, status=400)
\ No newline at end of file
+            yield f"event: error\ndata: {json.dumps({'error' : str(e)})}\n\n"
+
+    response = StreamingHttpResponse(event_stream(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no" #stops reverse proxies from buffering the stream
+
+    return response
+
+
+def cache_stats(request):
+    """
+        returns hit/miss counters of the answer cache and the retrieval cache
+    """
+    runtime = agent.runtime
+
+    return JsonResponse({
+        "answer_cache" : runtime.answer_cache.stats() if runtime and runtime.answer_cache else None,
+        "retrieval_cache" : runtime.retriever.stats() if runtime and runtime.retriever else None,
+    })
+
+
+def metrics(request):
+    """
+        returns p50/p95/p99 latency per traced stage (send_message, run_agent, call_llm, execute_tools, retriever,
+        chroma, db, ...) over the most recent requests, plus token and tool call totals, the LLM gateway's
+        queue depth, wait times and rejections, the LLM calls avoided by the intent fast path, the chat writer's
+        queue and batch counts and the trace writer's written, dropped and rotated counts
+    """
+    runtime = agent.runtime
+
+    return JsonResponse({
+        **tracing.metrics(),
+        "llm_gateway" : runtime.gateway.stats() if runtime and runtime.gateway else None,
+        "intent_fast_path" : runtime.intent_classifier.stats() if runtime and runtime.intent_classifier else None,
+        "chat_writer" : chat_writer.stats(),
+    })
@@ -0,0 +1,328 @@
+import atexit
+import contextvars
+import json
+import math
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+from config.logger import get_logger
+
+logger = get_logger(__name__)
+
+#finished traces are appended here as one JSON object per line by a background thread, see TraceWriter
+TRACE_FILE = Path(os.getenv("TRACE_FILE", Path(__file__).resolve().parent.parent / "traces.jsonl"))
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(50 * 1024 * 1024))) #the file is rotated to <file>.1 past this size, 0 never rotates
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", "1000")) #finished traces waiting to be written, more are dropped
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "1") != "0"
+STAGE_WINDOW = int(os.getenv("TRACE_STAGE_WINDOW", "1000")) #most recent durations per stage kept for the percentiles
+
+_current_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    def __init__(self, name: str, parent: "Span | None", attrs: dict):
+        self.id = uuid.uuid4().hex[:8]
+        self.name = name
+        self.parent_id = parent.id if parent is not None else None
+        self.attrs = attrs
+        self.start = time.perf_counter()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counts):
+        """
+            increments numeric attributes, e.g. span.add(tool_calls=2)
+        """
+        for key, value in counts.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def to_dict(self, trace_start: float) -> dict:
+        return {
+            "id" : self.id,
+            "parent" : self.parent_id,
+            "name" : self.name,
+            "offset_ms" : round((self.start - trace_start) * 1000, 2),
+            "duration_ms" : round((self.duration or 0.0) * 1000, 2),
+            "attrs" : self.attrs,
+        }
+
+
+class Trace:
+    """
+        All spans of one request. Spans opened in worker threads join it as long as the thread runs in a copy of
+        the request's context (contextvars.copy_context, which LangGraph and execute_tools already use).
+    """
+
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self.totals: dict[str, int] = {} #token and tool call counts summed over the whole request
+        self.lock = threading.Lock()
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.totals[key] = self.totals.get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        root = self.spans[0] if self.spans else None
+        return {
+            "trace_id" : self.id,
+            "name" : self.name,
+            "timestamp" : self.wall_start,
+            "duration_ms" : round((root.duration or 0.0) * 1000, 2) if root else 0.0,
+            "totals" : self.totals,
+            "spans" : [span.to_dict(self.start) for span in self.spans],
+        }
+
+
+class StageMetrics:
+    """
+        Rolling per stage durations (the last STAGE_WINDOW spans of every name) for the /chat/metrics endpoint
+    """
+
+    def __init__(self, window: int = STAGE_WINDOW):
+        self.window = window
+        self.durations: dict[str, deque] = {}
+        self.counts: dict[str, int] = {}
+        self.totals: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def record(self, trace: Trace):
+        with self.lock:
+            for span in trace.spans:
+                self.durations.setdefault(span.name, deque(maxlen=self.window)).append((span.duration or 0.0) * 1000)
+                self.counts[span.name] = self.counts.get(span.name, 0) + 1
+            for key, value in trace.totals.items():
+                self.totals[key] = self.totals.get(key, 0) + value
+            self.totals["requests"] = self.totals.get("requests", 0) + 1
+
+    def summary(self) -> dict:
+        with self.lock:
+            stages = {}
+            for name, durations in self.durations.items():
+                values = sorted(durations)
+                stages[name] = {
+                    "count" : self.counts[name],
+                    "mean_ms" : round(sum(values) / len(values), 2),
+                    "p50_ms" : percentile(values, 50),
+                    "p95_ms" : percentile(values, 95),
+                    "p99_ms" : percentile(values, 99),
+                    "max_ms" : round(values[-1], 2),
+                }
+
+            return {"stages" : stages, "totals" : dict(self.totals), "window" : self.window}
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+    """
+        nearest rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+
+    rank = max(math.ceil(p / 100 * len(sorted_values)) - 1, 0)
+
+    return round(sorted_values[min(rank, len(sorted_values) - 1)], 2)
+
+
+class TraceWriter:
+    """
+        Writes finished traces to the trace file from a background thread, so neither a request thread nor the event
+        loop of the streaming endpoint ever waits on the file. Traces queued meanwhile are serialised and appended
+        together. When an append would take the file past max_bytes it is renamed to <file>.1 (replacing the older one)
+        first, so at most about twice max_bytes stays on disk. A trace that finds the queue full is dropped and counted.
+    """
+
+    def __init__(self, path: Path = TRACE_FILE, max_bytes: int = TRACE_FILE_MAX_BYTES, max_size: int = TRACE_QUEUE_SIZE):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.queue: queue.Queue[Trace] = queue.Queue(maxsize=max_size)
+
+        self.lock = threading.Lock()
+        self.thread: threading.Thread | None = None
+
+        self.written = 0
+        self.dropped = 0
+        self.rotations = 0
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                self.thread.start()
+
+    def put(self, trace: Trace):
+        self._start()
+
+        try:
+            self.queue.put_nowait(trace)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+
+    def _run(self):
+        while True:
+            traces = [self.queue.get()]
+            while True:
+                try:
+                    traces.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            self._write(traces)
+
+            for _ in traces:
+                self.queue.task_done()
+
+    def _write(self, traces: list[Trace]):
+        lines = []
+        for trace in traces:
+            try:
+                lines.append((json.dumps(trace.to_dict(), default=str) + "\n").encode("utf-8"))
+            except (TypeError, ValueError, RuntimeError) as e: #e.g. an abandoned tool call still setting span attributes
+                logger.warning(f"Could not serialise trace {trace.id}: {e}")
+
+        written = 0
+        try:
+            size = self.path.stat().st_size if self.path.exists() else 0
+            f = open(self.path, "ab")
+            try:
+                for line in lines:
+                    if self.max_bytes and size and size + len(line) > self.max_bytes:
+                        f.close()
+                        self.path.replace(self.path.with_name(self.path.name + ".1"))
+                        f = open(self.path, "ab")
+                        size = 0
+                        with self.lock:
+                            self.rotations += 1
+
+                    f.write(line)
+                    size += len(line)
+                    written += 1
+            finally:
+                f.close()
+        except OSError as e:
+            logger.warning(f"Could not write {len(lines) - written} traces to {self.path}: {e}")
+
+        with self.lock:
+            self.written += written
+
+    def flush(self):
+        """
+            blocks until every queued trace is written, called at interpreter exit
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "queued" : self.queue.qsize(),
+                "written" : self.written,
+                "dropped" : self.dropped,
+                "rotations" : self.rotations,
+            }
+
+
+stage_metrics = StageMetrics()
+trace_writer = TraceWriter()
+atexit.register(trace_writer.flush)
+
+
+def export(trace: Trace):
+    stage_metrics.record(trace)
+    trace_writer.put(trace)
+
+
+def _reset(var: contextvars.ContextVar, token: contextvars.Token):
+    try:
+        var.reset(token)
+    except ValueError: #exited in another context than it was entered in, e.g. an async generator resumed by a new task
+        var.set(None)
+
+
+@contextmanager
+def span(name: str, start_trace: bool = False, **attrs):
+    """
+        Times the enclosed block as a span of the current trace.
+        Without a current trace the block is only traced when start_trace is set (request entry points); the new trace
+        is exported (JSON line + stage metrics) when this outermost span ends.
+            with span("retriever", k=4) as s:
+                s.set(cache_hit=True)
+    """
+    trace = _current_trace.get()
+    root = trace is None
+
+    if not TRACE_ENABLED or (root and not start_trace):
+        yield Span(name, None, attrs) #not recorded anywhere
+        return
+
+    trace_token = None
+
+    if root:
+        trace = Trace(name)
+        trace_token = _current_trace.set(trace)
+
+    current = Span(name, _current_span.get(), attrs)
+    with trace.lock:
+        trace.spans.append(current)
+    span_token = _current_span.set(current)
+
+    try:
+        yield current
+    except Exception as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _reset(_current_span, span_token)
+
+        if root:
+            _reset(_current_trace, trace_token)
+            export(trace)
+
+
+def current_span() -> Span | None:
+    return _current_span.get()
+
+
+def add_counts(**counts):
+    """
+        adds counts (tokens, tool calls, ...) to the current span and the totals of the current trace
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counts)
+
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(**counts)
+
+
+def current_totals() -> dict:
+    """
+        token and tool call counts of the current trace so far
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return {}
+
+    with trace.lock:
+        return dict(trace.totals)
+
+
+def metrics() -> dict:
+    return {**stage_metrics.summary(), "trace_writer" : trace_writer.stats()}
@@ -0,0 +1,156 @@
+"""
+    Query latency vs. recall of chroma's HNSW index at different settings, measured against exact brute-force search.
+    The chunk vectors of an already built collection are copied into in-memory collections, one per combination of
+    distance metric, M, ef_construction and ef_search, so nothing is re-embedded.
+        recall@k   share of the exact top k ids the HNSW query returned
+        build_s    time to insert every vector (HNSW graph construction)
+
+        python scripts/ann_report.py --collection market_db --m 8 16 32 --ef-construction 100 200 --ef-search 10 50 100
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import chromadb
+import numpy as np
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BASE_DIR))
+
+from apps.chat.rag import pdfloader
+from apps.chat.rag.embeddings import get_embeddings
+from config.tracing import percentile
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+RESULTS_DIR = BASE_DIR / "benchmarks"
+ADD_BATCH_SIZE = 1000 #below chroma's maximum batch size
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int, metric: str) -> list[list[int]]:
+    """
+        brute-force nearest neighbours with chroma's distance definitions
+    """
+    if metric == "cosine":
+        vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+        distances = 1 - queries @ vectors.T
+    elif metric == "ip":
+        distances = 1 - queries @ vectors.T
+    else: #squared l2
+        distances = (queries ** 2).sum(axis=1, keepdims=True) - 2 * queries @ vectors.T + (vectors ** 2).sum(axis=1)
+
+    return np.argsort(distances, axis=1)[:, :k].tolist()
+
+
+def load_queries(eval_set: Path, texts: list[str], samples: int) -> list[str]:
+    """
+        the labelled questions plus the first sentence of a few random chunks
+    """
+    queries = []
+    if eval_set.exists():
+        with open(eval_set, "r", encoding="utf-8") as f:
+            queries = [item["question"] for item in json.load(f)]
+
+    rng = random.Random(0)
+    for text in rng.sample(texts, min(samples, len(texts))):
+        queries.append(text.split(". ")[0][:200])
+
+    return queries
+
+
+def bench_setting(client, vectors: np.ndarray, queries: np.ndarray, exact: list[list[int]], k: int, metric: str,
+                  m: int, ef_construction: int, ef_search: int) -> dict:
+    name = f"ann_{metric}_{m}_{ef_construction}_{ef_search}"
+    collection = client.create_collection(
+        name,
+        metadata=pdfloader.collection_metadata(metric, m, ef_construction, ef_search),
+    )
+
+    start = time.perf_counter()
+    for offset in range(0, len(vectors), ADD_BATCH_SIZE):
+        batch = vectors[offset:offset + ADD_BATCH_SIZE]
+        collection.add(ids=[str(i) for i in range(offset, offset + len(batch))], embeddings=batch.tolist())
+    build_seconds = time.perf_counter() - start
+
+    latencies = []
+    recalls = []
+    for query, expected in zip(queries, exact):
+        start = time.perf_counter()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        found = {int(i) for i in result["ids"][0]}
+        recalls.append(len(found & set(expected)) / len(expected))
+
+    client.delete_collection(name)
+    latencies.sort()
+
+    return {
+        "metric" : metric,
+        "m" : m,
+        "ef_construction" : ef_construction,
+        "ef_search" : ef_search,
+        "k" : k,
+        "recall_at_k" : round(sum(recalls) / len(recalls), 4),
+        "p50_ms" : percentile(latencies, 50),
+        "p95_ms" : percentile(latencies, 95),
+        "build_s" : round(build_seconds, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HNSW latency vs. recall against exact search")
+    parser.add_argument("--collection", choices=sorted(pdfloader.COLLECTIONS), default="market_db")
+    parser.add_argument("--metrics", nargs="+", choices=sorted(pdfloader.RELEVANCE_SCORE_FNS), default=[pdfloader.DISTANCE_METRIC])
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument("--k", type=int, default=pdfloader.RETRIEVER_K)
+    parser.add_argument("--samples", type=int, default=100, help="random chunks used as extra queries")
+    parser.add_argument("--output", type=Path, help="result file, defaults to benchmarks/ann_report_<timestamp>.json")
+    args = parser.parse_args()
+
+    _, chroma_dir = pdfloader.COLLECTIONS[args.collection]
+    data = pdfloader.open_vectorstore(chroma_dir)._collection.get(include=["embeddings", "documents"])
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+
+    queries = load_queries(EVAL_SET, data["documents"], args.samples)
+    query_vectors = np.asarray(get_embeddings().embed_documents(queries), dtype=np.float32)
+    k = min(args.k, len(vectors))
+
+    print(f"{args.collection}: {len(vectors)} vectors, {len(queries)} queries, k={k}")
+
+    client = chromadb.EphemeralClient()
+    results = []
+
+    for metric in args.metrics:
+        start = time.perf_counter()
+        exact = exact_top_k(vectors, query_vectors, k, metric)
+        exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+        print(f"exact {metric}: {exact_ms:.2f} ms per query")
+
+        for m in args.m:
+            for ef_construction in args.ef_construction:
+                for ef_search in args.ef_search:
+                    row = bench_setting(client, vectors, query_vectors, exact, k, metric, m, ef_construction, ef_search)
+                    row["exact_ms"] = round(exact_ms, 3)
+                    results.append(row)
+                    print(
+                        f"{metric:>6} M={m:<3} ef_construction={ef_construction:<4} ef_search={ef_search:<4} "
+                        f"recall@{k} {row['recall_at_k']:.3f} p50 {row['p50_ms']} ms p95 {row['p95_ms']} ms build {row['build_s']}s"
+                    )
+
+    output = args.output or RESULTS_DIR / f"ann_report_{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"collection" : args.collection, "vectors" : len(vectors), "queries" : len(queries), "results" : results}, f, indent=2)
+
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+    Offline benchmark of the RAG agent, no Groq key needed: ChatGroq is replaced by the deterministic ScriptedChatModel.
+    Measures ingestion time, retrieval latency, end-to-end latency percentiles, LLM calls per question and throughput
+    at several concurrency levels and graph modes and peak RSS, and saves the results as JSON so two versions can be
+    compared.
+
+        python scripts/benchmark.py --concurrency 1 4 8 --repeats 3
+        python scripts/benchmark.py --graph-modes agent retrieve_first --pattern sequential
+        python scripts/benchmark.py --compare benchmarks/<previous result>.json
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BASE_DIR))
+
+from apps.chat.rag import pdfloader
+from apps.chat.rag.agent import init_rag, run_agent
+from apps.chat.rag.build_graph import GRAPH_MODES
+from scripts.fake_llm import TOOL_PATTERNS, ScriptedChatModel
+from config import tracing
+from config.tracing import percentile
+
+RESULTS_DIR = BASE_DIR / "benchmarks"
+
+#questions about both collections, the scripted model searches them verbatim and looks up the company they name
+BENCH_QUESTIONS = [
+    "Is Apple listed on NASDAQ?",
+    "What is the ticker symbol of Microsoft?",
+    "Which exchange lists Coca-Cola?",
+    "What companies from Canada are listed on the NYSE?",
+    "Is Tesla traded on NASDAQ?",
+    "How did the S&P 500 perform in 2021?",
+    "What percentage of large cap funds underperformed the S&P 500?",
+    "What are the market attributes of US equities in June 2025?",
+    "How did the sectors of the S&P 500 perform?",
+    "What was the dividend yield of the S&P 500?",
+    "How did small cap funds perform against their benchmark?",
+    "What was the volatility of the US equity market?",
+]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1) #bytes on macOS, kilobytes on linux
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    values = sorted(latency * 1000 for latency in latencies)
+    return {
+        "count" : len(values),
+        "mean_ms" : round(sum(values) / len(values), 2) if values else 0.0,
+        "p50_ms" : percentile(values, 50),
+        "p95_ms" : percentile(values, 95),
+        "p99_ms" : percentile(values, 99),
+        "max_ms" : round(values[-1], 2) if values else 0.0,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_ingestion(rebuild: bool) -> dict:
+    start = time.perf_counter()
+    pdfloader.build_index(rebuild=rebuild)
+    elapsed = time.perf_counter() - start
+
+    print(f"ingestion ({'rebuild' if rebuild else 'incremental'}): {elapsed:.2f}s")
+
+    return {"rebuild" : rebuild, "seconds" : round(elapsed, 3), "peak_rss_mb" : peak_rss_mb()}
+
+
+def bench_retrieval(runtime, questions: list[str]) -> dict:
+    runtime.retriever.get_relevant_documents(questions[0]) #loads the reranker and warms the embedder
+
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        runtime.retriever.get_relevant_documents(question)
+        latencies.append(time.perf_counter() - start)
+
+    summary = latency_summary(latencies)
+    print(f"retrieval: p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms")
+
+    return summary
+
+
+def bench_agent(runtime, questions: list[str], concurrency: int, repeats: int) -> dict:
+    workload = questions * repeats
+
+    def run(question: str) -> float:
+        start = time.perf_counter()
+        run_agent([], question, agent_runtime=runtime)
+        return time.perf_counter() - start
+
+    llm_calls = tracing.metrics()["totals"].get("llm_calls", 0) #every run_agent is a trace, its llm calls are summed here
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(run, workload))
+    wall = time.perf_counter() - start
+
+    summary = latency_summary(latencies)
+    summary["graph_mode"] = runtime.graph_mode
+    summary["concurrency"] = concurrency
+    summary["llm_calls_per_question"] = round((tracing.metrics()["totals"].get("llm_calls", 0) - llm_calls) / len(workload), 2)
+    summary["throughput_rps"] = round(len(workload) / wall, 3)
+    summary["wall_seconds"] = round(wall, 3)
+    summary["peak_rss_mb"] = peak_rss_mb()
+
+    print(
+        f"agent {runtime.graph_mode} x{concurrency}: p50 {summary['p50_ms']} ms, p95 {summary['p95_ms']} ms, "
+        f"p99 {summary['p99_ms']} ms, {summary['llm_calls_per_question']} llm calls/question, {summary['throughput_rps']} req/s"
+    )
+
+    return summary
+
+
+def compare(current: dict, previous_path: Path):
+    """
+        prints the change of every latency and throughput number against a previous result file
+    """
+    with open(previous_path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+
+    print(f"\ncompared with {previous_path.name} (commit {previous.get('commit')}):")
+
+    def line(label: str, old, new, lower_is_better: bool = True):
+        if not old or new is None:
+            return
+        change = (new - old) / old * 100
+        worse = change > 0 if lower_is_better else change < 0
+        print(f"  {label}: {old} -> {new} ({change:+.1f}%){'  REGRESSION' if worse and abs(change) > 10 else ''}")
+
+    if previous.get("ingestion") and current.get("ingestion"):
+        line("ingestion s", previous["ingestion"]["seconds"], current["ingestion"]["seconds"])
+    for key in ("p50_ms", "p95_ms"):
+        line(f"retrieval {key}", previous["retrieval"].get(key), current["retrieval"].get(key))
+
+    old_runs = {(run.get("graph_mode", "agent"), run["concurrency"]) : run for run in previous.get("agent", [])}
+    for run in current["agent"]:
+        old = old_runs.get((run["graph_mode"], run["concurrency"]))
+        if old is None:
+            continue
+        label = f"agent {run['graph_mode']} x{run['concurrency']}"
+        for key in ("p50_ms", "p95_ms", "p99_ms", "llm_calls_per_question"):
+            line(f"{label} {key}", old.get(key), run[key])
+        line(f"{label} throughput", old["throughput_rps"], run["throughput_rps"], lower_is_better=False)
+
+    line("peak rss mb", previous.get("peak_rss_mb"), current.get("peak_rss_mb"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the RAG agent with a scripted LLM")
+    parser.add_argument("--pattern", choices=sorted(TOOL_PATTERNS), default="retrieve", help="tool calls the scripted LLM makes")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per scripted LLM call")
+    parser.add_argument("--latency-per-1k-tokens", type=float, default=0.05, help="extra seconds per 1000 prompt tokens")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--graph-modes", nargs="+", choices=GRAPH_MODES, default=["agent"], help="graph topologies to compare")
+    parser.add_argument("--repeats", type=int, default=2, help="times every question is asked per concurrency level")
+    parser.add_argument("--questions", type=Path, help="JSON list of questions, defaults to the built-in set")
+    parser.add_argument("--skip-ingest", action="store_true", help="do not time ingestion")
+    parser.add_argument("--rebuild", action="store_true", help="time a full rebuild instead of an incremental sync")
+    parser.add_argument("--caches", action="store_true", help="keep the answer and retrieval caches on")
+    parser.add_argument("--output", type=Path, help="result file, defaults to benchmarks/<timestamp>_<commit>.json")
+    parser.add_argument("--compare", type=Path, help="previous result file to compare with")
+    args = parser.parse_args()
+
+    if not args.caches: #repeated questions would otherwise only measure cache hits
+        os.environ["RAG_ANSWER_CACHE"] = "0"
+        os.environ["RAG_RETRIEVAL_CACHE_SIZE"] = "0"
+
+    questions = BENCH_QUESTIONS
+    if args.questions:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            questions = json.load(f)
+
+    results = {
+        "commit" : git_commit(),
+        "timestamp" : datetime.now().isoformat(timespec="seconds"),
+        "python" : platform.python_version(),
+        "settings" : {
+            "pattern" : args.pattern,
+            "latency" : args.latency,
+            "latency_per_1k_tokens" : args.latency_per_1k_tokens,
+            "repeats" : args.repeats,
+            "questions" : len(questions),
+            "caches" : args.caches,
+            "retrieval_mode" : os.getenv("RAG_RETRIEVAL_MODE", "hybrid"),
+            "graph_modes" : args.graph_modes,
+        },
+        "ingestion" : None if args.skip_ingest else bench_ingestion(args.rebuild),
+    }
+
+    llm = ScriptedChatModel(pattern=args.pattern, latency=args.latency, latency_per_1k_tokens=args.latency_per_1k_tokens)
+    runtimes = [init_rag(build_index=False, llm=llm, graph_mode=mode) for mode in args.graph_modes]
+
+    results["retrieval"] = bench_retrieval(runtimes[0], questions)
+    results["agent"] = [
+        bench_agent(runtime, questions, concurrency, args.repeats)
+        for runtime in runtimes
+        for concurrency in args.concurrency
+    ]
+    results["peak_rss_mb"] = peak_rss_mb()
+
+    print(f"peak rss: {results['peak_rss_mb']} MB")
+
+    output = args.output or RESULTS_DIR / f"{datetime.now():%Y%m%d-%H%M%S}_{results['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"results saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+    Retrieval quality and speed evaluation over a labelled question set (scripts/retrieval_eval_set.json, pages are
+    1-based as shown by a pdf viewer). Every chunk size / overlap combination is ingested into its own throwaway
+    collections, then every retrieval mode and k is scored:
+        hit@k      share of questions with at least one relevant page in the results
+        recall@k   share of the relevant pages found
+        mrr        mean reciprocal rank of the first relevant result
+        tokens     mean estimated tokens of the retrieved chunks, i.e. the context sent to the LLM per search
+    next to ingestion time, index size and query latency.
+
+        python scripts/eval_retrieval.py --chunk-sizes 500 1000 --overlaps 100 200 --k 2 4 6 --modes vector hybrid
+"""
+import argparse
+import json
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+sys.path.append(str(BASE_DIR))
+
+from apps.chat.rag import pdfloader
+from apps.chat.rag.budget import count_tokens
+from apps.chat.rag.embeddings import get_embeddings
+from apps.chat.rag.reranker import CrossEncoderReranker
+from apps.chat.rag.router import EmbeddingRouter, RouterRetriever
+from config.logger import get_logger
+from config.tracing import percentile
+
+logger = get_logger(__name__)
+
+EVAL_SET = Path(__file__).resolve().parent / "retrieval_eval_set.json"
+RESULTS_DIR = BASE_DIR / "benchmarks"
+
+
+def dir_size(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file())
+
+
+def build_collections(work_dir: Path, chunk_size: int, chunk_overlap: int) -> tuple[dict, dict]:
+    """
+        ingests both collections with the given chunking into work_dir
+        returns:
+            ({collection: Chroma}, ingestion stats)
+    """
+    stores = {}
+    chunks = 0
+    start = time.perf_counter()
+
+    for collection, (pdf_dir, _) in pdfloader.COLLECTIONS.items():
+        stores[collection] = pdfloader.build_vectorstore(pdf_dir, work_dir / collection, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        chunks += len(stores[collection].get(include=[])["ids"])
+
+    stats = {
+        "ingest_seconds" : round(time.perf_counter() - start, 2),
+        "chunks" : chunks,
+        "index_mb" : round(dir_size(work_dir) / 1024 / 1024, 2),
+    }
+
+    return stores, stats
+
+
+def evaluate(retriever: RouterRetriever, eval_set: list[dict]) -> dict:
+    hits = 0
+    found_pages = 0
+    relevant_pages = 0
+    reciprocal_ranks = 0.0
+    tokens = []
+    latencies = []
+
+    for item in eval_set:
+        relevant = {(r["source"], r["page"]) for r in item["relevant"]}
+
+        start = time.perf_counter()
+        docs = retriever.get_relevant_documents(item["question"])
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        retrieved = [(Path(doc.metadata.get("source", "")).name, doc.metadata.get("page", -1) + 1) for doc in docs] #chroma pages are 0-based
+        ranks = [rank for rank, page in enumerate(retrieved, start=1) if page in relevant]
+
+        if ranks:
+            hits += 1
+            reciprocal_ranks += 1 / ranks[0]
+        found_pages += len(relevant & set(retrieved))
+        relevant_pages += len(relevant)
+        tokens.append(sum(count_tokens(doc.page_content) for doc in docs))
+
+    latencies.sort()
+
+    return {
+        "hit_at_k" : round(hits / len(eval_set), 3),
+        "recall_at_k" : round(found_pages / relevant_pages, 3),
+        "mrr" : round(reciprocal_ranks / len(eval_set), 3),
+        "mean_tokens" : round(sum(tokens) / len(tokens), 1),
+        "p50_ms" : percentile(latencies, 50),
+        "p95_ms" : percentile(latencies, 95),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep chunking, k and retrieval mode over a labelled question set")
+    parser.add_argument("--chunk-sizes", type=int, nargs="+", default=[500, 1000])
+    parser.add_argument("--overlaps", type=int, nargs="+", default=[100, 200])
+    parser.add_argument("--k", type=int, nargs="+", default=[2, 4, 6])
+    parser.add_argument("--modes", nargs="+", choices=["vector", "hybrid"], default=["vector", "hybrid"])
+    parser.add_argument("--rerank", action="store_true", help="rerank a wider candidate set with the cross-encoder")
+    parser.add_argument("--eval-set", type=Path, default=EVAL_SET)
+    parser.add_argument("--work-dir", type=Path, help="where the sweep's collections are built, a temporary directory by default")
+    parser.add_argument("--output", type=Path, help="result file, defaults to benchmarks/retrieval_eval_<timestamp>.json")
+    args = parser.parse_args()
+
+    with open(args.eval_set, "r", encoding="utf-8") as f:
+        eval_set = json.load(f)
+
+    query_router = EmbeddingRouter(get_embeddings())
+    reranker = CrossEncoderReranker() if args.rerank else None
+    results = []
+
+    with tempfile.TemporaryDirectory(prefix="rag-eval-") as tmp:
+        work_root = args.work_dir or Path(tmp)
+
+        for chunk_size in args.chunk_sizes:
+            for chunk_overlap in args.overlaps:
+                if chunk_overlap >= chunk_size:
+                    continue
+
+                work_dir = work_root / f"chunk{chunk_size}_overlap{chunk_overlap}"
+                stores, ingest_stats = build_collections(work_dir, chunk_size, chunk_overlap)
+                lexical_indexes = {
+                    "listing" : pdfloader.load_lexical_index(work_dir / "listing_db"),
+                    "market" : pdfloader.load_lexical_index(work_dir / "market_db"),
+                }
+
+                for mode in args.modes:
+                    for k in args.k:
+                        retriever = RouterRetriever(
+                            stores["listing_db"].as_retriever(search_kwargs={"k" : k}),
+                            stores["market_db"].as_retriever(search_kwargs={"k" : k}),
+                            logger,
+                            cache_size=0, #every question is a real search
+                            mode=mode,
+                            lexical_loader=lambda: lexical_indexes,
+                            query_router=query_router,
+                            reranker=reranker,
+                        )
+                        scores = evaluate(retriever, eval_set)
+                        row = {"chunk_size" : chunk_size, "chunk_overlap" : chunk_overlap, "mode" : mode, "k" : k, **ingest_stats, **scores}
+                        results.append(row)
+                        print(
+                            f"chunk {chunk_size:>5} overlap {chunk_overlap:>4} {mode:>6} k={k}: "
+                            f"hit {row['hit_at_k']:.2f} recall {row['recall_at_k']:.2f} mrr {row['mrr']:.2f} "
+                            f"tokens {row['mean_tokens']:>6} p50 {row['p50_ms']} ms | "
+                            f"{row['chunks']} chunks, {row['index_mb']} MB, ingested in {row['ingest_seconds']}s"
+                        )
+
+    #cheapest configurations first among those that find as many questions as the best one
+    best_hit = max(row["hit_at_k"] for row in results) if results else 0
+    shortlist = sorted((row for row in results if row["hit_at_k"] == best_hit), key=lambda row: row["mean_tokens"])
+    if shortlist:
+        best = shortlist[0]
+        print(
+            f"\nfewest tokens at hit@k {best_hit:.2f}: chunk {best['chunk_size']} overlap {best['chunk_overlap']} "
+            f"{best['mode']} k={best['k']} ({best['mean_tokens']} tokens)"
+        )
+
+    output = args.output or RESULTS_DIR / f"retrieval_eval_{datetime.now():%Y%m%d-%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump({"eval_set" : str(args.eval_set), "rerank" : args.rerank, "results" : results}, f, indent=2)
+
+    print(f"results saved to {output}")
+
+
+if __name__ == "__main__":
+    main()
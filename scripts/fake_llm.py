@@ -0,0 +1,85 @@
+import re
+import time
+import uuid
+from typing import Any
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+from apps.chat.rag.budget import count_tokens
+
+#tool calls the scripted model makes per turn, one inner list per LLM turn before it answers
+TOOL_PATTERNS = {
+    "direct" : [], #answers without tools
+    "retrieve" : [["retriever_tool"]],
+    "listing" : [["listing_lookup"]],
+    "parallel" : [["retriever_tool", "listing_lookup"]], #two tool calls in one turn
+    "sequential" : [["retriever_tool"], ["retriever_tool"]], #a follow-up search after reading the first results
+}
+
+LISTING_SKIP_WORDS = {"NASDAQ", "NYSE", "S&P", "US"} #capitalised words of a question that are not a company
+
+
+def listing_query(question: str) -> str:
+    """
+        the company or ticker of a question, like an LLM passes it to listing_lookup ("Is Apple listed on NASDAQ?" -> "Apple"),
+        the whole question when it names none
+    """
+    words = re.findall(r"[A-Za-z0-9&.\-]+", question)
+    names = [word for word in words[1:] if word[0].isupper() and word.upper() not in LISTING_SKIP_WORDS]
+
+    return names[0] if names else question
+
+
+class ScriptedChatModel(BaseChatModel):
+    """
+        Deterministic local stand-in for ChatGroq, used to benchmark the graph without an API key.
+        Each call sleeps latency + latency_per_1k_tokens per 1000 prompt tokens, then either issues the next turn of
+        tool calls of its pattern (retriever_tool searches the latest user question, listing_lookup the company it
+        names) or answers with the start of the tool results.
+    """
+
+    pattern: str = "retrieve"
+    latency: float = 0.5 #seconds per call
+    latency_per_1k_tokens: float = 0.05 #extra seconds per 1000 prompt tokens, like prefill time
+    answer_chars: int = 300
+
+    @property
+    def _llm_type(self) -> str:
+        return "scripted"
+
+    def bind_tools(self, tools: list, **kwargs) -> "ScriptedChatModel":
+        return self #the tool calls are scripted, the schemas are not needed
+
+    def _generate(self, messages: list[BaseMessage], stop: list[str] | None = None, run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt_tokens = sum(count_tokens(str(m.content)) for m in messages)
+        time.sleep(self.latency + self.latency_per_1k_tokens * prompt_tokens / 1000)
+
+        human_indexes = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+        question_index = human_indexes[-1] if human_indexes else 0
+        question = messages[question_index].content if messages else ""
+        turn = sum(1 for m in messages[question_index:] if isinstance(m, AIMessage) and m.tool_calls)
+        turns = TOOL_PATTERNS[self.pattern]
+        limit_reached = "maximum number of tool calls" in str(messages[0].content) if messages else False
+
+        if turn < len(turns) and not limit_reached:
+            message = AIMessage(
+                content="",
+                tool_calls=[
+                    {"name" : name, "args" : {"query" : listing_query(question) if name == "listing_lookup" else question}, "id" : f"call_{uuid.uuid4().hex[:8]}", "type" : "tool_call"}
+                    for name in turns[turn]
+                ],
+            )
+        else:
+            tool_output = " ".join(str(m.content) for m in messages[question_index:] if isinstance(m, ToolMessage))
+            answer = f"Based on the documents: {tool_output[:self.answer_chars]}" if tool_output else f"You asked: {question}"
+            message = AIMessage(content=answer)
+
+        message.usage_metadata = {
+            "input_tokens" : prompt_tokens,
+            "output_tokens" : count_tokens(str(message.content)) + 10 * len(message.tool_calls),
+            "total_tokens" : prompt_tokens + count_tokens(str(message.content)) + 10 * len(message.tool_calls),
+        }
+
+        return ChatResult(generations=[ChatGeneration(message=message)])
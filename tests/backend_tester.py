@@ -1,7 +1,7 @@
 import os
 import sys
 
-sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from apps.chat.rag.agent import init_rag, run_agent
 
@@ -11,10 +11,10 @@ def main():
 
     user_input = "What is the performance of the stock market?"
 
-    response = run_agent(user_input)
+    response = run_agent([], user_input) #no previous messages
 
     print("user: ", user_input)
     print("agent: ", response)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()